@@ -0,0 +1,69 @@
+"""
+Funzioni condivise tra l'API (main.py) e le interfacce Streamlit per l'analisi dei video.
+
+Le funzioni principali si importano dal pacchetto:
+    from analysis_core import describe_frames_sequential, extract_frames, get_system_prompt
+oppure, come finora, dai singoli moduli:
+    from analysis_core.history import build_history
+
+Importare il pacchetto non importa nessun modulo: ogni nome viene risolto dal suo modulo al primo
+accesso, e le dipendenze pesanti (cv2, numpy, langchain) sono importate solo quando servono
+(vedi analysis_core/lazy.py). Tempi di import misurati con benchmarks/bench_import_time.py.
+"""
+import importlib
+
+# Nome pubblico -> modulo che lo definisce
+_EXPORTS = {
+    "get_chat_backend": "backend",
+    "AnalysisBudget": "budget",
+    "BudgetExceeded": "budget",
+    "cached_call": "cache",
+    "conversation_context": "cache",
+    "get_response_cache": "cache",
+    "make_cache_key": "cache",
+    "suppress_near_duplicates": "dedup",
+    "ExtractedFrame": "frames",
+    "extract_frames": "frames",
+    "format_minutes_seconds": "frames",
+    "format_timestamp": "frames",
+    "image_file_data_url": "frames",
+    "jpeg_data_url": "frames",
+    "resize_image": "frames",
+    "build_history": "history",
+    "limit_previous_descriptions": "history",
+    "ReplyParseError": "parsing",
+    "parse_final_description": "parsing",
+    "parse_frame_description": "parsing",
+    "parse_reply": "parsing",
+    "AnalysisOptions": "pipeline",
+    "VideoAnalyzer": "pipeline",
+    "LENGTH_STYLES": "prompts",
+    "get_length_instruction": "prompts",
+    "get_system_prompt": "prompts",
+    "user_style_text": "prompts",
+    "FrameRequest": "sequential",
+    "describe_frame": "sequential",
+    "describe_frames_sequential": "sequential",
+    "frame_message": "sequential",
+    "FINAL_INSTRUCTION": "summarize",
+    "TimedText": "summarize",
+    "summarize_hierarchically": "summarize",
+    "cleanup_video": "videos",
+    "decode_base64_video": "videos",
+    "save_video_bytes": "videos",
+}
+
+__all__ = sorted(_EXPORTS)
+
+
+def __getattr__(name: str):
+    module_name = _EXPORTS.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f"{__name__}.{module_name}"), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS))
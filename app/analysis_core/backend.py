@@ -0,0 +1,251 @@
+"""
+Backend del modello, configurato una sola volta e condiviso da API e interfacce Streamlit.
+
+Tipi di backend:
+- "openai": API OpenAI (default);
+- "openai_compatible": server compatibile con l'API OpenAI (vLLM, LM Studio, Ollama, ...) raggiunto tramite base URL,
+  per spostare le analisi massive su hardware di inferenza locale;
+- "stub": modello finto in-process che risponde nel formato a tag atteso, senza rete (prove e sviluppo).
+
+Configurazione tramite variabili d'ambiente:
+- VIDEO_ANALYSIS_BACKEND: tipo di backend (default "openai")
+- VIDEO_ANALYSIS_MODEL: nome del modello (default "gpt-4o")
+- VIDEO_ANALYSIS_API_KEY (oppure OPENAI_API_KEY): chiave API
+- VIDEO_ANALYSIS_BASE_URL: URL del server per "openai_compatible" (es. http://gpu-server:8000/v1)
+- VIDEO_ANALYSIS_TEMPERATURE / VIDEO_ANALYSIS_MAX_TOKENS: parametri di generazione (default 0.25 / 2048)
+- VIDEO_ANALYSIS_BACKEND_CONCURRENCY: chiamate contemporanee massime verso il backend, per processo
+- VIDEO_ANALYSIS_BACKEND_TIMEOUT: timeout di una chiamata in secondi
+Concorrenza, timeout e limiti RPM/TPM hanno default diversi per ciascun backend (vedi BACKEND_DEFAULTS).
+Ogni chiamata passa dallo scheduler (analysis_core/scheduler.py) per limiti di frequenza e retry.
+"""
+import asyncio
+import json
+import os
+import re
+import threading
+from typing import TYPE_CHECKING, Callable, Optional
+
+from analysis_core.metrics import record_usage, time_stage
+from analysis_core.scheduler import RateLimitScheduler, create_scheduler
+
+if TYPE_CHECKING:
+    from langchain_core.messages import AIMessage
+
+BACKEND_TYPES = ("openai", "openai_compatible", "stub")
+
+# Default per backend: un server locale regge meno richieste contemporanee ma può essere più lento a rispondere
+BACKEND_DEFAULTS = {
+    "openai": {"concurrency": 8, "timeout": 120.0, "rpm": 500, "tpm": 0},
+    "openai_compatible": {"concurrency": 2, "timeout": 600.0, "rpm": 0, "tpm": 0},
+    "stub": {"concurrency": 64, "timeout": None, "rpm": 0, "tpm": 0},
+}
+
+DEFAULT_MODEL = "gpt-4o"
+DEFAULT_TEMPERATURE = 0.25
+DEFAULT_MAX_TOKENS = 2048
+
+
+class StubChatModel:
+    """
+    Modello finto: risponde con blocchi nel formato a tag usato dal progetto, senza chiamate di rete.
+    Descrive un frame per immagine ricevuta (con "indice_frame" se la richiesta lo prevede),
+    ripete un blocco per ogni "Descrizione frame N" nelle richieste di sola revisione del testo
+    e produce una descrizione finale quando viene richiesta.
+    """
+    model_name = "stub"
+
+    def _reply(self, messages) -> "AIMessage":
+        from langchain_core.messages import AIMessage
+
+        content = messages[-1].content
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content}]
+        text = " ".join(part.get("text", "") for part in parts if part.get("type") == "text")
+        num_images = sum(1 for part in parts if part.get("type") == "image_url")
+
+        if "descrizione finale" in text.lower():
+            reply = self._block("final_description", {"descrizione_finale": "Descrizione finale generata dal backend stub."})
+        elif "indice_frame" in text:
+            first = re.search(r"frame da (\d+) a (\d+)", text)
+            if num_images and first:
+                numbers = range(int(first.group(1)), int(first.group(1)) + num_images)
+            else:
+                numbers = [int(n) for n in re.findall(r"Descrizione frame (\d+):", text)]
+            reply = "".join(
+                self._block("frame_description", {"indice_frame": n, "descrizione_frame": f"Frame {n} descritto dal backend stub."})
+                for n in numbers
+            )
+        else:
+            reply = self._block("frame_description", {"descrizione_frame": "Frame descritto dal backend stub."})
+
+        return AIMessage(content=reply, usage_metadata={
+            "input_tokens": len(json.dumps([m.content for m in messages])) // 4,
+            "output_tokens": len(reply) // 4,
+            "total_tokens": len(json.dumps([m.content for m in messages])) // 4 + len(reply) // 4,
+        })
+
+    @staticmethod
+    def _block(attribute: str, payload: dict) -> str:
+        return f"<attribute={attribute}| {json.dumps(payload, ensure_ascii=False)} | attribute={attribute}>"
+
+    def invoke(self, messages, **kwargs) -> "AIMessage":
+        return self._reply(messages)
+
+    async def ainvoke(self, messages, **kwargs) -> "AIMessage":
+        return self._reply(messages)
+
+
+class _SlotWaiter:
+    """
+    Attesa di un posto del semaforo in un thread del pool, annullabile senza passare dall'event loop:
+    se la chiamata viene annullata, il posto ottenuto (prima o dopo l'annullamento) viene restituito
+    subito, anche se l'event loop della richiesta è già stato chiuso.
+    """
+
+    def __init__(self, slots: threading.BoundedSemaphore):
+        self._slots = slots
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._acquired = False
+
+    def wait(self) -> None:
+        self._slots.acquire()
+        with self._lock:
+            if self._cancelled:
+                self._slots.release()
+            else:
+                self._acquired = True
+
+    def cancel(self) -> None:
+        with self._lock:
+            self._cancelled = True
+            if self._acquired:
+                self._slots.release()
+
+
+class ModelBackend:
+    """
+    Involucro comune attorno al modello di chat: limita le chiamate contemporanee del processo
+    e si usa come il ChatOpenAI di prima (chiamabile, invoke, ainvoke, model_name).
+    Ogni chiamata passa dallo scheduler: il posto di concorrenza viene occupato solo durante il
+    tentativo, non durante le attese di backoff.
+    Il modello vero e proprio viene creato da `factory` alla prima chiamata, così che importare
+    un punto di ingresso non richieda la chiave API né il caricamento del client.
+    """
+
+    def __init__(self, kind: str, model_name: str, factory: Callable, concurrency: int, timeout: Optional[float],
+                 scheduler: Optional[RateLimitScheduler] = None):
+        self.kind = kind
+        self.scheduler = scheduler or RateLimitScheduler()
+        self.model_name = model_name
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._factory = factory
+        self._model = None
+        self._model_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(concurrency)
+
+    @property
+    def model(self):
+        with self._model_lock:
+            if self._model is None:
+                self._model = self._factory()
+            return self._model
+
+    def __call__(self, messages, **kwargs) -> "AIMessage":
+        return self.invoke(messages, **kwargs)
+
+    def invoke(self, messages, **kwargs) -> "AIMessage":
+        return self.scheduler.call(lambda: self._invoke_once(messages, **kwargs), messages)
+
+    async def ainvoke(self, messages, **kwargs) -> "AIMessage":
+        return await self.scheduler.acall(lambda: self._ainvoke_once(messages, **kwargs), messages)
+
+    def _invoke_once(self, messages, **kwargs) -> "AIMessage":
+        with self._slots:
+            with time_stage("model_call"):
+                response = self.model.invoke(messages, **kwargs)
+        record_usage(response)
+        return response
+
+    async def _ainvoke_once(self, messages, **kwargs) -> "AIMessage":
+        # Il semaforo è condiviso tra thread ed event loop diversi: l'attesa avviene in un thread del pool
+        if not self._slots.acquire(blocking=False):
+            waiter = _SlotWaiter(self._slots)
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, waiter.wait)
+            except asyncio.CancelledError:
+                # Il posto ottenuto in seguito viene restituito dal thread stesso: l'event loop della
+                # richiesta può essere chiuso subito dopo l'annullamento
+                waiter.cancel()
+                raise
+        try:
+            with time_stage("model_call"):
+                response = await self.model.ainvoke(messages, **kwargs)
+        finally:
+            self._slots.release()
+        record_usage(response)
+        return response
+
+
+def create_backend(kind: Optional[str] = None, model: Optional[str] = None, api_key: Optional[str] = None,
+                   base_url: Optional[str] = None, concurrency: Optional[int] = None,
+                   timeout: Optional[float] = None) -> ModelBackend:
+    """
+    Crea un backend; i parametri non indicati vengono letti dalle variabili d'ambiente.
+    """
+    kind = kind or os.getenv("VIDEO_ANALYSIS_BACKEND", "openai")
+    if kind not in BACKEND_TYPES:
+        raise ValueError(f"Backend non valido: {kind}. Valori ammessi: {BACKEND_TYPES}")
+    defaults = BACKEND_DEFAULTS[kind]
+    if concurrency is None:
+        concurrency = int(os.getenv("VIDEO_ANALYSIS_BACKEND_CONCURRENCY", str(defaults["concurrency"])))
+    if timeout is None and os.getenv("VIDEO_ANALYSIS_BACKEND_TIMEOUT"):
+        timeout = float(os.getenv("VIDEO_ANALYSIS_BACKEND_TIMEOUT"))
+    elif timeout is None:
+        timeout = defaults["timeout"]
+
+    max_tokens = int(os.getenv("VIDEO_ANALYSIS_MAX_TOKENS", str(DEFAULT_MAX_TOKENS)))
+    scheduler = create_scheduler(defaults["rpm"], defaults["tpm"], max_output_tokens=max_tokens)
+
+    if kind == "stub":
+        return ModelBackend(kind, StubChatModel.model_name, StubChatModel, max(1, concurrency), timeout, scheduler)
+
+    model = model or os.getenv("VIDEO_ANALYSIS_MODEL", DEFAULT_MODEL)
+    base_url = base_url or os.getenv("VIDEO_ANALYSIS_BASE_URL")
+    if kind == "openai_compatible" and not base_url:
+        raise ValueError("Il backend openai_compatible richiede VIDEO_ANALYSIS_BASE_URL.")
+    api_key = api_key or os.getenv("VIDEO_ANALYSIS_API_KEY") or os.getenv("OPENAI_API_KEY")
+    if kind == "openai_compatible" and not api_key:
+        # I server locali di solito non controllano la chiave, ma il client OpenAI ne richiede una
+        api_key = "not-needed"
+
+    def factory():
+        from langchain_openai import ChatOpenAI
+
+        return ChatOpenAI(
+            model=model,
+            temperature=float(os.getenv("VIDEO_ANALYSIS_TEMPERATURE", str(DEFAULT_TEMPERATURE))),
+            max_tokens=max_tokens,
+            openai_api_key=api_key,
+            base_url=base_url if kind == "openai_compatible" else None,
+            timeout=timeout,
+            # I retry sono gestiti dallo scheduler, che rispetta i limiti condivisi del processo
+            max_retries=0,
+        )
+
+    return ModelBackend(kind, model, factory, max(1, concurrency), timeout, scheduler)
+
+
+_chat_backend = None
+_chat_backend_lock = threading.Lock()
+
+
+def get_chat_backend() -> ModelBackend:
+    """
+    Restituisce il backend condiviso del processo, creandolo al primo utilizzo.
+    """
+    global _chat_backend
+    with _chat_backend_lock:
+        if _chat_backend is None:
+            _chat_backend = create_backend()
+        return _chat_backend
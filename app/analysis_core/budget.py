@@ -0,0 +1,109 @@
+"""
+Budget di token e di tempo di una singola analisi.
+
+Ogni analisi ha un AnalysisBudget che conta le chiamate al modello, i token dichiarati nelle risposte
+(stimati dal testo e dalle immagini della richiesta se il backend non li riporta) e il tempo trascorso.
+Con un limite impostato, check() va chiamato prima di ogni chiamata al modello: se il budget è esaurito
+solleva BudgetExceeded e la pipeline si ferma in modo ordinato, restituendo i risultati parziali.
+
+Durante la descrizione dei frame si riserva una parte del budget (reserve) alla descrizione finale,
+così che un'analisi interrotta abbia comunque un riassunto dei frame già descritti.
+Le risposte trovate in cache non consumano budget.
+"""
+import threading
+import time
+from typing import Optional
+
+from analysis_core.scheduler import estimate_request_tokens
+
+
+# Motivi di interruzione: budget di token, di tempo o limite di frame delle interfacce
+BUDGET_REASONS = {"tokens": "token", "time": "tempo", "frames": "frame"}
+
+
+class BudgetExceeded(Exception):
+    """
+    Budget dell'analisi esaurito; `reason` è una chiave di BUDGET_REASONS.
+    """
+
+    def __init__(self, reason: str):
+        super().__init__(f"Budget di {BUDGET_REASONS[reason]} esaurito")
+        self.reason = reason
+
+
+class AnalysisBudget:
+    """
+    Limiti (None = nessun limite) e consumo di una singola analisi. Thread-safe.
+    """
+
+    def __init__(self, max_tokens: Optional[int] = None, max_seconds: Optional[float] = None):
+        self.max_tokens = max_tokens
+        self.max_seconds = max_seconds
+        self.started = time.monotonic()
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.call_seconds = 0.0
+        self.reserved_tokens = 0
+        self.reserved_calls = 0
+        self._lock = threading.Lock()
+
+    @property
+    def tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def reserve(self, tokens: int, calls: int) -> None:
+        """
+        Riserva token e chiamate (la cui durata è stimata dalla media delle chiamate già fatte) per le fasi
+        successive: check() li considera già spesi. reserve(0, 0) libera la riserva.
+        """
+        with self._lock:
+            self.reserved_tokens = tokens
+            self.reserved_calls = calls
+
+    def exhausted(self) -> Optional[str]:
+        with self._lock:
+            if self.max_tokens is not None and self.tokens + self.reserved_tokens >= self.max_tokens:
+                return "tokens"
+            average_call = self.call_seconds / self.calls if self.calls else 0.0
+            reserved_seconds = average_call * self.reserved_calls
+        if self.max_seconds is not None and self.elapsed() + reserved_seconds >= self.max_seconds:
+            return "time"
+        return None
+
+    def check(self) -> None:
+        reason = self.exhausted()
+        if reason is not None:
+            raise BudgetExceeded(reason)
+
+    def record(self, messages, response, seconds: float) -> None:
+        """
+        Registra una chiamata conclusa: token dichiarati dal modello o, in mancanza, stimati.
+        """
+        usage = getattr(response, "usage_metadata", None) or {}
+        prompt_tokens = usage.get("input_tokens")
+        completion_tokens = usage.get("output_tokens")
+        if prompt_tokens is None:
+            prompt_tokens = estimate_request_tokens(messages)
+        if completion_tokens is None:
+            completion_tokens = len(str(getattr(response, "content", ""))) // 4
+        with self._lock:
+            self.calls += 1
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.call_seconds += seconds
+
+    def usage(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "tokens": self.tokens,
+                "seconds": round(self.elapsed(), 3),
+                "max_tokens": self.max_tokens,
+                "max_seconds": self.max_seconds,
+            }
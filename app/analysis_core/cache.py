@@ -0,0 +1,194 @@
+"""
+Cache su disco delle risposte del modello per i singoli frame.
+
+La chiave è un hash del contenuto: byte dell'immagine codificata (data URL), prompt, stile e modello.
+Rianalizzare lo stesso video (o la stessa cartella FlightHub) non ripaga quindi le chiamate già fatte.
+Nelle analisi con storia la risposta dipende anche dai turni precedenti della conversazione: le chiavi
+di quei turni includono un contesto (conversation_context), così che lo stesso frame in un'altra
+conversazione non riceva la descrizione salvata per la prima. cached_call calcola invece la chiave
+sull'intera lista di messaggi inviata.
+Le voci sono salvate in un database SQLite condiviso tra API e interfacce Streamlit, con scadenza
+(TTL) ed eliminazione delle voci usate meno di recente quando si supera la dimensione massima.
+
+Configurazione tramite variabili d'ambiente:
+- VIDEO_ANALYSIS_CACHE_PATH: percorso del database (default ~/.cache/video-analysis-agent/frame_cache.sqlite)
+- VIDEO_ANALYSIS_CACHE_MAX_MB: dimensione massima delle risposte salvate (default 256)
+- VIDEO_ANALYSIS_CACHE_TTL_SECONDS: durata di una voce (default 7 giorni)
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Iterable, List, Optional
+
+from analysis_core.metrics import CACHE_LOOKUPS
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "video-analysis-agent", "frame_cache.sqlite")
+DEFAULT_MAX_MB = 256
+DEFAULT_TTL_SECONDS = 7 * 24 * 3600
+
+
+def make_cache_key(images: Iterable[str], prompt: str, style: str, model: str, context: Iterable[str] = ()) -> str:
+    """
+    Chiave della cache: sha256 delle immagini (in ordine), del prompt, dello stile, del modello e del
+    contesto della conversazione. Senza contesto (chiamate indipendenti) le chiavi restano quelle di prima.
+    """
+    digest = hashlib.sha256()
+    for part in (prompt, style, model):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\x00")
+    for image in images:
+        digest.update(hashlib.sha256(image.encode("utf-8")).digest())
+    for part in context:
+        digest.update(b"\x01")
+        digest.update(hashlib.sha256(part.encode("utf-8")).digest())
+    return digest.hexdigest()
+
+
+def conversation_context(previous_key: Optional[str], previous_response: Optional[str], *parts: str) -> List[str]:
+    """
+    Contesto della chiave di un turno di conversazione: chiave e risposta del turno precedente (la chiave
+    dipende a sua volta dai turni prima) più gli altri testi che cambiano la richiesta, come i parametri
+    della storia e le descrizioni precedenti allegate. Vuoto per il primo turno, che non ha storia.
+    """
+    if previous_key is None:
+        return []
+    return [previous_key, previous_response or ""] + list(parts)
+
+
+def messages_cache_key(messages: list, model: str) -> str:
+    """
+    Chiave della cache calcolata sull'intera lista di messaggi (tipo, testi e immagini in ordine).
+    """
+    images, texts = [], []
+    for message in messages:
+        texts.append(message.type)
+        content = message.content
+        if isinstance(content, str):
+            texts.append(content)
+            continue
+        for part in content:
+            if part.get("type") == "image_url":
+                images.append(part["image_url"]["url"])
+                texts.append("<image>")
+            else:
+                texts.append(part.get("text", ""))
+    return make_cache_key(images, "", "messages", model, texts)
+
+
+def cached_call(call: Callable[[list], str], model: str) -> Callable[[list], str]:
+    """
+    Avvolge una chiamata messaggi -> testo della risposta con la cache condivisa, usando come chiave
+    l'intera richiesta: adatta alle interfacce che inviano ogni volta tutta la conversazione.
+    """
+    def wrapped(messages: list) -> str:
+        cache = get_response_cache()
+        key = messages_cache_key(messages, model)
+        response = cache.get(key)
+        if response is None:
+            response = call(messages)
+            cache.set(key, response)
+        return response
+    return wrapped
+
+
+class ResponseCache:
+    """
+    Cache chiave -> risposta del modello, con TTL e limite di dimensione (eliminazione LRU).
+    Thread-safe; più processi possono condividere lo stesso file.
+    """
+
+    def __init__(self, path: str, max_bytes: int, ttl_seconds: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses (last_access)")
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                self.misses += 1
+                CACHE_LOOKUPS.labels(result="miss").inc()
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            CACHE_LOOKUPS.labels(result="hit").inc()
+            return row[0]
+
+    def set(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value.encode("utf-8")), now, now),
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now: float) -> None:
+        # Da chiamare con il lock acquisito: prima le voci scadute, poi le meno usate di recente
+        self._conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        while total > self.max_bytes:
+            rows = self._conn.execute("SELECT key, size FROM responses ORDER BY last_access LIMIT 100").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "size_bytes": size,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl_seconds,
+        }
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    """
+    Restituisce la cache condivisa del processo, creandola al primo utilizzo.
+    """
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache(
+                path=os.getenv("VIDEO_ANALYSIS_CACHE_PATH", DEFAULT_CACHE_PATH),
+                max_bytes=int(float(os.getenv("VIDEO_ANALYSIS_CACHE_MAX_MB", str(DEFAULT_MAX_MB))) * 1024 * 1024),
+                ttl_seconds=int(os.getenv("VIDEO_ANALYSIS_CACHE_TTL_SECONDS", str(DEFAULT_TTL_SECONDS))),
+            )
+        return _response_cache
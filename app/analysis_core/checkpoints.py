@@ -0,0 +1,170 @@
+"""
+Checkpoint delle analisi video, per riprendere un'analisi interrotta dall'ultimo frame completato.
+
+Ogni analisi è identificata da una chiave: hash del contenuto del video, parametri che influenzano
+il risultato, prompt e modello. Dopo ogni chiamata riuscita vengono salvati gli eventi dei frame
+descritti e la risposta grezza del modello, da cui si ricostruisce la conversazione. Se il modello
+fallisce al frame 40 di 60, la nuova richiesta (o il job rilanciato dopo un riavvio) con lo stesso
+video e gli stessi parametri riparte dal frame 40 senza ripagare i primi 39. Il checkpoint viene
+eliminato quando l'analisi si conclude con la descrizione finale.
+
+Configurazione tramite variabili d'ambiente:
+- VIDEO_ANALYSIS_CHECKPOINT_PATH: percorso del database (default ~/.cache/video-analysis-agent/checkpoints.sqlite)
+- VIDEO_ANALYSIS_CHECKPOINT_TTL_SECONDS: durata di un checkpoint non concluso (default 2 giorni)
+"""
+import hashlib
+import json
+import mmap
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+DEFAULT_CHECKPOINT_PATH = os.path.join(os.path.expanduser("~"), ".cache", "video-analysis-agent", "checkpoints.sqlite")
+DEFAULT_TTL_SECONDS = 2 * 24 * 3600
+# Hash dei file già calcolati, per percorso, dimensione e data di modifica: i video letti in place
+# dalle cartelle condivise non vengono riletti a ogni analisi
+HASH_MEMO_SIZE = 256
+_hash_memo = OrderedDict()
+_hash_memo_lock = threading.Lock()
+
+
+def file_sha256(path: str) -> str:
+    """
+    sha256 del contenuto di un file. Il file è mappato in memoria e passato a hashlib senza
+    copie in buffer intermedi; il risultato resta memorizzato finché il file non cambia.
+    """
+    stat = os.stat(path)
+    memo_key = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+    with _hash_memo_lock:
+        if memo_key in _hash_memo:
+            _hash_memo.move_to_end(memo_key)
+            return _hash_memo[memo_key]
+    digest = hashlib.sha256()
+    # mmap non accetta file vuoti
+    if stat.st_size:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            digest.update(mapped)
+    video_hash = digest.hexdigest()
+    with _hash_memo_lock:
+        _hash_memo[memo_key] = video_hash
+        while len(_hash_memo) > HASH_MEMO_SIZE:
+            _hash_memo.popitem(last=False)
+    return video_hash
+
+
+def make_checkpoint_key(video_hash: str, params: dict, prompt: str, model: str) -> str:
+    """
+    Chiave del checkpoint: hash del video, dei parametri (serializzati in modo stabile), del prompt e del modello.
+    """
+    digest = hashlib.sha256()
+    for part in (video_hash, json.dumps(params, sort_keys=True, default=str), prompt, model):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+class CheckpointStore:
+    """
+    Passi completati di ciascuna analisi: per ogni chiamata (indice del primo frame) gli eventi
+    dei frame prodotti e la risposta del modello. Thread-safe; più processi possono condividere il file.
+    """
+
+    def __init__(self, path: str, ttl_seconds: int):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS steps ("
+            " run_key TEXT NOT NULL, step INTEGER NOT NULL, events TEXT NOT NULL, reply TEXT NOT NULL,"
+            " created_at REAL NOT NULL, PRIMARY KEY (run_key, step))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_steps_created_at ON steps (created_at)")
+        self._conn.commit()
+
+    def load(self, run_key: str) -> Dict[int, Tuple[List[dict], str]]:
+        """
+        Passi già completati dell'analisi: {indice del primo frame: (eventi, risposta del modello)}.
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM steps WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+            self._conn.commit()
+            rows = self._conn.execute("SELECT step, events, reply FROM steps WHERE run_key = ?", (run_key,)).fetchall()
+        return {step: (json.loads(events), reply) for step, events, reply in rows}
+
+    def save_step(self, run_key: str, step: int, events: List[dict], reply: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO steps (run_key, step, events, reply, created_at) VALUES (?, ?, ?, ?, ?)",
+                (run_key, step, json.dumps(events, ensure_ascii=False), reply, time.time()),
+            )
+            self._conn.commit()
+
+    def delete(self, run_key: str) -> None:
+        # Insieme all'analisi si eliminano i checkpoint dei suoi segmenti ("<run_key>:<segmento>")
+        with self._lock:
+            self._conn.execute("DELETE FROM steps WHERE run_key = ? OR run_key LIKE ?", (run_key, run_key + ":%"))
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            runs, steps = self._conn.execute("SELECT COUNT(DISTINCT run_key), COUNT(*) FROM steps").fetchone()
+        return {"runs": runs, "steps": steps, "ttl_seconds": self.ttl_seconds}
+
+
+class RunCheckpoint:
+    """
+    Checkpoint di una singola analisi: passi già completati (caricati all'avvio) e salvataggio dei nuovi.
+    Con store None non salva nulla (ripresa disattivata).
+    """
+
+    def __init__(self, store: Optional[CheckpointStore], run_key: Optional[str]):
+        self.store = store
+        self.run_key = run_key
+        self.steps = store.load(run_key) if store is not None else {}
+
+    @property
+    def resumed_frames(self) -> int:
+        return sum(len(events) for events, _ in self.steps.values())
+
+    def get(self, step: int) -> Optional[Tuple[List[dict], str]]:
+        return self.steps.get(step)
+
+    def save(self, step: int, events: List[dict], reply: str) -> None:
+        if self.store is not None:
+            self.store.save_step(self.run_key, step, events, reply)
+
+    def segment(self, segment: int) -> "RunCheckpoint":
+        """
+        Checkpoint di un segmento del video analizzato come conversazione indipendente (modalità "segments").
+        """
+        if self.store is None:
+            return RunCheckpoint(None, None)
+        return RunCheckpoint(self.store, f"{self.run_key}:{segment}")
+
+    def complete(self) -> None:
+        if self.store is not None:
+            self.store.delete(self.run_key)
+
+
+_checkpoint_store = None
+_checkpoint_store_lock = threading.Lock()
+
+
+def get_checkpoint_store() -> CheckpointStore:
+    """
+    Restituisce l'archivio dei checkpoint condiviso del processo, creandolo al primo utilizzo.
+    """
+    global _checkpoint_store
+    with _checkpoint_store_lock:
+        if _checkpoint_store is None:
+            _checkpoint_store = CheckpointStore(
+                path=os.getenv("VIDEO_ANALYSIS_CHECKPOINT_PATH", DEFAULT_CHECKPOINT_PATH),
+                ttl_seconds=int(os.getenv("VIDEO_ANALYSIS_CHECKPOINT_TTL_SECONDS", str(DEFAULT_TTL_SECONDS))),
+            )
+        return _checkpoint_store
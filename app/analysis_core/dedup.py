@@ -0,0 +1,83 @@
+"""
+Soppressione dei frame quasi identici prima delle chiamate al modello.
+
+Le riprese del drone in hovering sopra un perimetro producono lunghe sequenze di frame praticamente
+uguali: per ciascun frame si calcola un dHash a 64 bit sull'immagine già ridimensionata e i frame
+la cui distanza di Hamming dall'ultimo frame mantenuto è inferiore alla soglia non vengono inviati.
+
+Il dHash confronta solo pixel adiacenti in scala di grigi, quindi non vede luminosità e colore: due
+frame a tinta unita blu e verde hanno lo stesso hash. Per questo si confronta anche il colore medio
+di una griglia 4x4 (color_signature): un frame con un cambio di colore o di luminosità oltre
+DEFAULT_COLOR_THRESHOLD non è mai considerato un duplicato.
+"""
+from typing import List, Tuple
+
+from analysis_core.lazy import lazy_import
+
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+
+# Soglia consigliata (su 64 bit) per considerare due frame quasi identici
+DEFAULT_DEDUP_THRESHOLD = 5
+# Differenza massima (0-255) del colore medio di una cella della griglia tra due frame quasi identici
+DEFAULT_COLOR_THRESHOLD = 24
+COLOR_GRID = 4
+
+
+def dhash(image: "np.ndarray", hash_size: int = 8) -> int:
+    """
+    Difference hash: confronta i pixel adiacenti di una versione in scala di grigi (hash_size+1) x hash_size.
+    """
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(image, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits.flatten()).tobytes(), "big")
+
+
+def color_signature(image: "np.ndarray", grid: int = COLOR_GRID) -> bytes:
+    """
+    Colore medio (BGR) di ciascuna cella di una griglia grid x grid: conserva la componente continua
+    (luminosità e colore) che il dHash scarta.
+    """
+    small = cv2.resize(image, (grid, grid), interpolation=cv2.INTER_AREA)
+    return small.astype(np.uint8).tobytes()
+
+
+def hamming_distance(hash_a: int, hash_b: int) -> int:
+    return bin(hash_a ^ hash_b).count("1")
+
+
+def color_distance(signature_a: bytes, signature_b: bytes) -> int:
+    """
+    Massima differenza tra i colori medi delle celle corrispondenti (0 se una delle firme manca).
+    """
+    if not signature_a or len(signature_a) != len(signature_b):
+        return 0
+    return max(abs(a - b) for a, b in zip(signature_a, signature_b))
+
+
+def suppress_near_duplicates(frames: list, threshold: int,
+                             color_threshold: int = DEFAULT_COLOR_THRESHOLD) -> Tuple[list, List[dict]]:
+    """
+    Divide i frame (oggetti con attributi index, timestamp, dhash e color) in mantenuti e scartati.
+    Un frame viene scartato se la distanza di Hamming dall'ultimo frame mantenuto è minore di `threshold`
+    e il colore medio di nessuna cella della griglia differisce di più di `color_threshold`.
+    Per ogni frame scartato si restituisce indice, timestamp e posizione (nella lista dei mantenuti)
+    del frame di cui è un duplicato, così che la sua descrizione possa essere riutilizzata.
+    """
+    kept = []
+    dropped = []
+    for frame in frames:
+        if kept:
+            distance = hamming_distance(frame.dhash, kept[-1].dhash)
+            if distance < threshold and color_distance(frame.color, kept[-1].color) <= color_threshold:
+                dropped.append({
+                    "frame_index": frame.index,
+                    "timestamp": frame.timestamp,
+                    "duplicate_of": len(kept) - 1,
+                    "distance": distance,
+                })
+                continue
+        kept.append(frame)
+    return kept, dropped
@@ -0,0 +1,97 @@
+"""
+Estrazione dei frame di più video in parallelo, su un pool di processi.
+
+Decodifica, ridimensionamento e codifica JPEG di un video occupano un solo core: con una cartella
+di volo da 30 file analizzata in sequenza gli altri core restano inattivi. Il pool estrae i video
+successivi mentre il modello descrive quelli già pronti, e restituisce i risultati nell'ordine dei
+video (al massimo `lookahead` video estratti in anticipo, per limitare la memoria occupata).
+
+I processi sono avviati con il metodo "spawn": il processo principale (Streamlit, uvicorn) ha già
+dei thread attivi e un fork potrebbe ereditarne i lock. Le metriche registrate nei processi del pool
+(durata di extract_frames ed encode_jpeg) restano nei processi figli.
+
+Configurazione tramite variabili d'ambiente:
+- VIDEO_ANALYSIS_EXTRACTION_WORKERS: processi del pool (default: core disponibili)
+"""
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+
+from analysis_core.checkpoints import file_sha256
+from analysis_core.frames import ExtractedFrame, extract_frames
+
+
+def available_cores() -> int:
+    """
+    Core utilizzabili dal processo (tiene conto dell'affinità impostata da container o taskset).
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return max(1, len(os.sched_getaffinity(0)))
+    return max(1, os.cpu_count() or 1)
+
+
+def extraction_workers() -> int:
+    return max(1, int(os.getenv("VIDEO_ANALYSIS_EXTRACTION_WORKERS", str(available_cores()))))
+
+
+def _extract_video(video_path: str, options: dict) -> Tuple[str, List[ExtractedFrame]]:
+    # Eseguita nei processi del pool: restituisce anche l'hash del video, usato per i checkpoint
+    return file_sha256(video_path), extract_frames(video_path, **options)
+
+
+_extraction_pool = None
+_extraction_pool_lock = threading.Lock()
+
+
+def get_extraction_pool() -> ProcessPoolExecutor:
+    """
+    Restituisce il pool di processi condiviso, creandolo al primo utilizzo.
+    """
+    global _extraction_pool
+    with _extraction_pool_lock:
+        if _extraction_pool is None:
+            _extraction_pool = ProcessPoolExecutor(
+                max_workers=extraction_workers(),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _extraction_pool
+
+
+def extract_videos_in_order(video_paths: Iterable[str], options: dict, lookahead: Optional[int] = None,
+                            pool: Optional[ProcessPoolExecutor] = None
+                            ) -> Iterator[Tuple[str, Union[Tuple[str, List[ExtractedFrame]], Exception]]]:
+    """
+    Estrae i frame dei video sul pool di processi e produce (percorso, (hash del video, frame)) nell'ordine
+    dei video. Se l'estrazione di un video fallisce si produce (percorso, eccezione) e si prosegue con i successivi.
+    `options` sono gli argomenti di extract_frames (escluso il percorso).
+    """
+    pool = pool or get_extraction_pool()
+    if lookahead is None:
+        lookahead = extraction_workers() * 2
+    paths = iter(video_paths)
+    pending = deque()
+
+    def submit_next() -> bool:
+        path = next(paths, None)
+        if path is None:
+            return False
+        pending.append((path, pool.submit(_extract_video, path, options)))
+        return True
+
+    while len(pending) < max(1, lookahead) and submit_next():
+        pass
+    try:
+        while pending:
+            path, future = pending.popleft()
+            submit_next()
+            try:
+                yield path, future.result()
+            except Exception as e:
+                yield path, e
+    finally:
+        # Generatore chiuso in anticipo: le estrazioni non ancora avviate vengono annullate
+        for _, future in pending:
+            future.cancel()
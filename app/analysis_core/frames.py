@@ -0,0 +1,430 @@
+"""
+Estrazione dei frame da un video, condivisa tra API e interfacce Streamlit.
+
+Modalità di campionamento:
+- "uniform": num_frames frame equidistanti oppure un frame ogni fps/frame_rate (comportamento storico);
+- "scene": keyframe nei punti in cui il contenuto cambia, individuati con una passata di decodifica
+  a bassa risoluzione, entro un budget minimo/massimo di frame.
+
+Lettura dei frame scelti:
+- "sequential": decodifica in avanti con grab()/retrieve(), converte solo i frame richiesti;
+- "seek": posizionamento con CAP_PROP_POS_FRAMES prima di ogni lettura (ogni seek riparte dal keyframe precedente);
+- "auto": sequenziale se i frame richiesti sono fitti, seek se sono radi.
+
+Backend di estrazione:
+- "opencv": decodifica con cv2.VideoCapture a piena risoluzione, poi cv2.resize (default);
+- "ffmpeg": processo ffmpeg con filtri select e scale, che scarta i frame non richiesti e ridimensiona
+  dentro la pipeline di decodifica; i frame arrivano già ridotti (rawvideo BGR) da una pipe.
+  Conviene con sorgenti ad alta risoluzione (4K da drone). Richiede l'eseguibile ffmpeg
+  (VIDEO_ANALYSIS_FFMPEG_PATH, default "ffmpeg"); i thread di decodifica si impostano con
+  VIDEO_ANALYSIS_FFMPEG_THREADS (default 0, scelta automatica di ffmpeg).
+
+I frame restano in memoria: l'immagine ridimensionata e il relativo JPEG codificato con cv2.imencode,
+da cui si costruisce direttamente il data URL inviato al modello (nessun file temporaneo).
+"""
+import base64
+import os
+import subprocess
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Tuple
+
+from analysis_core.dedup import color_signature, dhash
+from analysis_core.image_tokens import plan_frame_size
+from analysis_core.lazy import lazy_import
+from analysis_core.metrics import time_stage
+
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+
+
+SAMPLING_MODES = ("uniform", "scene")
+
+# Parametri della passata di analisi per il campionamento "scene"
+SCENE_ANALYSIS_FPS = 4.0
+SCENE_ANALYSIS_SIZE = (64, 36)
+# Punteggio minimo (0-1) perché una variazione sia considerata un cambio di scena
+SCENE_MIN_SCORE = 0.08
+DEFAULT_MIN_FRAMES = 3
+DEFAULT_MAX_FRAMES = 30
+
+READ_STRATEGIES = ("auto", "sequential", "seek")
+# Distanza media (in frame) tra i frame richiesti oltre la quale conviene il seek: fino a questa soglia
+# decodificare in avanti costa meno che ripartire ogni volta dal keyframe precedente. Misurata con
+# benchmarks/bench_frame_extraction.py: le due strategie si equivalgono attorno a 20 frame, a 30 il seek
+# è già più veloce (51 contro 39 frame/s a 640x360, 12,7 contro 9,6 a 1280x720)
+SEEK_MIN_GAP = 20
+
+EXTRACTION_BACKENDS = ("opencv", "ffmpeg")
+DEFAULT_FFMPEG_THREADS = 0
+
+
+@dataclass
+class ExtractedFrame:
+    """
+    Frame estratto e ridimensionato.
+    `index` è l'indice del frame nel video, `timestamp` il tempo in secondi dall'inizio,
+    `jpeg` la codifica JPEG del frame ridimensionato e `width`/`height` le sue dimensioni,
+    `dhash` l'hash percettivo a 64 bit usato per riconoscere i frame quasi identici,
+    `color` il colore medio di una griglia 4x4 che distingue i frame con la stessa struttura ma colori diversi.
+    L'immagine decodificata non viene conservata: hash, colore e JPEG si calcolano in estrazione,
+    così in memoria (e tra i processi di estrazione) resta solo il JPEG.
+    """
+    index: int
+    timestamp: float
+    jpeg: bytes
+    width: int
+    height: int
+    dhash: int
+    color: bytes = b""
+
+    @property
+    def data_url(self) -> str:
+        return jpeg_data_url(self.jpeg)
+
+
+def encode_jpeg(image: "np.ndarray") -> bytes:
+    with time_stage("encode_jpeg"):
+        ok, buffer = cv2.imencode(".jpg", image)
+    if not ok:
+        raise ValueError("Impossibile codificare il frame in JPEG.")
+    return buffer.tobytes()
+
+
+def jpeg_data_url(jpeg: bytes) -> str:
+    return "data:image/jpeg;base64," + base64.b64encode(jpeg).decode("utf-8")
+
+
+def image_file_data_url(image_path: str) -> str:
+    """
+    Data URL di un'immagine già salvata su disco (JPEG o PNG), senza decodificarla.
+    """
+    mime = "image/png" if image_path.lower().endswith(".png") else "image/jpeg"
+    with open(image_path, "rb") as f:
+        return f"data:{mime};base64," + base64.b64encode(f.read()).decode("utf-8")
+
+
+def resize_image(image_data: bytes, width: int, height: int) -> bytes:
+    """
+    Decodifica un'immagine caricata (JPEG, PNG, ...), la ridimensiona a width x height e la ricodifica in JPEG.
+    """
+    image = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Impossibile decodificare l'immagine.")
+    return encode_jpeg(cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA))
+
+
+def format_timestamp(seconds: float) -> str:
+    hh = int(seconds // 3600)
+    mm = int((seconds % 3600) // 60)
+    ss = int(seconds % 60)
+    return f"{hh:02d}:{mm:02d}:{ss:02d}"
+
+
+def format_minutes_seconds(seconds: float) -> str:
+    # Formato mm:ss delle interfacce ui_.py e ui___.py (i minuti non si azzerano dopo un'ora)
+    minutes, secs = divmod(int(seconds), 60)
+    return f"{minutes:02d}:{secs:02d}"
+
+
+def _scene_samples_opencv(cap, step: int, size: tuple) -> tuple:
+    indices = []
+    samples = []
+    idx = 0
+    while True:
+        # grab() avanza senza convertire il frame: solo i campioni vengono recuperati e ridotti
+        if not cap.grab():
+            break
+        if idx % step == 0:
+            ret, frame = cap.retrieve()
+            if not ret:
+                break
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            samples.append(cv2.resize(gray, size, interpolation=cv2.INTER_AREA))
+            indices.append(idx)
+        idx += 1
+    return indices, samples
+
+
+def scene_change_scores(video_path: str, analysis_fps: float = SCENE_ANALYSIS_FPS,
+                        size: tuple = SCENE_ANALYSIS_SIZE, backend: str = "opencv") -> tuple:
+    """
+    Passata di decodifica a bassa risoluzione: campiona il video a `analysis_fps` frame al secondo,
+    riduce ogni frame a `size` in scala di grigi e calcola per ogni campione un punteggio (0-1)
+    di variazione rispetto al campione precedente, media della differenza assoluta dei pixel e
+    della distanza tra istogrammi. Restituisce (indici dei frame campionati, punteggi).
+    """
+    cap = cv2.VideoCapture(video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    step = max(1, int(round(fps / analysis_fps))) if fps > 0 else 1
+    if backend == "ffmpeg":
+        cap.release()
+        # Campionamento e riduzione avvengono dentro ffmpeg: in Python arrivano solo i campioni in grigio
+        samples = list(_ffmpeg_frames(video_path, f"not(mod(n\\,{step}))", size[0], size[1], pix_fmt="gray"))
+        indices = [k * step for k in range(len(samples))]
+    else:
+        indices, samples = _scene_samples_opencv(cap, step, size)
+        cap.release()
+
+    if not samples:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+
+    stack = np.stack(samples)
+    n = stack.shape[0]
+    pixel_diff = np.abs(np.diff(stack.astype(np.int16), axis=0)).mean(axis=(1, 2)) / 255.0
+
+    # Istogrammi a 16 livelli di tutti i campioni in un'unica bincount
+    bins = (stack >> 4).reshape(n, -1).astype(np.int64) + (np.arange(n, dtype=np.int64) * 16)[:, None]
+    hist = np.bincount(bins.ravel(), minlength=n * 16).reshape(n, 16) / float(stack[0].size)
+    hist_diff = np.abs(np.diff(hist, axis=0)).sum(axis=1) / 2.0
+
+    scores = np.concatenate([[1.0], 0.5 * pixel_diff + 0.5 * hist_diff]).astype(np.float32)
+    return np.asarray(indices, dtype=np.int64), scores
+
+
+def select_scene_keyframes(sample_indices: "np.ndarray", scores: "np.ndarray",
+                           min_frames: int, max_frames: int) -> List[int]:
+    """
+    Sceglie i keyframe: il primo campione e quelli il cui punteggio supera una soglia adattiva
+    (mediana + 6 deviazioni assolute mediane, almeno SCENE_MIN_SCORE), robusta anche quando i cambi
+    di scena sono frequenti. Se sono troppi si tengono i cambi più forti; se sono troppo pochi si
+    aggiungono campioni equidistanti.
+    """
+    n = len(sample_indices)
+    if n == 0:
+        return []
+    max_frames = max(1, min(max_frames, n))
+    min_frames = max(1, min(min_frames, max_frames))
+
+    changes = scores[1:]
+    threshold = SCENE_MIN_SCORE
+    if len(changes):
+        median = float(np.median(changes))
+        mad = float(np.median(np.abs(changes - median)))
+        threshold = max(threshold, median + 6 * mad)
+    selected = [0] + [int(k) for k in np.nonzero(scores >= threshold)[0] if k > 0]
+
+    if len(selected) > max_frames:
+        strongest = sorted(selected[1:], key=lambda k: scores[k], reverse=True)[:max_frames - 1]
+        selected = [0] + strongest
+    if len(selected) < min_frames:
+        for k in np.linspace(0, n - 1, min_frames).astype(int):
+            if len(selected) >= min_frames:
+                break
+            if int(k) not in selected:
+                selected.append(int(k))
+
+    return [int(sample_indices[k]) for k in sorted(set(selected))]
+
+
+def choose_read_strategy(frame_indices: List[int], strategy: str = "auto") -> str:
+    """
+    Risolve la strategia "auto" in base alla densità del campionamento.
+    """
+    if strategy not in READ_STRATEGIES:
+        raise ValueError(f"Strategia di lettura non valida: {strategy}. Valori ammessi: {READ_STRATEGIES}")
+    if strategy != "auto":
+        return strategy
+    if len(frame_indices) < 2:
+        return "seek"
+    mean_gap = (frame_indices[-1] - frame_indices[0]) / (len(frame_indices) - 1)
+    return "sequential" if mean_gap <= SEEK_MIN_GAP else "seek"
+
+
+def _read_frames_seek(cap, frame_indices: List[int]) -> Iterator[Tuple[int, "np.ndarray"]]:
+    for idx in frame_indices:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
+        ret, frame = cap.read()
+        if not ret:
+            print(f"Impossibile leggere il frame all'indice {idx}. Stop.")
+            return
+        yield idx, frame
+
+
+def _read_frames_sequential(cap, frame_indices: List[int]) -> Iterator[Tuple[int, "np.ndarray"]]:
+    position = 0
+    last_idx, last_frame = None, None
+    for idx in sorted(frame_indices):
+        if idx == last_idx:
+            yield idx, last_frame
+            continue
+        # I frame intermedi vengono solo decodificati (grab), senza conversione in BGR
+        while position < idx:
+            if not cap.grab():
+                print(f"Impossibile leggere il frame all'indice {idx}. Stop.")
+                return
+            position += 1
+        ret, frame = cap.read()
+        if not ret:
+            print(f"Impossibile leggere il frame all'indice {idx}. Stop.")
+            return
+        position += 1
+        last_idx, last_frame = idx, frame
+        yield idx, frame
+
+
+def _ffmpeg_select_expression(frame_indices: List[int]) -> str:
+    """
+    Espressione del filtro select che lascia passare solo i frame richiesti (indici distinti e ordinati).
+    Gli indici a passo costante, il caso di num_frames e frame_rate, diventano una sola condizione modulo.
+    """
+    first, last = frame_indices[0], frame_indices[-1]
+    if len(frame_indices) == 1:
+        return f"eq(n\\,{first})"
+    step = frame_indices[1] - first
+    if all(b - a == step for a, b in zip(frame_indices, frame_indices[1:])):
+        return f"between(n\\,{first}\\,{last})*not(mod(n-{first}\\,{step}))"
+    return "+".join(f"eq(n\\,{idx})" for idx in frame_indices)
+
+
+def _ffmpeg_frames(video_path: str, select: str, width: int, height: int, max_frames: Optional[int] = None,
+                   pix_fmt: str = "bgr24", threads: Optional[int] = None) -> Iterator["np.ndarray"]:
+    """
+    Avvia ffmpeg con i filtri select e scale e legge i frame rawvideo dalla pipe, uno alla volta.
+    Con max_frames ffmpeg si ferma dopo l'ultimo frame utile invece di decodificare il video fino alla fine.
+    """
+    if threads is None:
+        threads = int(os.getenv("VIDEO_ANALYSIS_FFMPEG_THREADS", str(DEFAULT_FFMPEG_THREADS)))
+    channels = 1 if pix_fmt == "gray" else 3
+    frame_size = width * height * channels
+    command = [
+        os.getenv("VIDEO_ANALYSIS_FFMPEG_PATH", "ffmpeg"), "-hide_banner", "-loglevel", "error", "-nostdin",
+        "-threads", str(threads), "-i", video_path, "-an", "-sn",
+        "-vf", f"select={select},scale={width}:{height}:flags=area",
+        "-vsync", "0", "-f", "rawvideo", "-pix_fmt", pix_fmt, "pipe:1",
+    ]
+    if max_frames is not None:
+        command[-7:-7] = ["-frames:v", str(max_frames)]
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=frame_size)
+    except FileNotFoundError:
+        raise ValueError("Backend di estrazione ffmpeg non disponibile: eseguibile ffmpeg non trovato.")
+    try:
+        while True:
+            buffer = process.stdout.read(frame_size)
+            if len(buffer) < frame_size:
+                break
+            frame = np.frombuffer(buffer, dtype=np.uint8)
+            yield frame.reshape((height, width, channels)) if channels > 1 else frame.reshape((height, width))
+        process.wait()
+        if process.returncode != 0:
+            error = process.stderr.read().decode("utf-8", errors="replace").strip()
+            raise ValueError(f"Errore di ffmpeg durante l'estrazione dei frame: {error}")
+    finally:
+        # Interruzione anticipata (errore o generatore chiuso): il processo non deve restare attivo
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+
+def _read_frames_ffmpeg(video_path: str, frame_indices: List[int], width: int, height: int,
+                        threads: Optional[int] = None) -> Iterator[Tuple[int, "np.ndarray"]]:
+    """
+    Legge i frame richiesti già ridimensionati a width x height; gli indici ripetuti riusano lo stesso frame.
+    """
+    wanted = sorted(set(frame_indices))
+    if not wanted:
+        return
+    delivered = 0
+    reader = _ffmpeg_frames(video_path, _ffmpeg_select_expression(wanted), width, height, len(wanted), threads=threads)
+    for frame, idx in zip(reader, wanted):
+        for _ in range(frame_indices.count(idx)):
+            yield idx, frame
+        delivered += 1
+    if delivered < len(wanted):
+        print(f"Impossibile leggere il frame all'indice {wanted[delivered]}. Stop.")
+
+
+@time_stage("extract_frames")
+def extract_frames(video_path: str, width: int, height: int, num_frames: Optional[int] = None,
+                   frame_rate: Optional[int] = None, sampling: str = "uniform",
+                   min_frames: int = DEFAULT_MIN_FRAMES,
+                   max_frames: int = DEFAULT_MAX_FRAMES,
+                   read_strategy: str = "auto", keep_aspect_ratio: bool = False,
+                   max_image_tokens: Optional[int] = None, detail: str = "auto",
+                   backend: str = "opencv", ffmpeg_threads: Optional[int] = None,
+                   frame_limit: Optional[int] = None) -> List[ExtractedFrame]:
+    """
+    Estrae i frame dal video.
+    Se num_frames è fornito, estrae quel numero di frame uniformemente distribuiti sul video.
+    Se frame_rate è fornito, estrae i frame a quell'intervallo.
+    Con sampling="scene" num_frames e frame_rate vengono ignorati e si estraggono i keyframe
+    ai cambi di scena, tra min_frames e max_frames.
+    read_strategy sceglie come leggere i frame con OpenCV (vedi READ_STRATEGIES); con backend="ffmpeg"
+    i frame vengono selezionati e ridimensionati da ffmpeg (ffmpeg_threads thread di decodifica).
+    Con frame_limit (ad esempio il numero di frame che rientra nel budget di token della richiesta)
+    i frame selezionati oltre il limite vengono diradati uniformemente prima della lettura.
+    Inoltre, effettua il resize di ogni frame alla dimensione width x height, oppure a quella scelta da
+    plan_frame_size se keep_aspect_ratio o max_image_tokens sono impostati.
+    Restituisce la lista dei frame estratti, in ordine temporale.
+    """
+    print("Estrazione dei frame dal video...")
+    cap = cv2.VideoCapture(video_path)
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    print(f"Frame totali nel video: {total_frames}, FPS: {fps}")
+    width, height = plan_frame_size(
+        int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        width, height, keep_aspect_ratio, max_image_tokens, detail
+    )
+
+    if sampling not in SAMPLING_MODES:
+        raise ValueError(f"Modalità di campionamento non valida: {sampling}. Valori ammessi: {SAMPLING_MODES}")
+    if backend not in EXTRACTION_BACKENDS:
+        raise ValueError(f"Backend di estrazione non valido: {backend}. Valori ammessi: {EXTRACTION_BACKENDS}")
+
+    if sampling == "scene":
+        print(f"Ricerca dei cambi di scena (tra {min_frames} e {max_frames} frame)...")
+        sample_indices, scores = scene_change_scores(video_path, backend=backend)
+        frame_indices = select_scene_keyframes(sample_indices, scores, min_frames, max_frames)
+        print(f"{len(frame_indices)} keyframe selezionati su {len(sample_indices)} campioni analizzati.")
+    elif num_frames is not None and num_frames > 0:
+        print(f"Estrazione di {num_frames} frame uniformemente distribuiti.")
+        frame_indices = [int(i * total_frames / num_frames) for i in range(num_frames)]
+    elif frame_rate is not None and frame_rate > 0:
+        print(f"Estrazione di frame con frame_rate: {frame_rate}")
+        frame_step = int(fps / frame_rate) if frame_rate <= fps else 1
+        frame_indices = list(range(0, total_frames, frame_step))
+    else:
+        print("Nessun parametro fornito, estraggo 5 frame di default.")
+        num_frames = 5
+        frame_indices = [int(i * total_frames / num_frames) for i in range(num_frames)]
+
+    if frame_limit is not None and len(frame_indices) > frame_limit:
+        print(f"{len(frame_indices)} frame selezionati, ridotti a {frame_limit} per rientrare nel limite.")
+        step = len(frame_indices) / frame_limit
+        frame_indices = [frame_indices[int(k * step)] for k in range(frame_limit)]
+
+    if backend == "ffmpeg":
+        print("Lettura dei frame con ffmpeg (selezione e ridimensionamento in decodifica)")
+        cap.release()
+        frame_reader = _read_frames_ffmpeg(video_path, frame_indices, width, height, ffmpeg_threads)
+    else:
+        strategy = choose_read_strategy(frame_indices, read_strategy)
+        print(f"Lettura dei frame con strategia: {strategy}")
+        reader = _read_frames_sequential if strategy == "sequential" else _read_frames_seek
+        frame_reader = reader(cap, frame_indices)
+
+    frames = []
+    for i, (idx, frame) in enumerate(frame_reader):
+        # Effettuiamo il resize del frame (i frame di ffmpeg hanno già la dimensione finale)
+        if frame.shape[:2] != (height, width):
+            resized_frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+        else:
+            resized_frame = frame
+
+        frames.append(ExtractedFrame(
+            index=idx,
+            timestamp=idx / fps if fps > 0 else 0.0,
+            jpeg=encode_jpeg(resized_frame),
+            width=width,
+            height=height,
+            dhash=dhash(resized_frame),
+            color=color_signature(resized_frame),
+        ))
+        print(f"Frame {i} estratto e ridimensionato a {width}x{height}.")
+
+    cap.release()
+    print("Estrazione frame completata.")
+    return frames
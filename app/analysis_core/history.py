@@ -0,0 +1,102 @@
+"""
+Costruzione della chat history inviata al modello ad ogni frame.
+
+Nella modalità "full" (comportamento storico) ogni messaggio utente già inviato viene rispedito
+per intero, immagine compresa: il frame N trasporta N immagini e la dimensione delle richieste
+cresce in modo quadratico con il numero di frame. Le modalità compatte mantengono invece
+un numero limitato di turni e rimuovono le immagini dei turni precedenti:
+
+- "text": dei turni precedenti resta solo il testo (istruzione + risposta del modello);
+- "window": come "text", ma gli ultimi `image_window` turni conservano anche l'immagine.
+
+Anche le descrizioni dei frame precedenti allegate al messaggio di ogni frame seguono la modalità:
+nelle modalità compatte sono solo quelle dei turni mantenuti (limit_previous_descriptions), così
+la dimensione di ogni richiesta resta costante con il numero di frame.
+"""
+from typing import TYPE_CHECKING, List, Optional, Sequence
+
+if TYPE_CHECKING:
+    from langchain_core.messages import BaseMessage, HumanMessage
+
+HISTORY_MODES = ("full", "text", "window")
+
+# Valori di default per le modalità compatte
+DEFAULT_HISTORY_TURNS = 10
+DEFAULT_IMAGE_WINDOW = 2
+
+# Limite delle descrizioni precedenti allegate al messaggio di ogni frame nella modalità "full"
+MAX_PREVIOUS_DESCRIPTIONS = 100
+
+OMITTED_IMAGE_TEXT = "[immagine del frame omessa: fare riferimento alla descrizione già fornita]"
+
+
+def compact_human_message(message: "HumanMessage") -> "HumanMessage":
+    """
+    Restituisce la versione solo testo di un messaggio utente già inviato.
+    Si mantiene la prima parte testuale (l'istruzione con eventuale timestamp) e l'immagine viene
+    sostituita da un segnaposto; le descrizioni dei frame precedenti allegate al messaggio vengono
+    scartate perché sono già presenti nelle risposte del modello.
+    """
+    from langchain_core.messages import HumanMessage
+
+    if isinstance(message.content, str):
+        return message
+
+    first_text = next((part for part in message.content if part.get("type") == "text"), None)
+    has_image = any(part.get("type") == "image_url" for part in message.content)
+
+    content = [first_text] if first_text is not None else []
+    if has_image:
+        content.append({"type": "text", "text": OMITTED_IMAGE_TEXT})
+    return HumanMessage(content=content)
+
+
+def limit_previous_descriptions(descriptions: Sequence[str], mode: str = "full",
+                                max_turns: Optional[int] = DEFAULT_HISTORY_TURNS) -> List[str]:
+    """
+    Descrizioni dei frame precedenti da allegare al messaggio del frame corrente: in "full" le ultime
+    MAX_PREVIOUS_DESCRIPTIONS (comportamento storico), nelle modalità compatte solo le ultime `max_turns`.
+    """
+    limit = MAX_PREVIOUS_DESCRIPTIONS
+    if mode != "full" and max_turns is not None:
+        limit = min(limit, max_turns)
+    return list(descriptions[-limit:]) if limit > 0 else []
+
+
+def build_history(messages: List["BaseMessage"], mode: str = "full",
+                  image_window: int = DEFAULT_IMAGE_WINDOW,
+                  max_turns: Optional[int] = DEFAULT_HISTORY_TURNS) -> List["BaseMessage"]:
+    """
+    Restituisce la lista di messaggi da inviare al modello come storia della conversazione.
+
+    `messages` è la storia completa: uno o più messaggi di sistema seguiti da coppie
+    (messaggio utente, risposta del modello). La lista originale non viene modificata.
+    """
+    if mode not in HISTORY_MODES:
+        raise ValueError(f"Modalità di history non valida: {mode}. Valori ammessi: {HISTORY_MODES}")
+    if mode == "full":
+        return list(messages)
+    from langchain_core.messages import HumanMessage
+
+    # I messaggi di sistema iniziali vanno sempre mantenuti
+    n_system = 0
+    while n_system < len(messages) and not isinstance(messages[n_system], HumanMessage):
+        n_system += 1
+    system_messages = list(messages[:n_system])
+    turns = list(messages[n_system:])
+
+    human_positions = [i for i, m in enumerate(turns) if isinstance(m, HumanMessage)]
+    if max_turns is not None and len(human_positions) > max_turns:
+        turns = turns[human_positions[-max_turns]:] if max_turns > 0 else []
+        human_positions = [i for i, m in enumerate(turns) if isinstance(m, HumanMessage)]
+
+    keep_images = image_window if mode == "window" else 0
+    with_images = set(human_positions[-keep_images:]) if keep_images > 0 else set()
+
+    history = system_messages
+    for i, message in enumerate(turns):
+        if isinstance(message, HumanMessage) and i not in with_images:
+            history.append(compact_human_message(message))
+        else:
+            history.append(message)
+    return history
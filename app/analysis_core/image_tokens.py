@@ -0,0 +1,85 @@
+"""
+Stima del costo in token delle immagini e scelta della risoluzione dei frame per un budget di token.
+
+Formula dei modelli vision OpenAI:
+- detail "low": costo fisso di 85 token (l'immagine viene ridotta a 512x512);
+- detail "high": l'immagine viene riportata entro 2048x2048, poi il lato corto a 768 px;
+  costo 85 token + 170 token per ogni tile da 512x512.
+Con detail "auto" il modello sceglie da sé: per prudenza la stima è quella di "high".
+"""
+import math
+from typing import Optional, Tuple
+
+DETAIL_LEVELS = ("low", "high", "auto")
+
+BASE_TOKENS = 85
+TILE_TOKENS = 170
+TILE_SIZE = 512
+LOW_DETAIL_SIZE = 512
+HIGH_DETAIL_MAX_SIZE = 2048
+HIGH_DETAIL_SHORT_SIDE = 768
+
+
+def _high_detail_size(width: int, height: int) -> Tuple[float, float]:
+    scale = min(1.0, HIGH_DETAIL_MAX_SIZE / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, HIGH_DETAIL_SHORT_SIDE / min(width, height))
+    return width * scale, height * scale
+
+
+def estimate_image_tokens(width: int, height: int, detail: str = "auto") -> int:
+    """
+    Token stimati per un'immagine width x height inviata con il livello di dettaglio indicato.
+    """
+    if detail == "low":
+        return BASE_TOKENS
+    scaled_width, scaled_height = _high_detail_size(width, height)
+    tiles = math.ceil(scaled_width / TILE_SIZE) * math.ceil(scaled_height / TILE_SIZE)
+    return BASE_TOKENS + TILE_TOKENS * tiles
+
+
+def resolve_detail(detail: str, max_image_tokens: Optional[int]) -> str:
+    """
+    Con un budget per immagine, "auto" diventa "low" se il budget non basta per un tile in alta definizione.
+    """
+    if detail not in DETAIL_LEVELS:
+        raise ValueError(f"Livello di dettaglio non valido: {detail}. Valori ammessi: {DETAIL_LEVELS}")
+    if detail != "auto" or max_image_tokens is None:
+        return detail
+    return "high" if max_image_tokens >= BASE_TOKENS + TILE_TOKENS else "low"
+
+
+def plan_frame_size(source_width: int, source_height: int, width: int, height: int,
+                    keep_aspect_ratio: bool = False, max_image_tokens: Optional[int] = None,
+                    detail: str = "auto") -> Tuple[int, int]:
+    """
+    Dimensione a cui ridimensionare i frame.
+    - Senza budget e senza keep_aspect_ratio: width x height, come in precedenza.
+    - keep_aspect_ratio: il frame viene adattato dentro il riquadro width x height mantenendo le proporzioni.
+    - max_image_tokens: width e height vengono ignorati; si sceglie la risoluzione più alta (senza ingrandire
+      il frame e mantenendo le proporzioni) il cui costo stimato con `detail` non supera il budget.
+      In "low" non serve andare oltre 512 px sul lato lungo.
+    """
+    if source_width <= 0 or source_height <= 0:
+        return width, height
+
+    if max_image_tokens is None:
+        if not keep_aspect_ratio:
+            return width, height
+        scale = min(width / source_width, height / source_height)
+    elif detail == "low":
+        scale = min(1.0, LOW_DETAIL_SIZE / max(source_width, source_height))
+    else:
+        # Il costo cresce a gradini con la scala: ricerca binaria della scala massima entro il budget
+        low, high = 0.0, 1.0
+        for _ in range(30):
+            middle = (low + high) / 2
+            tokens = estimate_image_tokens(max(1, round(source_width * middle)),
+                                           max(1, round(source_height * middle)), detail)
+            if tokens <= max_image_tokens:
+                low = middle
+            else:
+                high = middle
+        scale = low if low > 0 else min(1.0, TILE_SIZE / max(source_width, source_height))
+
+    return max(1, round(source_width * scale)), max(1, round(source_height * scale))
@@ -0,0 +1,40 @@
+"""
+Import differito delle dipendenze pesanti (cv2, numpy).
+
+Importare cv2 costa più di 100 ms: i moduli di analysis_core che lo usano lo dichiarano con
+lazy_import, e l'import vero avviene al primo attributo richiesto (ad esempio alla prima chiamata
+di extract_frames). Così l'avvio dell'API, i rerun delle interfacce Streamlit e gli script che
+usano solo una parte del pacchetto non pagano le dipendenze che non usano.
+
+Le dipendenze usate solo in poche funzioni (langchain_core, langchain_openai) sono invece
+importate dentro le funzioni stesse.
+"""
+import importlib
+import sys
+import threading
+import types
+
+_import_lock = threading.Lock()
+
+
+class LazyModule(types.ModuleType):
+    """
+    Segnaposto di un modulo: al primo attributo richiesto importa il modulo vero e ne copia
+    gli attributi, quindi gli accessi successivi non passano più da __getattr__.
+    """
+
+    def __getattr__(self, name: str):
+        with _import_lock:
+            module = importlib.import_module(self.__name__)
+            self.__dict__.update(module.__dict__)
+        return getattr(module, name)
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """
+    Restituisce il modulo `name` se è già importato, altrimenti un segnaposto che lo importa al primo uso.
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    return LazyModule(name)
@@ -0,0 +1,69 @@
+"""
+Metriche Prometheus della pipeline di analisi, condivise da API e interfacce Streamlit.
+
+- video_analysis_stage_seconds{stage}: durata delle fasi (decode, extract_frames, encode_jpeg, model_call, parse)
+- video_analysis_frames_analyzed_total{source}: frame descritti (source = "api" o "ui")
+- video_analysis_model_tokens_total{kind}: token di prompt e di completamento dichiarati dal modello
+- video_analysis_parse_failures_total{kind}: risposte del modello non interpretabili
+- video_analysis_cache_lookups_total{result}: ricerche nella cache delle risposte (hit / miss)
+- video_analysis_jobs_in_flight: job asincroni in esecuzione
+
+L'API le espone su GET /metrics. Nei processi Streamlit si raccolgono avviando un server HTTP dedicato
+con start_metrics_server(), sulla porta indicata da VIDEO_ANALYSIS_METRICS_PORT.
+"""
+import os
+import threading
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+STAGES = ("decode", "extract_frames", "encode_jpeg", "model_call", "parse")
+
+STAGE_SECONDS = Histogram(
+    "video_analysis_stage_seconds",
+    "Durata delle fasi della pipeline di analisi",
+    ["stage"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+FRAMES_ANALYZED = Counter("video_analysis_frames_analyzed_total", "Frame descritti dal modello", ["source"])
+MODEL_TOKENS = Counter("video_analysis_model_tokens_total", "Token usati nelle chiamate al modello", ["kind"])
+PARSE_FAILURES = Counter("video_analysis_parse_failures_total", "Risposte del modello non interpretabili", ["kind"])
+CACHE_LOOKUPS = Counter("video_analysis_cache_lookups_total", "Ricerche nella cache delle risposte", ["result"])
+JOBS_IN_FLIGHT = Gauge("video_analysis_jobs_in_flight", "Job di analisi asincroni in esecuzione")
+
+
+def time_stage(stage: str):
+    """
+    Context manager (o decoratore) che registra la durata di una fase in STAGE_SECONDS.
+    """
+    return STAGE_SECONDS.labels(stage=stage).time()
+
+
+def record_usage(response) -> None:
+    """
+    Conta i token di prompt e completamento dichiarati nella risposta del modello, se presenti.
+    """
+    usage = getattr(response, "usage_metadata", None) or {}
+    if usage.get("input_tokens"):
+        MODEL_TOKENS.labels(kind="prompt").inc(usage["input_tokens"])
+    if usage.get("output_tokens"):
+        MODEL_TOKENS.labels(kind="completion").inc(usage["output_tokens"])
+
+
+_metrics_server_started = False
+_metrics_server_lock = threading.Lock()
+
+
+def start_metrics_server() -> bool:
+    """
+    Avvia (una sola volta per processo) il server HTTP delle metriche sulla porta VIDEO_ANALYSIS_METRICS_PORT.
+    Pensato per le interfacce Streamlit, che rieseguono lo script a ogni interazione. Restituisce True se attivo.
+    """
+    global _metrics_server_started
+    port = os.getenv("VIDEO_ANALYSIS_METRICS_PORT")
+    if not port:
+        return False
+    with _metrics_server_lock:
+        if not _metrics_server_started:
+            start_http_server(int(port))
+            _metrics_server_started = True
+    return True
@@ -0,0 +1,201 @@
+"""
+Parser tollerante per il formato a tag delle risposte del modello:
+
+    <attribute=frame_description| {"descrizione_frame": "..."} | attribute=frame_description>
+    <attribute=final_description| {"descrizione_finale": "..."} | attribute=final_description>
+    <attribute=anomaly| [{"anomaly": "..."}, ...] | attribute=anomaly>
+
+Una sola scansione della risposta estrae tutti i blocchi (spazi attorno ai tag tollerati). Il JSON
+di ciascun blocco viene riparato dagli errori più comuni dei modelli: blocchi di codice markdown,
+virgolette tipografiche, virgole finali, a capo non escapati, virgolette interne non escapate,
+apici singoli, parentesi di chiusura mancanti. Se il JSON resta illeggibile, il blocco viene
+scartato e il chiamante può richiedere di nuovo solo il frame interessato.
+"""
+import ast
+import json
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from analysis_core.metrics import PARSE_FAILURES, time_stage
+
+BLOCK_PATTERN = re.compile(r"<\s*attribute\s*=\s*(\w+)\s*\|(.*?)\|\s*attribute\s*=\s*\1\s*>", re.DOTALL)
+CODE_FENCE_PATTERN = re.compile(r"^```(?:json)?\s*|\s*```$")
+TRAILING_COMMA_PATTERN = re.compile(r",\s*([}\]])")
+# Coppia "chiave": "valore" il cui valore termina solo prima della chiave successiva o della fine dell'oggetto:
+# così le virgolette non escapate all'interno del testo non interrompono il valore
+LOOSE_FIELD_PATTERN = re.compile(r'"(\w+)"\s*:\s*(?:"(.*?)"|(-?\d+))\s*(?=,\s*"\w+"\s*:|}\s*$)', re.DOTALL)
+
+FORMAT_REMINDER = {
+    "frame_description": '<attribute=frame_description| {"descrizione_frame": "..."} | attribute=frame_description>',
+    "final_description": '<attribute=final_description| {"descrizione_finale": "..."} | attribute=final_description>',
+}
+
+
+class ReplyParseError(ValueError):
+    """
+    La risposta del modello non contiene un blocco valido del tipo richiesto.
+    """
+
+
+@dataclass
+class ParsedReply:
+    # Coppie (indice_frame o None, descrizione) nell'ordine in cui compaiono
+    frames: List[Tuple[Optional[int], str]] = field(default_factory=list)
+    # Campi di ciascun blocco frame_description interpretato (ad esempio "timestamp_frame"), nello stesso ordine
+    frame_fields: List[Dict[str, Any]] = field(default_factory=list)
+    final_description: Optional[str] = None
+    # Testo del blocco anomaly così come scritto dal modello, e la sua versione interpretata
+    anomaly_text: Optional[str] = None
+    anomalies: Optional[list] = None
+    # Nomi dei blocchi trovati ma non interpretabili
+    failed_blocks: List[str] = field(default_factory=list)
+
+
+def repair_json(text: str) -> Any:
+    """
+    Interpreta il JSON di un blocco, provando in ordine riparazioni sempre più aggressive.
+    Solleva ValueError se nessuna riesce.
+    """
+    text = CODE_FENCE_PATTERN.sub("", text.strip()).strip()
+    candidates = [text]
+    fixed = text.replace("“", '"').replace("”", '"')
+    fixed = TRAILING_COMMA_PATTERN.sub(r"\1", fixed)
+    candidates.append(fixed)
+    if fixed.startswith("{") and not fixed.endswith("}"):
+        candidates.append(fixed + "}")
+    if fixed.startswith("[") and not fixed.endswith("]"):
+        candidates.append(fixed + "]")
+
+    for candidate in candidates:
+        try:
+            # strict=False accetta a capo e tabulazioni non escapati all'interno delle stringhe
+            return json.loads(candidate, strict=False)
+        except ValueError:
+            pass
+
+    for candidate in candidates:
+        try:
+            value = ast.literal_eval(candidate)
+            if isinstance(value, (dict, list)):
+                return value
+        except (ValueError, SyntaxError):
+            pass
+
+    if fixed.startswith("{"):
+        obj = fixed if fixed.endswith("}") else fixed + "}"
+        fields = {}
+        for match in LOOSE_FIELD_PATTERN.finditer(obj):
+            key, string_value, number_value = match.groups()
+            fields[key] = int(number_value) if number_value is not None else string_value.replace('\\"', '"')
+        if fields:
+            return fields
+
+    raise ValueError("JSON non riparabile")
+
+
+@time_stage("parse")
+def parse_reply(ai_response: str) -> ParsedReply:
+    """
+    Estrae in una sola passata tutti i blocchi frame_description, final_description e anomaly.
+    """
+    parsed = ParsedReply()
+    for match in BLOCK_PATTERN.finditer(ai_response):
+        attribute, body = match.group(1), match.group(2)
+        if attribute == "anomaly":
+            parsed.anomaly_text = body.strip()
+            try:
+                value = repair_json(body)
+                parsed.anomalies = value if isinstance(value, list) else [value]
+            except ValueError:
+                parsed.failed_blocks.append(attribute)
+            continue
+        if attribute not in ("frame_description", "final_description"):
+            continue
+        try:
+            value = repair_json(body)
+        except ValueError:
+            parsed.failed_blocks.append(attribute)
+            continue
+        if not isinstance(value, dict):
+            parsed.failed_blocks.append(attribute)
+        elif attribute == "frame_description":
+            index = value.get("indice_frame")
+            try:
+                index = int(index) if index is not None else None
+            except (TypeError, ValueError):
+                index = None
+            parsed.frames.append((index, str(value.get("descrizione_frame", ""))))
+            parsed.frame_fields.append(value)
+        else:
+            parsed.final_description = str(value.get("descrizione_finale", ""))
+    return parsed
+
+
+def parse_frame_description(ai_response: str) -> str:
+    """
+    Descrizione del (primo) frame contenuto nella risposta; ReplyParseError se manca.
+    """
+    parsed = parse_reply(ai_response)
+    if not parsed.frames:
+        print("Errore: formato non corretto nella risposta del modello.")
+        PARSE_FAILURES.labels(kind="frame").inc()
+        raise ReplyParseError("La risposta del modello non contiene la descrizione formattata correttamente.")
+    return parsed.frames[0][1]
+
+
+def parse_indexed_frame_descriptions(ai_response: str, first_frame_number: int = 1) -> Dict[int, str]:
+    """
+    Tutti i blocchi frame_description di una risposta che descrive più frame, come {numero frame (da 1): descrizione}.
+    Se un blocco non riporta "indice_frame" si usa la sua posizione a partire da first_frame_number.
+    I blocchi non interpretabili vengono ignorati.
+    """
+    descriptions = {}
+    for position, (index, description) in enumerate(parse_reply(ai_response).frames):
+        descriptions[index if index is not None else first_frame_number + position] = description
+    return descriptions
+
+
+def parse_final_description(ai_response: str) -> str:
+    """
+    Descrizione finale contenuta nella risposta; ReplyParseError se manca.
+    """
+    final_description = parse_reply(ai_response).final_description
+    if final_description is None:
+        print("Errore: formato non corretto nella descrizione finale del modello.")
+        PARSE_FAILURES.labels(kind="final").inc()
+        raise ReplyParseError("La risposta del modello non contiene la descrizione finale formattata correttamente.")
+    return final_description
+
+
+def strip_tags(ai_response: str) -> str:
+    """
+    Testo della risposta senza i tag: ultima risorsa quando neanche una nuova richiesta produce un blocco valido.
+    """
+    text = re.sub(r"<\s*attribute\s*=\s*\w+\s*\|?|\|?\s*attribute\s*=\s*\w+\s*>", "", ai_response)
+    return text.strip()
+
+
+def format_frame_reply(descriptions: List[str], first_frame_number: Optional[int] = None) -> str:
+    """
+    Risposta nel formato a tag con i blocchi frame_description dati: sostituisce nella storia della
+    conversazione una risposta non interpretabile, dopo che i frame sono stati richiesti di nuovo.
+    Con first_frame_number ogni blocco riporta il suo "indice_frame", come nelle chiamate a più frame.
+    """
+    blocks = []
+    for position, description in enumerate(descriptions):
+        fields = {"descrizione_frame": description}
+        if first_frame_number is not None:
+            fields = {"indice_frame": first_frame_number + position, **fields}
+        blocks.append(f"<attribute=frame_description| {json.dumps(fields, ensure_ascii=False)} | attribute=frame_description>")
+    return "\n".join(blocks)
+
+
+def reask_instruction(attribute: str) -> str:
+    """
+    Istruzione da aggiungere quando si richiede di nuovo un blocco non interpretabile.
+    """
+    return (
+        "La risposta precedente non rispettava il formato richiesto. Rispondi esclusivamente con il blocco "
+        f"{FORMAT_REMINDER[attribute]} contenente JSON valido (virgolette interne escapate)."
+    )
@@ -0,0 +1,923 @@
+"""
+Pipeline completa di analisi di un video, condivisa dall'API (main.py), dall'interfaccia
+analyze_from_stored_data_ui.py e dalla descrizione sequenziale delle altre interfacce (sequential.py).
+
+VideoAnalyzer riceve il backend del modello e il prompt di sistema dell'applicazione che lo usa ed
+esegue, con le opzioni di AnalysisOptions: estrazione dei frame (o frame già estratti, ad esempio dal
+pool di processi), soppressione dei duplicati, descrizione in modalità "sequential", "parallel" o
+"segments" (con più frame per chiamata, nuova richiesta dei frame non interpretabili e passaggio in alta
+definizione dei frame sospetti), cache delle risposte, checkpoint, budget di token e di tempo e
+descrizione finale gerarchica. Il generatore analyze_video_events produce un evento (dict con chiave
+"event") appena ogni risultato è disponibile: l'API li inoltra così come sono, le interfacce li
+trasformano nei propri messaggi di avanzamento.
+
+Configurazione tramite variabili d'ambiente:
+- VIDEO_ANALYSIS_MAX_CONCURRENCY: default di max_concurrency (4)
+"""
+import asyncio
+import math
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, List, Literal, Optional, Tuple
+
+from pydantic import BaseModel
+
+from analysis_core.budget import AnalysisBudget, BudgetExceeded
+from analysis_core.cache import conversation_context, get_response_cache, make_cache_key
+from analysis_core.checkpoints import RunCheckpoint, file_sha256, get_checkpoint_store, make_checkpoint_key
+from analysis_core.dedup import suppress_near_duplicates
+from analysis_core.frames import (DEFAULT_MAX_FRAMES, DEFAULT_MIN_FRAMES, ExtractedFrame, extract_frames,
+                                  format_timestamp)
+from analysis_core.history import (DEFAULT_HISTORY_TURNS, DEFAULT_IMAGE_WINDOW, MAX_PREVIOUS_DESCRIPTIONS,
+                                   build_history, limit_previous_descriptions)
+from analysis_core.image_tokens import estimate_image_tokens, resolve_detail
+from analysis_core.metrics import FRAMES_ANALYZED, PARSE_FAILURES
+from analysis_core.parsing import (ReplyParseError, format_frame_reply, parse_frame_description,
+                                   parse_indexed_frame_descriptions, parse_reply, reask_instruction)
+from analysis_core.sequential import reasked_description
+from analysis_core.summarize import (DEFAULT_FAN_IN, FINAL_INSTRUCTION, TimedText, partial_instruction,
+                                     summarize_hierarchically)
+
+if TYPE_CHECKING:
+    from langchain_core.messages import SystemMessage
+
+# Numero massimo di chiamate contemporanee al modello nella modalità di analisi "parallel"
+MAX_CONCURRENCY = int(os.getenv("VIDEO_ANALYSIS_MAX_CONCURRENCY", "4"))
+
+# Parole che, nella descrizione di un frame analizzato in "low", fanno richiedere l'analisi in "high"
+ESCALATION_PATTERN = re.compile(r"anomal|sospett|intrus|non autorizzat|incendi|fiamm|fumo|allarm", re.IGNORECASE)
+
+# Riconciliazione della modalità "parallel": frame rivisti per chiamata (le loro descrizioni devono stare nel
+# limite di token di output del modello, 2048 di default) e descrizioni già riviste ripetute come contesto
+RECONCILE_WINDOW_FRAMES = 8
+RECONCILE_OVERLAP_FRAMES = 2
+
+# Stime usate per il budget di token (max_tokens_budget): lunghezza della descrizione di un frame
+# e del testo delle istruzioni di una chiamata; numero massimo di frame considerato nella stima
+ESTIMATED_DESCRIPTION_TOKENS = 150
+ESTIMATED_INSTRUCTION_TOKENS = 100
+MAX_BUDGET_FRAMES = 16384
+
+
+class AnalysisOptions(BaseModel):
+    """
+    Parametri di analisi comuni a tutti gli endpoint dell'API e alle interfacce, indipendenti da come arriva il video.
+    """
+    num_frames: Optional[int] = None
+    frame_rate: Optional[int] = None
+    # Aggiungiamo i parametri width e height per il resize dei frame
+    width: Optional[int] = 256
+    height: Optional[int] = 256
+    # Adatta i frame dentro width x height mantenendo le proporzioni invece di deformarli
+    keep_aspect_ratio: bool = False
+    # Budget di token stimati per immagine: se impostato sceglie la risoluzione (proporzioni mantenute,
+    # width e height ignorati) e, con detail "auto", il livello di dettaglio
+    max_image_tokens: Optional[int] = None
+    # Livello di dettaglio delle immagini inviate al modello
+    detail: Literal["low", "high", "auto"] = "auto"
+    # Con detail "low": i frame la cui descrizione segnala anomalie vengono descritti di nuovo in "high"
+    escalate_detail: bool = False
+    # "uniform": frame equidistanti (num_frames) o a intervallo fisso (frame_rate);
+    # "scene": keyframe ai cambi di scena, tra min_frames e max_frames
+    sampling: Literal["uniform", "scene"] = "uniform"
+    min_frames: int = DEFAULT_MIN_FRAMES
+    max_frames: int = DEFAULT_MAX_FRAMES
+    # Lettura dei frame: "auto" sceglie tra decodifica sequenziale e seek in base alla densità del campionamento
+    read_strategy: Literal["auto", "sequential", "seek"] = "auto"
+    # "opencv": decodifica a piena risoluzione e resize; "ffmpeg": selezione e resize dentro ffmpeg
+    # (meno CPU con video 4K e campionamento fitto), con ffmpeg_threads thread di decodifica
+    extraction_backend: Literal["opencv", "ffmpeg"] = "opencv"
+    ffmpeg_threads: Optional[int] = None
+    # Storia inviata al modello: "full" rispedisce ogni frame precedente con la sua immagine,
+    # "text" solo il testo dei turni precedenti, "window" anche le immagini degli ultimi turni
+    history_mode: Literal["full", "text", "window"] = "full"
+    history_turns: int = DEFAULT_HISTORY_TURNS
+    history_image_window: int = DEFAULT_IMAGE_WINDOW
+    # "sequential": un frame alla volta nella stessa conversazione;
+    # "parallel": frame descritti in modo indipendente e concorrente, poi riconciliati prima della descrizione finale;
+    # "segments": il video è diviso in segmenti di segment_seconds secondi, ciascuno descritto come una conversazione
+    # sequenziale indipendente (max_concurrency segmenti alla volta) e riassunto; la descrizione finale nasce dai
+    # riassunti dei segmenti. Ogni segmento parte dagli ultimi segment_overlap_seconds secondi del precedente,
+    # descritti solo come contesto
+    analysis_mode: Literal["sequential", "parallel", "segments"] = "sequential"
+    max_concurrency: int = MAX_CONCURRENCY
+    segment_seconds: float = 300.0
+    segment_overlap_seconds: float = 10.0
+    # Descrizioni riassunte in una sola chiamata per la descrizione finale (e per i riassunti dei segmenti):
+    # oltre questo numero vengono prima riassunte a blocchi
+    summary_fan_in: int = DEFAULT_FAN_IN
+    # Numero di frame consecutivi descritti in una sola chiamata al modello (immagini multiple nello stesso messaggio)
+    frames_per_call: int = 1
+    # Riutilizza le risposte già ottenute per gli stessi frame (cache su disco condivisa con le UI)
+    use_cache: bool = True
+    # Soglia (distanza di Hamming tra dHash a 64 bit) sotto la quale un frame è considerato duplicato
+    # dell'ultimo frame analizzato e non viene inviato al modello; None disattiva il filtro
+    dedup_threshold: Optional[int] = None
+    # Salva i frame descritti man mano e, se un'analisi identica (stesso video e parametri) si era
+    # interrotta, riprende dall'ultimo frame completato
+    resume: bool = True
+    # Budget della richiesta: token totali (richieste e risposte) e secondi di analisi. Con il budget di token
+    # i frame campionati vengono ridotti in anticipo secondo la stima del costo; esaurito un budget, l'analisi
+    # si ferma e restituisce i frame già descritti con una descrizione finale costruita da questi
+    max_tokens_budget: Optional[int] = None
+    max_seconds: Optional[float] = None
+
+
+# Opzioni che non cambiano il risultato dell'analisi e quindi non fanno parte della chiave del checkpoint
+CHECKPOINT_NEUTRAL_OPTIONS = ("use_cache", "max_concurrency", "resume", "ffmpeg_threads", "max_seconds")
+
+
+def _batch_instruction(first_index: int, batch_size: int) -> str:
+    """
+    Istruzione aggiuntiva per le chiamate che descrivono più frame consecutivi.
+    """
+    return (
+        f"Ti vengono forniti {batch_size} frame consecutivi, in ordine temporale "
+        f"(frame da {first_index + 1} a {first_index + batch_size}). Descrivi ciascun frame separatamente e, "
+        "per ogni frame, restituisci un blocco "
+        '<attribute=frame_description| {"indice_frame": <numero del frame>, "descrizione_frame": "..."} | attribute=frame_description>'
+    )
+
+
+def _frame_image_parts(images: List[str], first_index: int, detail: str = "auto") -> list:
+    """
+    Parti immagine del messaggio utente (data URL). Con più frame ogni immagine è preceduta dal suo numero di frame (da 1).
+    """
+    if len(images) == 1:
+        return [{"type": "image_url", "image_url": {"url": images[0], "detail": detail}}]
+    parts = []
+    for offset, image in enumerate(images):
+        parts.append({"type": "text", "text": f"Frame {first_index + offset + 1}:"})
+        parts.append({"type": "image_url", "image_url": {"url": image, "detail": detail}})
+    return parts
+
+
+def _frame_batches(frames: Iterable[ExtractedFrame], batch_size: int) -> Iterator[Tuple[int, List[ExtractedFrame]]]:
+    """
+    Gruppi di batch_size frame consecutivi, con l'indice del primo frame del gruppo.
+    `frames` può essere un generatore: ogni gruppo viene letto solo quando serve.
+    """
+    frames = iter(frames)
+    first = 0
+    while True:
+        batch = list(islice(frames, batch_size))
+        if not batch:
+            return
+        yield first, batch
+        first += len(batch)
+
+
+def _frame_detail(options: AnalysisOptions) -> str:
+    return resolve_detail(options.detail, options.max_image_tokens)
+
+
+def _image_tokens(frame: ExtractedFrame, detail: str) -> int:
+    # Frame di cui non si conosce la dimensione (FrameRequest delle interfacce): nessuna stima
+    if frame.width is None:
+        return 0
+    return estimate_image_tokens(frame.width, frame.height, detail)
+
+
+def _needs_high_detail(description: str, options: AnalysisOptions) -> bool:
+    """
+    Un frame descritto in "low" viene ridescritto in "high" se la descrizione segnala possibili anomalie.
+    """
+    if not options.escalate_detail or _frame_detail(options) != "low":
+        return False
+    return ESCALATION_PATTERN.search(description) is not None
+
+
+def _frame_event(index: int, description: str, frame: ExtractedFrame, detail: str, escalated: bool) -> dict:
+    image_tokens = _image_tokens(frame, detail)
+    if escalated:
+        image_tokens += _image_tokens(frame, "high")
+    return {
+        "event": "frame_description",
+        "index": index,
+        "descrizione_frame": description,
+        "detail": "high" if escalated else detail,
+        "image_tokens": image_tokens,
+    }
+
+
+def _batch_descriptions(ai_response: str, first_index: int, batch_size: int) -> List[Optional[str]]:
+    """
+    Descrizioni dei frame di una chiamata (uno o più frame consecutivi), nell'ordine dei frame.
+    None per i frame la cui descrizione manca o non è interpretabile: vanno richiesti di nuovo singolarmente.
+    """
+    if batch_size == 1:
+        try:
+            return [parse_frame_description(ai_response)]
+        except ReplyParseError:
+            return [None]
+    descriptions = parse_indexed_frame_descriptions(ai_response, first_frame_number=first_index + 1)
+    expected = range(first_index + 1, first_index + batch_size + 1)
+    missing = [n for n in expected if n not in descriptions]
+    if missing:
+        print(f"Errore: la risposta del modello non contiene una descrizione valida dei frame {missing}.")
+        PARSE_FAILURES.labels(kind="frame_batch").inc()
+    return [descriptions.get(n) for n in expected]
+
+
+def _escalated_description(escalation_response: str, low_description: str):
+    """
+    Descrizione in alta definizione; se la risposta non è interpretabile si mantiene quella in "low".
+    Restituisce (descrizione, True se l'alta definizione è stata usata).
+    """
+    try:
+        return parse_frame_description(escalation_response), True
+    except ReplyParseError:
+        print("Risposta in alta definizione non interpretabile: mantengo la descrizione a bassa risoluzione.")
+        return low_description, False
+
+
+def _temporal_segments(frames: List[ExtractedFrame], segment_seconds: float,
+                       overlap_seconds: float) -> List[Tuple[int, int, int]]:
+    """
+    Divide i frame (in ordine di tempo) in segmenti di segment_seconds secondi. Per ogni segmento non vuoto
+    restituisce (primo frame di contesto, primo frame del segmento, fine esclusa): i frame di contesto
+    sono quelli degli ultimi overlap_seconds secondi prima dell'inizio del segmento.
+    """
+    segments = []
+    start = 0
+    while start < len(frames):
+        segment_start = (frames[start].timestamp // segment_seconds) * segment_seconds
+        end = start
+        while end < len(frames) and frames[end].timestamp < segment_start + segment_seconds:
+            end += 1
+        context_start = start
+        while context_start > 0 and frames[context_start - 1].timestamp >= segment_start - overlap_seconds:
+            context_start -= 1
+        segments.append((context_start, start, end))
+        start = end
+    return segments
+
+
+def _frame_image_budget_tokens(options: AnalysisOptions) -> int:
+    """
+    Token immagine di un frame nel caso peggiore: la dimensione effettiva è nota solo dopo l'estrazione,
+    ma non supera mai width x height né il budget per immagine.
+    """
+    if options.max_image_tokens is not None:
+        return options.max_image_tokens
+    return estimate_image_tokens(options.width or 2048, options.height or 2048, _frame_detail(options))
+
+
+class InvalidOptions(ValueError):
+    """
+    Combinazione di opzioni che non permette l'analisi (ad esempio un budget di token troppo piccolo).
+    """
+
+
+class VideoAnalyzer:
+    """
+    Analisi dei video con un backend del modello e un prompt di sistema. `chat` è un ModelBackend
+    (o un oggetto con la stessa interfaccia: chiamata sincrona, ainvoke e model_name).
+    `instruction_suffix` viene accodato alle istruzioni dei frame e della descrizione finale (ad esempio
+    stile e richieste aggiuntive delle interfacce); con `frame_timestamps` l'istruzione di ogni frame
+    riporta il suo timestamp. `source` è l'etichetta delle metriche dei frame analizzati.
+    """
+
+    def __init__(self, chat, system_prompt: str, instruction_suffix: str = "", frame_timestamps: bool = False,
+                 source: str = "api"):
+        self.chat = chat
+        self.system_prompt = system_prompt
+        self.instruction_suffix = instruction_suffix
+        self.frame_timestamps = frame_timestamps
+        self.source = source
+
+    def frame_text(self, text: str, batch: list) -> str:
+        """
+        Istruzione di una chiamata che descrive i frame di `batch`: con frame_timestamps è preceduta dai
+        timestamp dei frame, ed è seguita da instruction_suffix.
+        """
+        if self.frame_timestamps:
+            text = f"Timestamp: {', '.join(format_timestamp(frame.timestamp) for frame in batch)} - {text}"
+        return text + self.instruction_suffix
+
+    def _frame_cache_key(self, images: List[str], frame_user_text: str, options: AnalysisOptions,
+                         detail: str = "auto", context: List[str] = ()) -> Optional[str]:
+        """
+        Chiave della cache delle risposte per un frame (o gruppo di frame); None se la cache è disattivata.
+        Il livello di dettaglio fa parte della chiave ("auto", il valore storico, lascia invariate le chiavi esistenti).
+        `context` identifica i turni precedenti nelle analisi con storia (vuoto per le chiamate indipendenti).
+        """
+        if not options.use_cache:
+            return None
+        style = "" if detail == "auto" else f"detail={detail}"
+        return make_cache_key(images, self.system_prompt + "\n" + frame_user_text, style, self.chat.model_name, context)
+
+    def _escalation_request(self, frame: ExtractedFrame, description: str, options: AnalysisOptions):
+        """
+        Messaggio e chiave di cache per ridescrivere un singolo frame in alta definizione.
+        """
+        from langchain_core.messages import HumanMessage
+
+        frame_user_text = (
+            "Analizza il frame seguente, ora in alta definizione. La descrizione ottenuta a bassa risoluzione "
+            f"segnala possibili anomalie: \"{description}\". Verifica e descrivi con precisione il frame. "
+            "Non generare analisi mediche."
+        )
+        human_content = [{"type": "text", "text": frame_user_text}] + _frame_image_parts([frame.data_url], 0, "high")
+        cache_key = self._frame_cache_key([frame.data_url], frame_user_text, options, "high")
+        return HumanMessage(content=human_content), cache_key
+
+    def _reask_request(self, frame: ExtractedFrame, options: AnalysisOptions, detail: str):
+        """
+        Messaggio e chiave di cache per richiedere di nuovo la descrizione di un solo frame,
+        quando la risposta originale non ne conteneva una interpretabile.
+        """
+        from langchain_core.messages import HumanMessage
+
+        frame_user_text = "Analizza il frame seguente. Non generare analisi mediche.\n" + reask_instruction("frame_description")
+        human_content = [{"type": "text", "text": frame_user_text}] + _frame_image_parts([frame.data_url], 0, detail)
+        cache_key = self._frame_cache_key([frame.data_url], frame_user_text, options, detail)
+        return HumanMessage(content=human_content), cache_key
+
+    def _cached_call(self, messages: list, cache_key: Optional[str], label: str, budget: AnalysisBudget) -> str:
+        """
+        Testo della risposta del modello ai messaggi, dalla cache se presente; altrimenti chiama il modello
+        e salva la risposta. Anche le risposte non interpretabili vengono salvate: le nuove richieste
+        dei singoli frame hanno una chiave propria. Le chiamate al modello sono registrate nel budget
+        dell'analisi, che solleva BudgetExceeded se è già esaurito.
+        """
+        ai_response = get_response_cache().get(cache_key) if cache_key else None
+        if ai_response is not None:
+            print("Risposta trovata in cache, nessuna chiamata al modello.")
+            return ai_response
+        budget.check()
+        print(f"Invio richiesta al modello per {label}...")
+        start = time.monotonic()
+        response = self.chat(messages)
+        budget.record(messages, response, time.monotonic() - start)
+        ai_response = response.content
+        if cache_key:
+            get_response_cache().set(cache_key, ai_response)
+        return ai_response
+
+    async def _cached_acall(self, messages: list, cache_key: Optional[str], label: str, semaphore: asyncio.Semaphore,
+                            budget: AnalysisBudget) -> str:
+        """
+        Versione asincrona di _cached_call: al massimo tante chiamate contemporanee quanti i posti del semaforo.
+        """
+        ai_response = get_response_cache().get(cache_key) if cache_key else None
+        if ai_response is not None:
+            return ai_response
+        async with semaphore:
+            budget.check()
+            print(f"Invio richiesta al modello per {label}...")
+            start = time.monotonic()
+            response = await self.chat.ainvoke(messages)
+            budget.record(messages, response, time.monotonic() - start)
+            ai_response = response.content
+        if cache_key:
+            get_response_cache().set(cache_key, ai_response)
+        return ai_response
+
+    def describe_frames_sequential(self, frames: Iterable[ExtractedFrame], options: AnalysisOptions, messages: list,
+                                   checkpoint: RunCheckpoint, budget: AnalysisBudget) -> Iterator[dict]:
+        """
+        Descrive i frame uno dopo l'altro nella stessa conversazione (ogni frame vede la storia dei precedenti).
+        Con options.frames_per_call > 1 ogni chiamata descrive un gruppo di frame consecutivi.
+        I frame senza una descrizione interpretabile vengono richiesti di nuovo singolarmente.
+        I passi già presenti nel checkpoint non vengono richiesti al modello: la conversazione
+        viene ricostruita dalle risposte salvate. `messages` viene aggiornata con i turni della conversazione.
+        `frames` può essere un generatore (frame di uno stream): il gruppo successivo viene letto solo
+        dopo aver descritto il precedente.
+        """
+        from langchain_core.messages import AIMessage, HumanMessage
+
+        batch_size = max(1, options.frames_per_call)
+        detail = _frame_detail(options)
+        # Manteniamo una lista di descrizioni dei frame precedenti
+        frame_descriptions = []
+        # Chiave e risposta del turno precedente: la chiave di cache di ogni turno dipende dalla conversazione
+        previous_key, previous_response = None, None
+        history_params = f"history={options.history_mode}:{options.history_turns}:{options.history_image_window}"
+        total = f" di {len(frames)}" if hasattr(frames, "__len__") else ""
+
+        # Per ogni frame (o gruppo di frame) estratto, chiediamo una descrizione
+        for i, batch in _frame_batches(frames, batch_size):
+            if batch_size == 1:
+                print(f"\nAnalisi del frame {i+1}{total}...")
+            else:
+                print(f"\nAnalisi dei frame {i+1}-{i+len(batch)}{total}...")
+
+            # Nelle modalità compatte solo le descrizioni dei turni mantenuti nella storia
+            previous_descriptions_limited = limit_previous_descriptions(
+                frame_descriptions, options.history_mode, options.history_turns * batch_size)
+
+            frame_user_text = "Analizza il frame seguente. Tieni conto delle descrizioni dei frame precedenti fornite. Non generare analisi mediche. Cerca di mantenere coerenza con le descrizioni precedenti."
+            if batch_size > 1:
+                frame_user_text += "\n" + _batch_instruction(i, len(batch))
+            frame_user_text = self.frame_text(frame_user_text, batch)
+
+            human_content = [
+                {"type": "text", "text": frame_user_text},
+            ]
+
+            for idx, desc in enumerate(previous_descriptions_limited):
+                human_content.append({"type": "text", "text": f"Descrizione frame precedente {idx+1}: {desc}"})
+
+            images = [frame.data_url for frame in batch]
+            human_content.extend(_frame_image_parts(images, i, detail))
+
+            human_message = HumanMessage(content=human_content)
+            context = conversation_context(previous_key, previous_response, history_params, *previous_descriptions_limited)
+            cache_key = self._frame_cache_key(images, frame_user_text, options, detail, context)
+
+            saved = checkpoint.get(i)
+            if saved is not None:
+                batch_events, ai_response = saved
+                print("Frame già descritti in un tentativo precedente, ripresi dal checkpoint.")
+                messages.append(human_message)
+                messages.append(AIMessage(content=ai_response))
+                previous_key, previous_response = cache_key, ai_response
+                for event in batch_events:
+                    frame_descriptions.append(event["descrizione_frame"])
+                    yield event
+                continue
+
+            history = build_history(messages, options.history_mode, options.history_image_window, options.history_turns)
+            ai_response = self._cached_call(history + [human_message], cache_key, "la descrizione del frame", budget)
+
+            print("Parsing della risposta del modello...")
+            batch_descriptions = _batch_descriptions(ai_response, i, len(batch))
+
+            reasked = None in batch_descriptions
+            batch_events = []
+            for offset, desc_frame in enumerate(batch_descriptions):
+                if desc_frame is None:
+                    print(f"Frame {i+offset+1}: descrizione non interpretabile, nuova richiesta per il solo frame...")
+                    reask_message, reask_key = self._reask_request(batch[offset], options, detail)
+                    desc_frame = reasked_description(self._cached_call([messages[0], reask_message], reask_key, f"il frame {i+offset+1}", budget))
+                    batch_descriptions[offset] = desc_frame
+                escalated = _needs_high_detail(desc_frame, options)
+                if escalated:
+                    print(f"Frame {i+offset+1}: possibili anomalie, nuova analisi in alta definizione...")
+                    escalation_message, escalation_key = self._escalation_request(batch[offset], desc_frame, options)
+                    escalation_response = self._cached_call([messages[0], escalation_message], escalation_key, f"il frame {i+offset+1}", budget)
+                    desc_frame, escalated = _escalated_description(escalation_response, desc_frame)
+                print(f"Descrizione frame {i+offset+1} estratta con successo.")
+                frame_descriptions.append(desc_frame)
+                batch_events.append(_frame_event(i + offset, desc_frame, batch[offset], detail, escalated))
+            if reasked:
+                # Nella storia (e nel checkpoint) la risposta non interpretabile viene sostituita da una
+                # risposta ben formata con le descrizioni ottenute dalle nuove richieste
+                ai_response = format_frame_reply(batch_descriptions, i + 1 if batch_size > 1 else None)
+            messages.append(human_message)
+            messages.append(AIMessage(content=ai_response))
+            previous_key, previous_response = cache_key, ai_response
+            checkpoint.save(i, batch_events, ai_response)
+            yield from batch_events
+
+    def _describe_frames_parallel(self, frames: List[ExtractedFrame], options: AnalysisOptions, system_message: "SystemMessage",
+                                  checkpoint: RunCheckpoint, budget: AnalysisBudget) -> Iterator[dict]:
+        """
+        Descrive i frame in modo indipendente l'uno dall'altro, con chiamate asincrone al modello
+        (al massimo options.max_concurrency contemporaneamente). Con options.frames_per_call > 1
+        ogni chiamata descrive un gruppo di frame consecutivi; i frame senza una descrizione
+        interpretabile vengono richiesti di nuovo singolarmente, quelli già presenti nel checkpoint
+        non vengono richiesti affatto. Gli eventi vengono prodotti nell'ordine in cui le descrizioni
+        sono pronte, non in ordine di frame.
+        """
+        from langchain_core.messages import HumanMessage
+
+        batch_size = max(1, options.frames_per_call)
+        detail = _frame_detail(options)
+        loop = asyncio.new_event_loop()
+        semaphore = asyncio.Semaphore(max(1, options.max_concurrency))
+
+        async def describe(i: int, batch: List[ExtractedFrame]):
+            saved = checkpoint.get(i)
+            if saved is not None:
+                return i, saved[0], None
+            frame_user_text = "Analizza il frame seguente. Non generare analisi mediche."
+            if batch_size > 1:
+                frame_user_text += "\n" + _batch_instruction(i, len(batch))
+            frame_user_text = self.frame_text(frame_user_text, batch)
+            images = [frame.data_url for frame in batch]
+            human_content = [{"type": "text", "text": frame_user_text}] + _frame_image_parts(images, i, detail)
+
+            cache_key = self._frame_cache_key(images, frame_user_text, options, detail)
+            ai_response = await self._cached_acall([system_message, HumanMessage(content=human_content)], cache_key,
+                                              f"i frame {i+1}-{i+len(batch)} di {len(frames)}", semaphore, budget)
+            batch_descriptions = _batch_descriptions(ai_response, i, len(batch))
+
+            escalated = []
+            for offset, desc_frame in enumerate(batch_descriptions):
+                if desc_frame is None:
+                    print(f"Frame {i+offset+1}: descrizione non interpretabile, nuova richiesta per il solo frame...")
+                    reask_message, reask_key = self._reask_request(batch[offset], options, detail)
+                    desc_frame = reasked_description(
+                        await self._cached_acall([system_message, reask_message], reask_key, f"il frame {i+offset+1}", semaphore, budget)
+                    )
+                    batch_descriptions[offset] = desc_frame
+                if not _needs_high_detail(desc_frame, options):
+                    escalated.append(False)
+                    continue
+                print(f"Frame {i+offset+1}: possibili anomalie, nuova analisi in alta definizione...")
+                escalation_message, escalation_key = self._escalation_request(batch[offset], desc_frame, options)
+                escalation_response = await self._cached_acall([system_message, escalation_message], escalation_key,
+                                                          f"il frame {i+offset+1}", semaphore, budget)
+                batch_descriptions[offset], used_high = _escalated_description(escalation_response, desc_frame)
+                escalated.append(used_high)
+            events = [
+                _frame_event(i + offset, desc_frame, batch[offset], detail, escalated[offset])
+                for offset, desc_frame in enumerate(batch_descriptions)
+            ]
+            return i, events, ai_response
+
+        pending = {
+            loop.create_task(describe(i, frames[i:i + batch_size]))
+            for i in range(0, len(frames), batch_size)
+        }
+        try:
+            while pending:
+                done, pending = loop.run_until_complete(asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED))
+                # Budget esaurito: prima si restituiscono le descrizioni già pronte (e pagate), poi ci si ferma
+                budget_errors = [task.exception() for task in done if isinstance(task.exception(), BudgetExceeded)]
+                for task in done:
+                    if isinstance(task.exception(), BudgetExceeded):
+                        continue
+                    i, events, ai_response = task.result()
+                    if ai_response is None:
+                        print(f"Frame {i+1}-{i+len(events)} già descritti in un tentativo precedente, ripresi dal checkpoint.")
+                    else:
+                        checkpoint.save(i, events, ai_response)
+                    for event in events:
+                        print(f"Descrizione frame {event['index']+1} estratta con successo.")
+                        yield event
+                if budget_errors:
+                    raise budget_errors[0]
+        finally:
+            # In caso di errore (o di client disconnesso) annulliamo le chiamate ancora in corso
+            for task in pending:
+                task.cancel()
+            if pending:
+                loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            loop.close()
+
+    def _summary_call(self, options: AnalysisOptions, budget: AnalysisBudget) -> Callable[[list], str]:
+        """
+        Chiamata solo testo usata per i riassunti, con la cache delle risposte se attiva.
+        """
+        def call(messages: list) -> str:
+            cache_key = None
+            if options.use_cache:
+                prompt = "\n".join(str(message.content) for message in messages)
+                cache_key = make_cache_key([], prompt, "summary", self.chat.model_name)
+            return self._cached_call(messages, cache_key, "il riassunto", budget)
+        return call
+
+    def _describe_segments(self, frames: List[ExtractedFrame], options: AnalysisOptions, system_message: "SystemMessage",
+                           segments: List[Tuple[int, int, int]], checkpoints: List[RunCheckpoint],
+                           budget: AnalysisBudget) -> Iterator[dict]:
+        """
+        Modalità "segments": ogni segmento è descritto da describe_frames_sequential in una propria conversazione
+        (al massimo options.max_concurrency segmenti contemporaneamente, sugli slot condivisi del backend) e poi
+        riassunto in una descrizione del suo intervallo. Produce gli eventi dei frame del segmento, con l'indice
+        del frame nel video (i frame di contesto sono già descritti dal segmento precedente), e un evento
+        "segment_summary" per segmento, nell'ordine in cui sono pronti.
+        """
+        results = queue.Queue()
+        stop = threading.Event()
+        summary_call = self._summary_call(options, budget)
+
+        def run_segment(segment: int, context_start: int, start: int, end: int) -> None:
+            try:
+                descriptions = []
+                for event in self.describe_frames_sequential(frames[context_start:end], options, [system_message],
+                                                         checkpoints[segment], budget):
+                    if stop.is_set():
+                        return
+                    index = context_start + event["index"]
+                    if index < start:
+                        continue
+                    timestamp = frames[index].timestamp
+                    descriptions.append(TimedText(timestamp, timestamp, event["descrizione_frame"]))
+                    results.put(dict(event, index=index))
+                segment_start, segment_end = frames[start].timestamp, frames[end - 1].timestamp
+                print(f"Riassunto del segmento {segment+1} di {len(segments)}...")
+                summary = summarize_hierarchically(summary_call, system_message, descriptions,
+                                                   partial_instruction(segment_start, segment_end),
+                                                   options.summary_fan_in).description
+                results.put({"event": "segment_summary", "segment": segment, "start": segment_start,
+                             "end": segment_end, "descrizione_segmento": summary})
+            except Exception as e:
+                results.put(e)
+            finally:
+                results.put(None)
+
+        executor = ThreadPoolExecutor(max_workers=max(1, options.max_concurrency), thread_name_prefix="video-segment")
+        for segment, (context_start, start, end) in enumerate(segments):
+            executor.submit(run_segment, segment, context_start, start, end)
+        remaining = len(segments)
+        try:
+            while remaining:
+                item = results.get()
+                if item is None:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            # In caso di errore (o di client disconnesso) i segmenti in corso si fermano al frame successivo
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _reconcile_window(self, frame_descriptions: List[str], reconciled: List[str], first: int, last: int,
+                          system_message: "SystemMessage", budget: AnalysisBudget) -> List[str]:
+        """
+        Riconcilia le descrizioni dei frame da first a last (esclusi), con le ultime descrizioni già riviste
+        della finestra precedente come solo contesto. Se la risposta non contiene una descrizione per ogni
+        frame della finestra si mantengono quelle originali della finestra.
+        """
+        from langchain_core.messages import HumanMessage
+
+        human_content = [
+            {"type": "text", "text": (
+                "Le descrizioni seguenti sono state prodotte in modo indipendente per ciascun frame del video, "
+                "in ordine temporale. Rivedile in modo che siano coerenti tra loro: indica i cambiamenti rispetto "
+                "ai frame precedenti, riferisciti agli stessi soggetti in modo uniforme ed evita ripetizioni, "
+                "senza aggiungere dettagli non presenti nelle descrizioni. Non generare analisi mediche. "
+                "Per ogni frame, nello stesso ordine, restituisci un blocco "
+                '<attribute=frame_description| {"indice_frame": <numero>, "descrizione_frame": "..."} | attribute=frame_description>'
+            )},
+        ]
+        context_start = max(0, first - RECONCILE_OVERLAP_FRAMES)
+        if context_start < first:
+            human_content.append({"type": "text", "text": (
+                "Descrizioni già riviste dei frame immediatamente precedenti, solo come contesto: non restituirle."
+            )})
+            for idx in range(context_start, first):
+                human_content.append({"type": "text", "text": f"Frame {idx+1} (già rivisto): {reconciled[idx]}"})
+        for idx in range(first, last):
+            human_content.append({"type": "text", "text": f"Descrizione frame {idx+1}: {frame_descriptions[idx]}"})
+
+        messages = [system_message, HumanMessage(content=human_content)]
+        budget.check()
+        start = time.monotonic()
+        response = self.chat(messages)
+        budget.record(messages, response, time.monotonic() - start)
+
+        window = parse_indexed_frame_descriptions(response.content, first + 1)
+        if any(idx + 1 not in window for idx in range(first, last)):
+            PARSE_FAILURES.labels(kind="reconcile").inc()
+            return frame_descriptions[first:last]
+        return [window[idx + 1] for idx in range(first, last)]
+
+    def _reconcile_descriptions(self, frame_descriptions: List[str], system_message: "SystemMessage",
+                                budget: AnalysisBudget) -> List[str]:
+        """
+        Passata di riconciliazione (solo testo) sulle descrizioni prodotte in modo indipendente:
+        il modello le rivede in ordine temporale per renderle coerenti tra loro. Le descrizioni sono
+        riviste a finestre di RECONCILE_WINDOW_FRAMES frame, così ogni risposta resta entro il limite di
+        token di output del modello; ogni finestra vede come contesto le ultime descrizioni già riviste.
+        """
+        reconciled = []
+        for first in range(0, len(frame_descriptions), RECONCILE_WINDOW_FRAMES):
+            last = min(first + RECONCILE_WINDOW_FRAMES, len(frame_descriptions))
+            reconciled.extend(self._reconcile_window(frame_descriptions, reconciled, first, last, system_message, budget))
+        return reconciled
+
+    def estimate_analysis_tokens(self, num_frames: int, options: AnalysisOptions) -> Tuple[int, int, int]:
+        """
+        Stima del costo di un'analisi di num_frames frame: (token per descrivere i frame, token della
+        descrizione finale, livelli di riassunto della descrizione finale). Tiene conto della storia inviata
+        a ogni chiamata; per la modalità "segments" usa la stima sequenziale, che è per eccesso.
+        """
+        system = len(self.system_prompt) // 4
+        image = _frame_image_budget_tokens(options)
+        description = ESTIMATED_DESCRIPTION_TOKENS
+        batch_size = max(1, options.frames_per_call)
+        frame_tokens = 0
+        history_tokens = 0
+        for call, first in enumerate(range(0, num_frames, batch_size)):
+            size = min(batch_size, num_frames - first)
+            request = system + ESTIMATED_INSTRUCTION_TOKENS + size * image
+            if options.analysis_mode != "parallel":
+                # Descrizioni precedenti allegate al messaggio e turni precedenti rispediti come storia
+                attached = MAX_PREVIOUS_DESCRIPTIONS
+                if options.history_mode != "full":
+                    attached = min(attached, options.history_turns * batch_size)
+                previous_text = min(first, max(0, attached)) * description
+                request += previous_text + history_tokens
+                if options.history_mode == "full":
+                    history_tokens += ESTIMATED_INSTRUCTION_TOKENS + previous_text + size * (image + description)
+                else:
+                    turns = min(call + 1, options.history_turns)
+                    image_turns = min(call + 1, options.history_image_window) if options.history_mode == "window" else 0
+                    history_tokens = (turns * (ESTIMATED_INSTRUCTION_TOKENS + batch_size * description)
+                                      + image_turns * batch_size * image)
+            frame_tokens += request + size * description
+        if options.analysis_mode == "parallel":
+            # Passata di riconciliazione a finestre: tutte le descrizioni in ingresso e in uscita, più il contesto
+            windows = math.ceil(num_frames / RECONCILE_WINDOW_FRAMES)
+            frame_tokens += (windows * (system + ESTIMATED_INSTRUCTION_TOKENS)
+                             + (2 * num_frames + max(0, windows - 1) * RECONCILE_OVERLAP_FRAMES) * description)
+
+        summary_tokens = 0
+        levels = 0
+        items = num_frames
+        fan_in = max(2, options.summary_fan_in)
+        while True:
+            calls = math.ceil(items / fan_in) if items > fan_in else 1
+            summary_tokens += items * description + calls * (system + ESTIMATED_INSTRUCTION_TOKENS + description)
+            levels += 1
+            if items <= fan_in:
+                break
+            items = calls
+        return frame_tokens, summary_tokens, levels
+
+    def budget_frame_limit(self, options: AnalysisOptions) -> Optional[int]:
+        """
+        Numero massimo di frame la cui analisi stimata rientra in max_tokens_budget (None senza budget di token).
+        """
+        if options.max_tokens_budget is None:
+            return None
+
+        def fits(num_frames: int) -> bool:
+            frame_tokens, summary_tokens, _ = self.estimate_analysis_tokens(num_frames, options)
+            return frame_tokens + summary_tokens <= options.max_tokens_budget
+
+        if not fits(1):
+            raise InvalidOptions(
+                f"max_tokens_budget insufficiente: la stima per un solo frame è di "
+                f"{sum(self.estimate_analysis_tokens(1, options)[:2])} token."
+            )
+        # Ricerca del massimo numero di frame che rientra nel budget (la stima cresce con i frame)
+        low, high = 1, 2
+        while high <= MAX_BUDGET_FRAMES and fits(high):
+            low, high = high, high * 2
+        while high - low > 1:
+            middle = (low + high) // 2
+            if fits(middle):
+                low = middle
+            else:
+                high = middle
+        return low
+
+    def _run_checkpoint(self, video_hash: str, options: AnalysisOptions) -> RunCheckpoint:
+        """
+        Checkpoint dell'analisi, identificato dal contenuto del video e dai parametri che influenzano il risultato.
+        """
+        if not options.resume:
+            return RunCheckpoint(None, None)
+        # Solo le opzioni di analisi: per le richieste VideoRequest il video è già identificato dal suo hash
+        params = {name: getattr(options, name) for name in AnalysisOptions.model_fields if name not in CHECKPOINT_NEUTRAL_OPTIONS}
+        # Le istruzioni aggiuntive delle interfacce cambiano le risposte (l'API non ne usa: chiavi invariate)
+        if self.instruction_suffix:
+            params["instruction_suffix"] = self.instruction_suffix
+        if self.frame_timestamps:
+            params["frame_timestamps"] = True
+        run_key = make_checkpoint_key(video_hash, params, self.system_prompt, self.chat.model_name)
+        return RunCheckpoint(get_checkpoint_store(), run_key)
+
+    def analyze_video_events(self, video_path: Optional[str], options: AnalysisOptions,
+                             frames: Optional[List[ExtractedFrame]] = None,
+                             video_hash: Optional[str] = None) -> Iterator[dict]:
+        """
+        Esegue l'analisi completa di un video già salvato su disco:
+        estrazione dei frame, descrizione frame per frame e descrizione finale.
+        Se `frames` è fornito (frame già estratti, ad esempio dal pool di processi, e `video_hash` del file)
+        l'estrazione viene saltata e `video_path` può essere None.
+        Generatore: produce un evento (dict con chiave "event") non appena ogni risultato è disponibile.
+        Se un budget della richiesta si esaurisce, la descrizione dei frame si ferma e la descrizione finale
+        viene costruita dai frame già descritti; l'evento "budget" riporta chiamate, token e tempo usati.
+        Solleva InvalidOptions, prima di ogni estrazione, se le opzioni non permettono l'analisi.
+        """
+        from langchain_core.messages import SystemMessage
+
+        if options.analysis_mode == "segments" and (options.segment_seconds <= 0 or options.segment_overlap_seconds < 0):
+            raise InvalidOptions("segment_seconds deve essere positivo e segment_overlap_seconds non negativo.")
+        budget = AnalysisBudget(options.max_tokens_budget, options.max_seconds)
+        frame_limit = self.budget_frame_limit(options)
+        if frame_limit is not None:
+            print(f"Budget di {options.max_tokens_budget} token: al massimo {frame_limit} frame.")
+        if frames is not None:
+            if frame_limit is not None and len(frames) > frame_limit:
+                # Frame già estratti: se ne tengono frame_limit equidistanti
+                frames = [frames[round(k * (len(frames) - 1) / max(1, frame_limit - 1))] for k in range(frame_limit)]
+        else:
+            # Estrazione dei frame con resize a width x height
+            frames = extract_frames(
+                video_path,
+                width=options.width,
+                height=options.height,
+                num_frames=options.num_frames,
+                frame_rate=options.frame_rate,
+                sampling=options.sampling,
+                min_frames=options.min_frames,
+                max_frames=options.max_frames,
+                read_strategy=options.read_strategy,
+                keep_aspect_ratio=options.keep_aspect_ratio,
+                max_image_tokens=options.max_image_tokens,
+                detail=resolve_detail(options.detail, options.max_image_tokens),
+                backend=options.extraction_backend,
+                ffmpeg_threads=options.ffmpeg_threads,
+                frame_limit=frame_limit
+            )
+        duplicate_frames = []
+        if options.dedup_threshold is not None:
+            frames, duplicate_frames = suppress_near_duplicates(frames, options.dedup_threshold)
+            print(f"{len(duplicate_frames)} frame quasi identici scartati, {len(frames)} frame da analizzare.")
+        checkpoint = self._run_checkpoint(video_hash or file_sha256(video_path), options)
+        resumed_frames = checkpoint.resumed_frames
+        segments, segment_checkpoints = [], []
+        if options.analysis_mode == "segments":
+            segments = _temporal_segments(frames, options.segment_seconds, options.segment_overlap_seconds)
+            segment_checkpoints = [checkpoint.segment(segment) for segment in range(len(segments))]
+            resumed_frames += sum(segment_checkpoint.resumed_frames for segment_checkpoint in segment_checkpoints)
+            print(f"{len(segments)} segmenti da analizzare in parallelo.")
+        if resumed_frames:
+            print(f"Ripresa dell'analisi dal checkpoint: {resumed_frames} frame già descritti.")
+        yield {
+            "event": "frames_extracted",
+            "num_frames": len(frames),
+            "frame_timestamps": [frame.timestamp for frame in frames],
+            "duplicate_frames": duplicate_frames,
+            "resumed_frames": resumed_frames,
+        }
+
+        print("Inizializzazione della conversazione con il modello...")
+        system_message = SystemMessage(content=self.system_prompt)
+        messages = [system_message]
+        frame_descriptions = [None] * len(frames)
+        segment_summaries = []
+        # Durante la descrizione dei frame il budget stimato per la descrizione finale resta riservato
+        _, summary_tokens, summary_levels = self.estimate_analysis_tokens(len(frames), options)
+        budget.reserve(summary_tokens, summary_levels)
+        budget_stop = None
+
+        try:
+            if options.analysis_mode == "segments":
+                for event in self._describe_segments(frames, options, system_message, segments, segment_checkpoints, budget):
+                    if event["event"] == "segment_summary":
+                        segment_summaries.append(event)
+                    else:
+                        frame_descriptions[event["index"]] = event["descrizione_frame"]
+                        FRAMES_ANALYZED.labels(source=self.source).inc()
+                    yield event
+            elif options.analysis_mode == "parallel":
+                for event in self._describe_frames_parallel(frames, options, system_message, checkpoint, budget):
+                    frame_descriptions[event["index"]] = event["descrizione_frame"]
+                    FRAMES_ANALYZED.labels(source=self.source).inc()
+                    yield event
+                if frame_descriptions:
+                    frame_descriptions = self._reconcile_descriptions(frame_descriptions, system_message, budget)
+                    yield {"event": "frames_reconciled", "frame_descriptions": frame_descriptions}
+            else:
+                for event in self.describe_frames_sequential(frames, options, messages, checkpoint, budget):
+                    frame_descriptions[event["index"]] = event["descrizione_frame"]
+                    FRAMES_ANALYZED.labels(source=self.source).inc()
+                    yield event
+        except BudgetExceeded as e:
+            budget_stop = e.reason
+            described = sum(1 for description in frame_descriptions if description is not None)
+            print(f"\n{e}: analisi interrotta dopo {described} frame descritti su {len(frames)}.")
+        budget.reserve(0, 0)
+
+        print("\nGenerazione della descrizione finale del video...")
+        # Descrizione finale solo testo, senza immagini né conversazione: dalle descrizioni dei frame con i loro
+        # timestamp o, in modalità "segments", dai riassunti dei segmenti; ridotte per livelli se sono troppe.
+        # Un'analisi interrotta dal budget usa le descrizioni dei frame completati
+        if segment_summaries and budget_stop is None:
+            segment_summaries.sort(key=lambda event: event["segment"])
+            items = [TimedText(event["start"], event["end"], event["descrizione_segmento"]) for event in segment_summaries]
+        else:
+            items = [TimedText(frame.timestamp, frame.timestamp, description)
+                     for frame, description in zip(frames, frame_descriptions) if description is not None]
+        final_description, anomaly_text = "", None
+        if items:
+            try:
+                summary = summarize_hierarchically(self._summary_call(options, budget), system_message, items,
+                                                   FINAL_INSTRUCTION + self.instruction_suffix, options.summary_fan_in,
+                                                   options.max_concurrency)
+                final_description = summary.description
+                # Blocco delle anomalie rilevate, se il modello lo ha incluso nella descrizione finale
+                anomaly_text = parse_reply(summary.reply).anomaly_text
+                print("Descrizione finale estratta con successo.")
+            except BudgetExceeded as e:
+                budget_stop = budget_stop or e.reason
+                print(f"{e}: descrizione finale non generata.")
+        if budget_stop is None:
+            # Analisi conclusa: il checkpoint non serve più (se interrotta, una nuova richiesta riprende da qui)
+            checkpoint.complete()
+
+        frame_tokens, summary_tokens, _ = self.estimate_analysis_tokens(len(frames), options)
+        yield {
+            "event": "budget",
+            **budget.usage(),
+            "estimated_tokens": frame_tokens + summary_tokens,
+            "frame_limit": frame_limit,
+            "stopped": budget_stop,
+        }
+        print("Processo completato con successo.")
+        yield {"event": "final_description", "descrizione_finale": final_description, "anomalie": anomaly_text}
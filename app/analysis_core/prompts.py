@@ -0,0 +1,33 @@
+"""
+Stile delle descrizioni e richieste aggiuntive, condivisi dalle interfacce Streamlit.
+
+Ogni interfaccia ha il proprio prompt di sistema di base (sorveglianza, timestamp, singola immagine):
+get_system_prompt vi aggiunge l'istruzione sulla lunghezza dello stile scelto, user_style_text
+il testo con stile e richieste aggiuntive da accodare all'istruzione di ogni richiesta.
+"""
+
+LENGTH_STYLES = ("sintetico", "normale", "dettagliato")
+
+LENGTH_INSTRUCTIONS = {
+    "sintetico": "Scegli uno stile SINTETICO: descrizione breve ed essenziale.",
+    "normale": "Scegli uno stile NORMALE: descrizione di lunghezza media e dettaglio moderato.",
+    "dettagliato": "Scegli uno stile DETTAGLIATO: descrizione più lunga, ricca di particolari.",
+}
+
+
+def get_length_instruction(length_style: str) -> str:
+    return LENGTH_INSTRUCTIONS.get(length_style.lower(), "Scegli uno stile NORMALE.")
+
+
+def get_system_prompt(base_prompt: str, length_style: str) -> str:
+    return base_prompt + "\n" + get_length_instruction(length_style)
+
+
+def user_style_text(length_style: str, additional_request: str = "") -> str:
+    """
+    Righe "Stile: ..." e, se presenti, "Richieste aggiuntive: ..." da accodare al testo di una richiesta.
+    """
+    text = f"\nStile: {length_style.upper()}"
+    if additional_request.strip():
+        text += f"\nRichieste aggiuntive: {additional_request.strip()}"
+    return text
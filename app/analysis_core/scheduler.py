@@ -0,0 +1,244 @@
+"""
+Scheduler delle chiamate al modello, condiviso da tutto il processo.
+
+Ogni chiamata passa da due token bucket, uno per le richieste al minuto (RPM) e uno per i token
+al minuto (TPM), così che richieste HTTP concorrenti, job e sessioni Streamlit rispettino insieme
+i limiti dell'account invece di saturarli e ricevere raffiche di 429. Gli errori transitori
+(429, 5xx, timeout, errori di connessione) vengono ritentati con backoff esponenziale con jitter;
+se il provider indica Retry-After, tutte le chiamate del processo attendono quel tempo.
+
+Configurazione tramite variabili d'ambiente:
+- VIDEO_ANALYSIS_RPM: richieste al minuto (0 = nessun limite; default del backend, 500 per OpenAI)
+- VIDEO_ANALYSIS_TPM: token al minuto (0 = nessun limite, il default di tutti i backend)
+- VIDEO_ANALYSIS_MAX_RETRIES: tentativi aggiuntivi per chiamata (default 5)
+- VIDEO_ANALYSIS_BACKOFF_BASE / VIDEO_ANALYSIS_BACKOFF_MAX: attesa iniziale e massima in secondi (default 1 / 60)
+"""
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from typing import Awaitable, Callable, Optional
+
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_BASE = 1.0
+DEFAULT_BACKOFF_MAX = 60.0
+
+# Stima dei token di un'immagine quando non se ne conosce la dimensione (un'immagine 512x512 in "high")
+IMAGE_TOKENS_ESTIMATE = {"low": 85, "high": 765, "auto": 765}
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+RETRYABLE_ERRORS = {"RateLimitError", "APITimeoutError", "APIConnectionError", "InternalServerError",
+                    "Timeout", "TimeoutError", "ConnectError", "ReadTimeout"}
+
+
+class TokenBucket:
+    """
+    Bucket con capacità pari al limite al minuto e ricarica continua.
+    reserve() preleva subito la quantità richiesta (il saldo può andare in negativo) e restituisce
+    quanto attendere: le chiamate successive ereditano il debito e vengono servite in ordine.
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= min(amount, self.capacity)
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def adjust(self, amount: float) -> None:
+        """
+        Corregge il prelievo una volta noto il consumo reale (amount positivo = token in più consumati).
+        """
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+
+def estimate_request_tokens(messages, max_output_tokens: int = 0) -> int:
+    """
+    Stima approssimativa dei token di una richiesta: circa 4 caratteri per token di testo,
+    costo tipico per ogni immagine, più i token di output riservati.
+    """
+    chars = 0
+    images = 0
+    for message in messages:
+        content = getattr(message, "content", message)
+        if isinstance(content, str):
+            chars += len(content)
+            continue
+        for part in content or []:
+            if isinstance(part, dict) and part.get("type") == "image_url":
+                detail = part.get("image_url", {}).get("detail", "auto")
+                images += IMAGE_TOKENS_ESTIMATE.get(detail, IMAGE_TOKENS_ESTIMATE["auto"])
+            elif isinstance(part, dict):
+                chars += len(part.get("text", ""))
+            else:
+                chars += len(json.dumps(part, default=str))
+    return chars // 4 + images + max_output_tokens
+
+
+def _usage_tokens(response) -> Optional[int]:
+    usage = getattr(response, "usage_metadata", None) or {}
+    return usage.get("total_tokens")
+
+
+def is_retryable(exc: Exception) -> bool:
+    status = getattr(exc, "status_code", None) or getattr(getattr(exc, "response", None), "status_code", None)
+    if status in RETRYABLE_STATUS:
+        return True
+    return any(cls.__name__ in RETRYABLE_ERRORS for cls in type(exc).__mro__)
+
+
+def retry_after_seconds(exc: Exception) -> Optional[float]:
+    """
+    Attesa indicata dal provider negli header della risposta (retry-after-ms o retry-after, in secondi).
+    """
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000.0
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        return None
+    return None
+
+
+class RateLimitScheduler:
+    """
+    Applica i limiti RPM/TPM e la politica di retry a ogni chiamata al modello.
+    """
+
+    def __init__(self, rpm: int = 0, tpm: int = 0, max_retries: int = DEFAULT_MAX_RETRIES,
+                 backoff_base: float = DEFAULT_BACKOFF_BASE, backoff_max: float = DEFAULT_BACKOFF_MAX,
+                 max_output_tokens: int = 0):
+        self.requests = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_output_tokens = max_output_tokens
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.throttled_seconds = 0.0
+
+    def _reserve(self, estimate: int) -> float:
+        wait = 0.0
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.reserve(estimate))
+        with self._lock:
+            wait = max(wait, self._paused_until - time.monotonic())
+            self.calls += 1
+            self.throttled_seconds += max(0.0, wait)
+        return max(0.0, wait)
+
+    def _refund(self, estimate: int) -> None:
+        # Una chiamata fallita non consuma i token stimati
+        if self.tokens is not None:
+            self.tokens.adjust(-estimate)
+
+    def _settle(self, estimate: int, response) -> None:
+        used = _usage_tokens(response)
+        if self.tokens is not None and used is not None:
+            self.tokens.adjust(used - estimate)
+
+    def _backoff(self, attempt: int, exc: Exception) -> float:
+        """
+        Attesa prima del prossimo tentativo: Retry-After se presente (e applicato a tutto il processo),
+        altrimenti backoff esponenziale con jitter completo.
+        """
+        retry_after = retry_after_seconds(exc)
+        with self._lock:
+            self.retries += 1
+            if retry_after is not None:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                return retry_after
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _give_up(self, attempt: int, exc: Exception) -> bool:
+        if attempt >= self.max_retries or not is_retryable(exc):
+            with self._lock:
+                self.failures += 1
+            return True
+        return False
+
+    def call(self, fn: Callable, messages):
+        """
+        Esegue fn() (chiamata sincrona al modello) rispettando limiti e retry.
+        """
+        estimate = estimate_request_tokens(messages, self.max_output_tokens)
+        for attempt in range(self.max_retries + 1):
+            time.sleep(self._reserve(estimate))
+            try:
+                response = fn()
+            except Exception as exc:
+                self._refund(estimate)
+                if self._give_up(attempt, exc):
+                    raise
+                delay = self._backoff(attempt, exc)
+                print(f"Chiamata al modello fallita ({type(exc).__name__}), nuovo tentativo tra {delay:.1f}s...")
+                time.sleep(delay)
+                continue
+            self._settle(estimate, response)
+            return response
+
+    async def acall(self, fn: Callable[[], Awaitable], messages):
+        """
+        Versione asincrona di call: fn() restituisce la coroutine della chiamata al modello.
+        """
+        estimate = estimate_request_tokens(messages, self.max_output_tokens)
+        for attempt in range(self.max_retries + 1):
+            await asyncio.sleep(self._reserve(estimate))
+            try:
+                response = await fn()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                self._refund(estimate)
+                if self._give_up(attempt, exc):
+                    raise
+                delay = self._backoff(attempt, exc)
+                print(f"Chiamata al modello fallita ({type(exc).__name__}), nuovo tentativo tra {delay:.1f}s...")
+                await asyncio.sleep(delay)
+                continue
+            self._settle(estimate, response)
+            return response
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "retries": self.retries,
+                "failures": self.failures,
+                "throttled_seconds": round(self.throttled_seconds, 3),
+            }
+
+
+def create_scheduler(default_rpm: int = 0, default_tpm: int = 0, max_output_tokens: int = 0) -> RateLimitScheduler:
+    """
+    Crea lo scheduler dalle variabili d'ambiente, con i limiti di default del backend.
+    """
+    return RateLimitScheduler(
+        rpm=int(os.getenv("VIDEO_ANALYSIS_RPM", str(default_rpm))),
+        tpm=int(os.getenv("VIDEO_ANALYSIS_TPM", str(default_tpm))),
+        max_retries=int(os.getenv("VIDEO_ANALYSIS_MAX_RETRIES", str(DEFAULT_MAX_RETRIES))),
+        backoff_base=float(os.getenv("VIDEO_ANALYSIS_BACKOFF_BASE", str(DEFAULT_BACKOFF_BASE))),
+        backoff_max=float(os.getenv("VIDEO_ANALYSIS_BACKOFF_MAX", str(DEFAULT_BACKOFF_MAX))),
+        max_output_tokens=max_output_tokens,
+    )
@@ -0,0 +1,127 @@
+"""
+Descrizione sequenziale dei frame in un'unica conversazione, condivisa dalle interfacce Streamlit.
+
+describe_frames_sequential usa la pipeline di analisi (VideoAnalyzer in pipeline.py): ogni frame è inviato
+con la sua istruzione, le descrizioni dei frame precedenti (al massimo MAX_PREVIOUS_DESCRIPTIONS, o quelle
+dei turni mantenuti nelle modalità compatte) e la storia della conversazione costruita con build_history.
+Una risposta non interpretabile viene richiesta di nuovo una sola volta; se anche la nuova risposta
+non rispetta il formato si usa il suo testo senza tag, così un solo frame non fa fallire l'analisi.
+
+`call` riceve la lista di messaggi e restituisce il testo della risposta del modello (ad esempio
+`lambda messages: chat(messages).content`), come in summarize.py.
+"""
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, List, NamedTuple, Sequence, Tuple
+
+from analysis_core.history import DEFAULT_HISTORY_TURNS, DEFAULT_IMAGE_WINDOW, MAX_PREVIOUS_DESCRIPTIONS
+from analysis_core.parsing import ReplyParseError, parse_frame_description, reask_instruction, strip_tags
+
+if TYPE_CHECKING:
+    from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+
+class FrameRequest(NamedTuple):
+    # Istruzione per il frame e data URL della sua immagine
+    text: str
+    image_url: str
+
+    # Dimensione dell'immagine non nota: la pipeline non stima i token immagine del frame
+    width = None
+    height = None
+
+    @property
+    def data_url(self) -> str:
+        return self.image_url
+
+
+class _TextCall:
+    """
+    Adatta `call` (messaggi -> testo della risposta) all'interfaccia del backend usata da VideoAnalyzer.
+    """
+    model_name = ""
+
+    def __init__(self, call: Callable[[List["BaseMessage"]], str]):
+        self.call = call
+
+    def __call__(self, messages: List["BaseMessage"]) -> "AIMessage":
+        from langchain_core.messages import AIMessage
+
+        return AIMessage(content=self.call(messages))
+
+
+def frame_message(text: str, image_url: str, previous_descriptions: Sequence[str],
+                  detail: str = "auto") -> "HumanMessage":
+    """
+    Messaggio utente di un frame: istruzione, descrizioni dei frame precedenti e immagine.
+    """
+    from langchain_core.messages import HumanMessage
+
+    human_content = [{"type": "text", "text": text}]
+    for idx, description in enumerate(previous_descriptions[-MAX_PREVIOUS_DESCRIPTIONS:]):
+        human_content.append({"type": "text", "text": f"Descrizione frame precedente {idx + 1}: {description}"})
+    human_content.append({"type": "image_url", "image_url": {"url": image_url, "detail": detail}})
+    return HumanMessage(content=human_content)
+
+
+def reask_reply(call: Callable[[List["BaseMessage"]], str], history: List["BaseMessage"],
+                human_message: "HumanMessage", ai_response: str, attribute: str) -> str:
+    """
+    Richiede di nuovo, una sola volta, il blocco `attribute` quando la risposta non è interpretabile.
+    """
+    from langchain_core.messages import AIMessage, HumanMessage
+
+    reask_message = HumanMessage(content=reask_instruction(attribute))
+    return call(history + [human_message, AIMessage(content=ai_response), reask_message])
+
+
+def reasked_description(ai_response: str) -> str:
+    """
+    Descrizione dalla risposta a una nuova richiesta; se neanche questa rispetta il formato
+    si usa il testo della risposta senza tag.
+    """
+    try:
+        return parse_frame_description(ai_response)
+    except ReplyParseError:
+        print("Anche la nuova risposta non rispetta il formato: uso il testo della risposta senza tag.")
+        return strip_tags(ai_response)
+
+
+def describe_frame(call: Callable[[List["BaseMessage"]], str], history: List["BaseMessage"],
+                   human_message: "HumanMessage") -> Tuple[str, str]:
+    """
+    Descrive un frame dopo la storia data. Restituisce (descrizione, risposta del modello da tenere nella storia).
+    """
+    ai_response = call(history + [human_message])
+    try:
+        return parse_frame_description(ai_response), ai_response
+    except ReplyParseError:
+        print("Risposta del modello non interpretabile per il frame, nuova richiesta...")
+        ai_response = reask_reply(call, history, human_message, ai_response, "frame_description")
+        return reasked_description(ai_response), ai_response
+
+
+def describe_frames_sequential(call: Callable[[List["BaseMessage"]], str], system_message: "BaseMessage",
+                               frames: Iterable[FrameRequest], history_mode: str = "full",
+                               history_image_window: int = DEFAULT_IMAGE_WINDOW,
+                               history_turns: int = DEFAULT_HISTORY_TURNS) -> Iterator[Tuple[int, str, str]]:
+    """
+    Descrive i frame uno dopo l'altro nella stessa conversazione e produce (indice, descrizione, risposta
+    del modello) appena ogni descrizione è pronta. `frames` può essere un generatore (ad esempio i frame di uno
+    stream che arrivano man mano): il frame successivo viene chiesto solo dopo aver descritto il precedente.
+    """
+    # Import locale: pipeline.py importa questo modulo
+    from analysis_core.budget import AnalysisBudget
+    from analysis_core.checkpoints import RunCheckpoint
+    from analysis_core.pipeline import AnalysisOptions, VideoAnalyzer
+
+    class RequestAnalyzer(VideoAnalyzer):
+        def frame_text(self, text: str, batch: list) -> str:
+            # Istruzione scelta dall'interfaccia per il frame
+            return batch[0].text
+
+    analyzer = RequestAnalyzer(_TextCall(call), system_message.content)
+    # La cache è già gestita da `call` (cached_call); nessun checkpoint né budget
+    options = AnalysisOptions(history_mode=history_mode, history_turns=history_turns,
+                              history_image_window=history_image_window, use_cache=False, resume=False)
+    messages = [system_message]
+    for event in analyzer.describe_frames_sequential(frames, options, messages, RunCheckpoint(None, None),
+                                                     AnalysisBudget()):
+        yield event["index"], event["descrizione_frame"], messages[-1].content
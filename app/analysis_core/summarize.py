@@ -0,0 +1,111 @@
+"""
+Riassunto gerarchico, solo testo, di descrizioni ordinate nel tempo.
+
+Ogni elemento è un intervallo del video (inizio e fine in secondi, coincidenti per un singolo frame)
+con la sua descrizione. Se gli elementi sono al massimo `fan_in` basta una chiamata al modello;
+altrimenti vengono raggruppati in blocchi consecutivi di `fan_in`, ogni blocco viene riassunto in
+una descrizione del suo intervallo e si ripete sui riassunti finché ne restano al massimo `fan_in`.
+I blocchi dello stesso livello sono indipendenti e vengono riassunti in parallelo.
+Al modello non viene inviata nessuna immagine.
+
+Usato per la descrizione finale in tutte le modalità di analisi (API e interfaccia Streamlit) e
+per i riassunti dei segmenti: la descrizione finale non rispedisce più la conversazione con le
+immagini dei frame, ma solo le descrizioni con i loro timestamp.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, List, NamedTuple
+
+from analysis_core.frames import format_timestamp
+from analysis_core.parsing import ReplyParseError, parse_final_description, reask_instruction, strip_tags
+
+if TYPE_CHECKING:
+    from langchain_core.messages import BaseMessage
+
+DEFAULT_FAN_IN = 20
+
+FINAL_INSTRUCTION = (
+    "Le descrizioni seguenti coprono, in ordine temporale, l'intero video. Genera la descrizione finale "
+    "del video basandoti su di esse. Non analisi mediche, ma solo qualitative ed estetiche. "
+    "Fornisci la descrizione finale racchiusa nei tag richiesti."
+)
+
+
+class TimedText(NamedTuple):
+    start: float
+    end: float
+    text: str
+
+
+class Summary(NamedTuple):
+    # Descrizione estratta e risposta completa del modello (che può contenere altri blocchi, ad esempio anomaly)
+    description: str
+    reply: str
+
+
+def format_interval(start: float, end: float) -> str:
+    if start == end:
+        return format_timestamp(start)
+    return f"{format_timestamp(start)}-{format_timestamp(end)}"
+
+
+def partial_instruction(start: float, end: float) -> str:
+    """
+    Istruzione per riassumere un tratto del video (un blocco intermedio o un segmento).
+    """
+    return (
+        f"Le descrizioni seguenti si riferiscono, in ordine temporale, al tratto del video {format_interval(start, end)}. "
+        "Riassumile in un'unica descrizione del tratto, in ordine cronologico, mantenendo gli eventi rilevanti "
+        "e i cambiamenti, senza aggiungere dettagli non presenti nelle descrizioni. Non generare analisi mediche. "
+        "Fornisci il riassunto racchiuso nei tag della descrizione finale."
+    )
+
+
+def summarize_group(call: Callable[[List["BaseMessage"]], str], system_message: "BaseMessage",
+                    items: List[TimedText], instruction: str) -> Summary:
+    """
+    Una chiamata al modello sulle descrizioni del gruppo; se la risposta non è interpretabile viene
+    richiesta una sola volta di nuovo, e se neanche questa lo è si usa il testo della risposta senza tag.
+    """
+    from langchain_core.messages import AIMessage, HumanMessage
+
+    lines = [f"[{format_interval(item.start, item.end)}] {item.text}" for item in items]
+    human_message = HumanMessage(content=instruction + "\n\n" + "\n".join(lines))
+    reply = call([system_message, human_message])
+    try:
+        return Summary(parse_final_description(reply), reply)
+    except ReplyParseError:
+        print("Riassunto non interpretabile, nuova richiesta al modello...")
+        reask_message = HumanMessage(content=reask_instruction("final_description"))
+        reply = call([system_message, human_message, AIMessage(content=reply), reask_message])
+        try:
+            return Summary(parse_final_description(reply), reply)
+        except ReplyParseError:
+            print("Anche il nuovo riassunto non rispetta il formato: uso il testo della risposta senza tag.")
+            return Summary(strip_tags(reply), reply)
+
+
+def summarize_hierarchically(call: Callable[[List["BaseMessage"]], str], system_message: "BaseMessage",
+                             items: List[TimedText], instruction: str, fan_in: int = DEFAULT_FAN_IN,
+                             max_workers: int = 1) -> Summary:
+    """
+    Riassume gli elementi (in ordine temporale) con l'istruzione data, passando per riassunti
+    intermedi se sono più di `fan_in`. `call` riceve i messaggi e restituisce il testo della risposta.
+    """
+    if not items:
+        raise ValueError("Nessuna descrizione da riassumere.")
+    fan_in = max(2, fan_in)
+
+    def reduce_block(block: List[TimedText]) -> TimedText:
+        if len(block) == 1:
+            return block[0]
+        start, end = block[0].start, block[-1].end
+        summary = summarize_group(call, system_message, block, partial_instruction(start, end))
+        return TimedText(start, end, summary.description)
+
+    level = list(items)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="video-summary") as executor:
+        while len(level) > fan_in:
+            blocks = [level[k:k + fan_in] for k in range(0, len(level), fan_in)]
+            print(f"Riassunto intermedio di {len(level)} descrizioni in {len(blocks)} blocchi...")
+            level = list(executor.map(reduce_block, blocks))
+    return summarize_group(call, system_message, level, instruction)
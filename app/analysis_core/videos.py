@@ -0,0 +1,67 @@
+"""
+File temporanei dei video ricevuti, condivisi tra API e interfacce Streamlit.
+
+Ogni video è scritto in una propria directory temporanea, rimossa con cleanup_video a fine analisi.
+La scrittura avviene a blocchi di UPLOAD_CHUNK_SIZE, così la memoria occupata resta limitata anche
+per registrazioni da 500 MB-2 GB.
+"""
+import base64
+import binascii
+import os
+import shutil
+import tempfile
+import uuid
+
+from analysis_core.metrics import time_stage
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def new_video_path() -> str:
+    tmp_dir = tempfile.mkdtemp()
+    return os.path.join(tmp_dir, f"{uuid.uuid4()}.mp4")
+
+
+def cleanup_video(video_path: str) -> None:
+    """
+    Rimuove la directory temporanea che contiene il video salvato.
+    """
+    shutil.rmtree(os.path.dirname(video_path), ignore_errors=True)
+
+
+@time_stage("decode")
+def decode_base64_video(video_base64: str) -> str:
+    """
+    Decodifica il video base64 e lo salva in un file temporaneo.
+    La decodifica avviene a blocchi, senza mai tenere in memoria l'intero video decodificato.
+    Restituisce il percorso del file video.
+    """
+    print("Decodifica del video in base64...")
+    video_path = new_video_path()
+    # Il blocco deve essere multiplo di 4 caratteri per poter essere decodificato da solo
+    chunk_chars = (UPLOAD_CHUNK_SIZE // 3) * 4
+    carry = ""
+    with open(video_path, "wb") as f:
+        for start in range(0, len(video_base64), chunk_chars):
+            chunk = carry + "".join(video_base64[start:start + chunk_chars].split())
+            usable = len(chunk) - (len(chunk) % 4)
+            carry = chunk[usable:]
+            if usable:
+                f.write(binascii.a2b_base64(chunk[:usable]))
+        if carry:
+            # Residuo senza padding: lo completiamo come farebbe base64.b64decode
+            f.write(base64.b64decode(carry + "=" * (-len(carry) % 4)))
+    print(f"Video salvato in: {video_path}")
+    return video_path
+
+
+@time_stage("decode")
+def save_video_bytes(video_data: bytes) -> str:
+    """
+    Salva in un file temporaneo un video già in memoria (ad esempio caricato da Streamlit),
+    senza passare dal base64. Restituisce il percorso del file video.
+    """
+    video_path = new_video_path()
+    with open(video_path, "wb") as f:
+        f.write(video_data)
+    return video_path
@@ -1,22 +1,28 @@
 import os
 import re
+import threading
 import time
 import random
-import base64
-import uuid
-import tempfile
 from typing import List, Optional
 import json
 
-import numpy as np
-import cv2
 import streamlit as st
 import streamlit.components.v1 as components
 
-# LangChain e AI
-from langchain_openai import ChatOpenAI
-from langchain.schema.messages import SystemMessage, HumanMessage
-from langchain_core.messages import AIMessage
+from analysis_core.backend import get_chat_backend
+from analysis_core.budget import BudgetExceeded
+from analysis_core.cache import get_response_cache, make_cache_key
+from analysis_core.extraction_pool import extract_videos_in_order
+from analysis_core.frames import (DEFAULT_MAX_FRAMES, DEFAULT_MIN_FRAMES, EXTRACTION_BACKENDS, ExtractedFrame,
+                                  format_timestamp, jpeg_data_url, resize_image)
+from analysis_core.metrics import FRAMES_ANALYZED, start_metrics_server
+from analysis_core.parsing import ReplyParseError, parse_frame_description, parse_reply
+from analysis_core.image_tokens import DETAIL_LEVELS, resolve_detail
+from analysis_core.history import HISTORY_MODES, DEFAULT_HISTORY_TURNS, DEFAULT_IMAGE_WINDOW
+from analysis_core.pipeline import MAX_CONCURRENCY, AnalysisOptions, VideoAnalyzer
+from analysis_core.prompts import get_system_prompt, user_style_text
+from analysis_core.sequential import frame_message, reask_reply
+from analysis_core.videos import cleanup_video, save_video_bytes
 
 ############################################
 # IMPORTA LE FUNZIONI DEL NUOVO SCRIPT:
@@ -92,71 +98,15 @@ Ad ogni chiamata riceverai:
 Ricorda: **Non ripetere** le descrizioni dei frame precedenti, ma fanne tesoro per dare continuità e coerenza alle osservazioni.
 """
 
-def get_length_instruction(length_style: str) -> str:
-    if length_style.lower() == "sintetico":
-        return "Scegli uno stile SINTETICO: descrizione breve ed essenziale."
-    elif length_style.lower() == "normale":
-        return "Scegli uno stile NORMALE: descrizione di lunghezza media e dettaglio moderato."
-    elif length_style.lower() == "dettagliato":
-        return "Scegli uno stile DETTAGLIATO: descrizione più lunga, ricca di particolari."
-    else:
-        return "Scegli uno stile NORMALE."
-
-def get_system_prompt(length_style: str) -> str:
-    length_instruction = get_length_instruction(length_style)
-    return BASE_SYSTEM_PROMPT + "\n" + length_instruction
-
-OPENAI_API_KEY = "..."
-chat = ChatOpenAI(model="gpt-4o", temperature=0.25, max_tokens=2048, openai_api_key=OPENAI_API_KEY)
+# Backend, modello e chiave API si configurano con le variabili d'ambiente (vedi analysis_core/backend.py)
+chat = get_chat_backend()
+# Con VIDEO_ANALYSIS_METRICS_PORT impostata le metriche Prometheus di questa sessione sono esposte su quella porta
+start_metrics_server()
 
 
 ################################################################################
 # FUNZIONI DI ESTRAZIONE FRAME / ANALISI
 ################################################################################
-def decode_base64_video(video_base64: str) -> str:
-    video_data = base64.b64decode(video_base64)
-    tmp_dir = tempfile.mkdtemp()
-    video_path = os.path.join(tmp_dir, f"{uuid.uuid4()}.mp4")
-    with open(video_path, "wb") as f:
-        f.write(video_data)
-    return video_path
-
-def extract_frames(video_path: str, width: int, height: int,
-                   num_frames: Optional[int] = None,
-                   frame_rate: Optional[int] = None) -> List[str]:
-    cap = cv2.VideoCapture(video_path)
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    fps = cap.get(cv2.CAP_PROP_FPS)
-
-    if num_frames is not None and num_frames > 0:
-        frame_indices = [int(i * total_frames / num_frames) for i in range(num_frames)]
-    elif frame_rate is not None and frame_rate > 0:
-        frame_step = int(fps / frame_rate) if frame_rate <= fps else 1
-        frame_indices = list(range(0, total_frames, frame_step))
-    else:
-        # Default: 5 frame
-        num_frames = 5
-        frame_indices = [int(i * total_frames / num_frames) for i in range(num_frames)]
-
-    frame_paths = []
-    for i, idx in enumerate(frame_indices):
-        cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
-        ret, frame = cap.read()
-        if not ret:
-            break
-        resized_frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
-        tmp_dir = tempfile.mkdtemp()
-        frame_path = os.path.join(tmp_dir, f"frame_{i}.jpg")
-        cv2.imwrite(frame_path, resized_frame)
-        frame_paths.append(frame_path)
-    cap.release()
-    return frame_paths
-
-def image_to_base64(image_path: str) -> str:
-    with open(image_path, "rb") as f:
-        return "data:image/jpeg;base64," + base64.b64encode(f.read()).decode("utf-8")
-
-
 ######################
 # ANALISI IMMAGINI
 ######################
@@ -167,6 +117,7 @@ def analyze_image_generator(
     length_style: str,
     additional_request: str
 ):
+    from langchain_core.messages import SystemMessage
 
 
 
@@ -196,82 +147,53 @@ def analyze_image_generator(
 
 
     yield "Analisi dell'immagine..."
-    nparr = np.frombuffer(image_data, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    if img is None:
+    try:
+        img_b64 = jpeg_data_url(resize_image(image_data, width, height))
+    except ValueError:
         yield "Errore nel decodificare l'immagine."
-        raise ValueError("Impossibile decodificare l'immagine.")
-    resized_img = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
-    tmp_dir = tempfile.mkdtemp()
-    image_path = os.path.join(tmp_dir, f"{uuid.uuid4()}.jpg")
-    cv2.imwrite(image_path, resized_img)
-    img_b64 = image_to_base64(image_path)
-
-    system_prompt = get_system_prompt(length_style)
+        raise
+
+    system_prompt = get_system_prompt(BASE_SYSTEM_PROMPT, length_style)
     system_message = SystemMessage(content=system_prompt)
     messages = [system_message]
 
-    additional_req_text = ""
-    if additional_request.strip():
-        additional_req_text = f"Richieste aggiuntive: {additional_request.strip()}"
-
-    image_user_text = "Analizza l'immagine seguente."
-    image_user_text += f"\nStile: {length_style.upper()}"
-    if additional_req_text:
-        image_user_text += f"\n{additional_req_text}"
-
-    human_content = [
-        {"type": "text", "text": image_user_text},
-        {"type": "image_url", "image_url": {"url": img_b64, "detail": "auto"}}
-    ]
-    human_message = HumanMessage(content=human_content)
-    response = chat(messages + [human_message])
-    ai_response = response.content
-
-    start_tag = "<attribute=frame_description|"
-    end_tag = "| attribute=frame_description>"
-    start_idx = ai_response.find(start_tag)
-    end_idx = ai_response.find(end_tag)
-    if start_idx == -1 or end_idx == -1:
-        yield "Errore nella formattazione della risposta del modello per l'immagine."
-        raise ValueError("Formato non corretto nella risposta del modello per l'immagine.")
-    json_str = ai_response[start_idx + len(start_tag):end_idx].strip()
+    image_user_text = "Analizza l'immagine seguente." + user_style_text(length_style, additional_request)
+    human_message = frame_message(image_user_text, img_b64, [])
+    cache_key = make_cache_key([img_b64], system_prompt + "\n" + image_user_text, length_style, chat.model_name)
+    ai_response = get_response_cache().get(cache_key)
+    from_cache = ai_response is not None
+    if from_cache:
+        yield "Risposta trovata in cache, nessuna chiamata al modello."
+    else:
+        response = chat(messages + [human_message])
+        ai_response = response.content
 
     try:
-        desc_dict = json.loads(json_str)
-        image_description = desc_dict.get("descrizione_frame", "")
-
+        image_description = parse_frame_description(ai_response)
+    except ReplyParseError:
+        yield "Risposta del modello non interpretabile per l'immagine, nuova richiesta..."
+        from_cache = False
+        ai_response = reask_reply(lambda m: chat(m).content, messages, human_message, ai_response, "frame_description")
+        try:
+            image_description = parse_frame_description(ai_response)
+        except ReplyParseError:
+            yield "Errore nella formattazione della risposta del modello per l'immagine."
+            raise
 
+    if not from_cache:
+        get_response_cache().set(cache_key, ai_response)
 
         # Dopo aver elaborato il frame, incrementa il contatore e salva il file
+        # (le risposte dalla cache non consumano il limite di frame)
         counter_data["CONTATORE"] += 1
         with open(counter_file, "w", encoding="utf-8") as f:
             json.dump(counter_data, f)
 
-
-
-    except:
-        yield "Errore nel parsing del JSON per la descrizione dell'immagine."
-        raise ValueError("Errore nel parsing del JSON per l'immagine.")
-
+    FRAMES_ANALYZED.labels(source="ui").inc()
     yield f"Descrizione immagine: {image_description}"
     yield f"Descrizione finale dell'immagine: {image_description}"
 
-    # Dopo aver ottenuto 'final_text' e prima del return, aggiungi:
-    anomaly_start_tag = "<attribute=anomaly|"
-    anomaly_end_tag = "| attribute=anomaly>"
-    anomaly_start_idx = ai_response.find(anomaly_start_tag)
-    anomaly_end_idx = ai_response.find(anomaly_end_tag)
-    anomaly_text = None
-    if anomaly_start_idx != -1 and anomaly_end_idx != -1:
-        anomaly_json_str = ai_response[anomaly_start_idx + len(anomaly_start_tag):anomaly_end_idx].strip()
-        try:
-            #anomaly_dict = json.loads(anomaly_json_str)
-            anomaly_text = str(anomaly_json_str)  # json.dump(anomaly_dict, indent=2)
-
-        except Exception as e:
-            yield "Errore nel parsing del JSON per l'anomalia."
-            raise ValueError("Errore nel parsing del JSON per l'anomalia.")
+    anomaly_text = parse_reply(ai_response).anomaly_text
     if anomaly_text:
         yield f"Anomalia: {anomaly_text}"
 
@@ -281,15 +203,101 @@ def analyze_image_generator(
 ######################
 # ANALISI VIDEO
 ######################
+def video_extraction_options(
+    num_frames: Optional[int],
+    frame_rate: Optional[int],
+    width: int,
+    height: int,
+    sampling: str = "uniform",
+    max_frames: int = DEFAULT_MAX_FRAMES,
+    keep_aspect_ratio: bool = False,
+    max_image_tokens: Optional[int] = None,
+    detail: str = "auto",
+    extraction_backend: str = "opencv"
+) -> dict:
+    """
+    Argomenti di extract_frames per i parametri scelti nell'interfaccia.
+    """
+    return dict(
+        width=width,
+        height=height,
+        num_frames=num_frames if frame_rate == 0 else None,
+        frame_rate=frame_rate if frame_rate > 0 else None,
+        sampling=sampling,
+        min_frames=min(DEFAULT_MIN_FRAMES, max_frames),
+        max_frames=max_frames,
+        keep_aspect_ratio=keep_aspect_ratio,
+        max_image_tokens=max_image_tokens,
+        detail=resolve_detail(detail, max_image_tokens),
+        backend=extraction_backend
+    )
+
+
+class _FrameQuotaChat:
+    """
+    Backend del modello con il limite di frame dell'interfaccia (CONTATORE e MAX_FRAMES in `counter_file`):
+    ogni chiamata al modello consuma un frame, le risposte trovate in cache no. Raggiunto il limite solleva
+    BudgetExceeded("frames"): la pipeline si ferma come con gli altri budget dell'analisi.
+    """
+
+    def __init__(self, chat, counter_file: str):
+        self.chat = chat
+        self.counter_file = counter_file
+        self.model_name = chat.model_name
+        self._lock = threading.Lock()
+
+    def _consume_frame(self) -> None:
+        with self._lock:
+            # Il contatore viene riletto a ogni chiamata (in caso di aggiornamenti esterni)
+            with open(self.counter_file, "r", encoding="utf-8") as f:
+                counter_data = json.load(f)
+            if counter_data["CONTATORE"] >= counter_data["MAX_FRAMES"]:
+                raise BudgetExceeded("frames")
+            counter_data["CONTATORE"] += 1
+            with open(self.counter_file, "w", encoding="utf-8") as f:
+                json.dump(counter_data, f)
+
+    def __call__(self, messages):
+        self._consume_frame()
+        return self.chat(messages)
+
+    async def ainvoke(self, messages):
+        self._consume_frame()
+        return await self.chat.ainvoke(messages)
+
+
 def analyze_video_generator(
-    video_data: bytes,
+    video_data: Optional[bytes],
     num_frames: Optional[int],
     frame_rate: Optional[int],
     width: int,
     height: int,
     length_style: str,
-    additional_request: str
+    additional_request: str,
+    history_mode: str = "full",
+    history_turns: int = DEFAULT_HISTORY_TURNS,
+    history_image_window: int = DEFAULT_IMAGE_WINDOW,
+    dedup_threshold: int = 0,
+    sampling: str = "uniform",
+    max_frames: int = DEFAULT_MAX_FRAMES,
+    keep_aspect_ratio: bool = False,
+    max_image_tokens: Optional[int] = None,
+    detail: str = "auto",
+    resume: bool = True,
+    extraction_backend: str = "opencv",
+    frames: Optional[List[ExtractedFrame]] = None,
+    video_hash: Optional[str] = None,
+    analysis_mode: str = "sequential",
+    max_concurrency: int = MAX_CONCURRENCY,
+    frames_per_call: int = 1,
+    escalate_detail: bool = False,
+    max_tokens_budget: Optional[int] = None
 ):
+    """
+    Analisi di un video con la pipeline dell'API (VideoAnalyzer), con un messaggio di avanzamento per ogni passo.
+    Se `frames` è fornito (frame già estratti, ad esempio dal pool di processi, e `video_hash`
+    del file) decodifica ed estrazione vengono saltate e `video_data` può essere None.
+    """
 
 
 
@@ -312,162 +320,88 @@ def analyze_video_generator(
 
 
 
-    yield "Decodifica del video..."
-    video_base64 = base64.b64encode(video_data).decode('utf-8')
-    video_path = decode_base64_video(video_base64)
-    yield "Estrazione dei frame..."
-    frame_paths = extract_frames(
-        video_path,
+    options = AnalysisOptions(
+        num_frames=num_frames if frame_rate == 0 else None,
+        frame_rate=frame_rate if frame_rate > 0 else None,
         width=width,
         height=height,
-        num_frames=num_frames if frame_rate == 0 else None,
-        frame_rate=frame_rate if frame_rate > 0 else None
+        sampling=sampling,
+        min_frames=min(DEFAULT_MIN_FRAMES, max_frames),
+        max_frames=max_frames,
+        keep_aspect_ratio=keep_aspect_ratio,
+        max_image_tokens=max_image_tokens,
+        detail=detail,
+        escalate_detail=escalate_detail,
+        extraction_backend=extraction_backend,
+        history_mode=history_mode,
+        history_turns=history_turns,
+        history_image_window=history_image_window,
+        analysis_mode=analysis_mode,
+        max_concurrency=max_concurrency,
+        frames_per_call=frames_per_call,
+        dedup_threshold=dedup_threshold or None,
+        resume=resume,
+        max_tokens_budget=max_tokens_budget
+    )
+    # Stile e richieste aggiuntive, accodati ai prompt dei frame e della descrizione finale;
+    # ogni frame è inviato con il suo timestamp
+    analyzer = VideoAnalyzer(
+        _FrameQuotaChat(chat, counter_file),
+        get_system_prompt(BASE_SYSTEM_PROMPT, length_style),
+        instruction_suffix=(" IMPORTANTE: menziona eventuali riferimenti a timestamp in descrizione se ci sono eventi."
+                            + user_style_text(length_style, additional_request)),
+        frame_timestamps=True,
+        source="ui"
     )
-    yield f"{len(frame_paths)} frame estratti."
-
-    system_prompt = get_system_prompt(length_style)
-    system_message = SystemMessage(content=system_prompt)
-    messages = [system_message]
-    frame_descriptions = []
-
-    additional_req_text = ""
-    if additional_request.strip():
-        additional_req_text = f"Richieste aggiuntive: {additional_request.strip()}"
-
-    cap = cv2.VideoCapture(video_path)
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    cap.release()
-
-    for i, frame_path in enumerate(frame_paths):
-
-        # Ricarica il contatore all'inizio di ogni iterazione (in caso di aggiornamenti esterni)
-        with open(counter_file, "r", encoding="utf-8") as f:
-            counter_data = json.load(f)
-        if counter_data["CONTATORE"] >= counter_data["MAX_FRAMES"]:
-            yield "Numero massimo di frame raggiunto. Interrompo l'analisi dei frame."
-            return
-
-        yield f"Analisi del frame {i + 1}/{len(frame_paths)}..."
-        # Calcolo indice e timestamp
-        if num_frames and num_frames > 0:
-            original_index = int(i * total_frames / num_frames)
-        elif frame_rate and frame_rate > 0:
-            frame_step = int(fps / frame_rate) if frame_rate <= fps else 1
-            original_index = i * frame_step
-        else:
-            original_index = i
-
-        timestamp_seconds = original_index / fps if fps > 0 else 0
-        hh = int(timestamp_seconds // 3600)
-        mm = int((timestamp_seconds % 3600) // 60)
-        ss = int(timestamp_seconds % 60)
-        timestamp_str = f"{hh:02d}:{mm:02d}:{ss:02d}"
-
-        frame_b64 = image_to_base64(frame_path)
-        prev_descs_limited = frame_descriptions[-100:]
-        frame_user_text = (f"Timestamp: {timestamp_str} - Analizza il frame seguente. "
-                           "Tieni conto delle descrizioni precedenti. "
-                           "IMPORTANTE: menziona eventuali riferimenti a timestamp in descrizione se ci sono eventi.")
-        frame_user_text += f"\nStile: {length_style.upper()}"
-        if additional_req_text:
-            frame_user_text += f"\n{additional_req_text}"
-
-        human_content = [{"type": "text", "text": frame_user_text}]
-        for idx, d in enumerate(prev_descs_limited):
-            human_content.append({"type": "text", "text": f"Descrizione frame precedente {idx + 1}: {d}"})
-        human_content.append({"type": "image_url", "image_url": {"url": frame_b64, "detail": "auto"}})
-
-        human_message = HumanMessage(content=human_content)
-        response = chat(messages + [human_message])
-        ai_response = response.content
-
-        start_tag = "<attribute=frame_description|"
-        end_tag = "| attribute=frame_description>"
-        start_idx = ai_response.find(start_tag)
-        end_idx = ai_response.find(end_tag)
-        if start_idx == -1 or end_idx == -1:
-            yield "Errore nella formattazione della risposta del modello per il frame."
-            raise ValueError("Formato non corretto nella risposta del modello.")
-        json_str = ai_response[start_idx + len(start_tag):end_idx].strip()
-
-        try:
-            desc_dict = json.loads(json_str)
-            desc_frame = desc_dict.get("descrizione_frame", "")
-
-
-            # Dopo aver elaborato il frame, incrementa il contatore e salva il file
-            counter_data["CONTATORE"] += 1
-            with open(counter_file, "w", encoding="utf-8") as f:
-                json.dump(counter_data, f)
 
+    video_path = None
+    if frames is None:
+        yield "Decodifica del video..."
+        video_path = save_video_bytes(video_data)
+        yield "Estrazione dei frame..."
 
-        except:
-            yield "Errore nel parsing del JSON per la descrizione del frame."
-            raise ValueError("Errore nel parsing del JSON per il frame.")
-
-        frame_descriptions.append(desc_frame)
-        messages.append(human_message)
-        messages.append(AIMessage(content=ai_response))
-        yield f"Descrizione frame {i + 1}: {desc_frame}"
-
-    yield "Generazione descrizione finale del video..."
-    final_user_text = ("Genera la descrizione finale del video basandoti sulle descrizioni dei frame precedenti. "
-                       "IMPORTANTE: menziona i timestamp se ci sono stati eventi rilevanti.\n")
-    final_user_text += f"Stile: {length_style.upper()}"
-    if additional_req_text:
-        final_user_text += f"\n{additional_req_text}"
-    final_user_text += "\nFornisci la descrizione finale racchiusa nei tag richiesti."
-
-    final_human_content = [{"type": "text", "text": final_user_text}]
-    for idx, d in enumerate(frame_descriptions):
-        final_human_content.append({"type": "text", "text": f"Descrizione frame {idx + 1}: {d}"})
-    final_human_message = HumanMessage(content=final_human_content)
-    final_response = chat(messages + [final_human_message])
-    final_text = final_response.content
-
-    final_start_tag = "<attribute=final_description|"
-    final_end_tag = "| attribute=final_description>"
-    fs_idx = final_text.find(final_start_tag)
-    fe_idx = final_text.find(final_end_tag)
-    if fs_idx == -1 or fe_idx == -1:
-        yield "Errore nella formattazione della descrizione finale."
-        raise ValueError("La risposta del modello non contiene la descrizione finale formattata correttamente.")
-    final_json_str = final_text[fs_idx + len(final_start_tag):fe_idx].strip()
+    frame_descriptions = []
+    final_description = ""
+    image_tokens_total = 0
     try:
-        final_desc_dict = json.loads(final_json_str)
-        final_description = final_desc_dict.get("descrizione_finale", "")
-
-
-        # Dopo aver elaborato il frame, incrementa il contatore e salva il file
-        counter_data["CONTATORE"] += 1
-        with open(counter_file, "w", encoding="utf-8") as f:
-            json.dump(counter_data, f)
-
-
-    except:
-        yield "Errore nel parsing del JSON per la descrizione finale."
-        raise ValueError("Errore nel parsing del JSON per la descrizione finale.")
-
-    yield f"Descrizione finale del video: {final_description}"
-
-
-    # Dopo aver ottenuto 'final_text' e prima del return, aggiungi:
-    anomaly_start_tag = "<attribute=anomaly|"
-    anomaly_end_tag = "| attribute=anomaly>"
-    anomaly_start_idx = final_text.find(anomaly_start_tag)
-    anomaly_end_idx = final_text.find(anomaly_end_tag)
-    anomaly_text = None
-    if anomaly_start_idx != -1 and anomaly_end_idx != -1:
-        anomaly_json_str = final_text[anomaly_start_idx + len(anomaly_start_tag):anomaly_end_idx].strip()
-        try:
-            #anomaly_dict = json.loads(anomaly_json_str)
-            anomaly_text = str(anomaly_json_str)  # json.dump(anomaly_dict, indent=2)
-        except Exception as e:
-            yield "Errore nel parsing del JSON per l'anomalia."
-            raise ValueError("Errore nel parsing del JSON per l'anomalia.")
-    if anomaly_text:
-        yield f"Anomalia: {anomaly_text}"
+        for event in analyzer.analyze_video_events(video_path, options, frames, video_hash):
+            if event["event"] == "frames_extracted":
+                duplicate_frames = event["duplicate_frames"]
+                frame_descriptions = [None] * event["num_frames"]
+                yield f"{event['num_frames'] + len(duplicate_frames)} frame estratti."
+                if options.dedup_threshold is not None:
+                    for dup in duplicate_frames:
+                        yield (f"Frame al timestamp {format_timestamp(dup['timestamp'])} quasi identico al frame "
+                               f"precedente (distanza {dup['distance']}): non inviato al modello.")
+                    yield f"{len(duplicate_frames)} frame duplicati scartati, {event['num_frames']} frame da analizzare."
+                if event["resumed_frames"]:
+                    yield f"Ripresa dell'analisi dal checkpoint: {event['resumed_frames']} frame già descritti."
+            elif event["event"] == "frame_description":
+                frame_descriptions[event["index"]] = event["descrizione_frame"]
+                image_tokens_total += event["image_tokens"]
+                yield f"Descrizione frame {event['index'] + 1}: {event['descrizione_frame']}"
+            elif event["event"] == "frames_reconciled":
+                frame_descriptions = list(event["frame_descriptions"])
+                yield "Descrizioni dei frame riviste per renderle coerenti tra loro."
+            elif event["event"] == "segment_summary":
+                yield (f"Riassunto del segmento {event['segment'] + 1} ({format_timestamp(event['start'])}-"
+                       f"{format_timestamp(event['end'])}): {event['descrizione_segmento']}")
+            elif event["event"] == "budget":
+                yield f"Token immagine stimati per i frame: {image_tokens_total}."
+                if event["stopped"] == "frames":
+                    yield "Numero massimo di frame raggiunto. Interrompo l'analisi dei frame."
+                elif event["stopped"]:
+                    yield f"{BudgetExceeded(event['stopped'])}: analisi interrotta."
+            elif event["event"] == "final_description":
+                final_description = event["descrizione_finale"]
+                if final_description:
+                    yield f"Descrizione finale del video: {final_description}"
+                if event["anomalie"]:
+                    yield f"Anomalia: {event['anomalie']}"
+    finally:
+        # Il file temporaneo del video serve solo all'estrazione
+        if video_path is not None:
+            cleanup_video(video_path)
     return frame_descriptions, final_description
 
 
@@ -588,8 +522,45 @@ if "driver" in st.session_state and "wait" in st.session_state:
     frame_rate = st.number_input("Frame rate di estrazione (0 => usa num_frames)", min_value=0, value=0)
     width = st.number_input("Larghezza frame ridimensionato", min_value=32, value=256)
     height = st.number_input("Altezza frame ridimensionato", min_value=32, value=256)
+    sampling = st.selectbox(
+        "Campionamento dei frame (uniform = equidistanti, scene = keyframe ai cambi di scena)",
+        ("uniform", "scene"),
+        index=0
+    )
+    max_frames = st.number_input("Numero massimo di keyframe (solo campionamento scene)", min_value=1, value=DEFAULT_MAX_FRAMES)
+    keep_aspect_ratio = st.checkbox("Mantieni le proporzioni del video (adatta dentro larghezza x altezza)", value=False)
+    max_image_tokens = st.number_input(
+        "Budget token per immagine (0 = usa larghezza/altezza; 85 = low, 255 = un tile high)",
+        min_value=0, value=0
+    )
+    detail = st.selectbox("Dettaglio immagini inviate al modello", DETAIL_LEVELS, index=DETAIL_LEVELS.index("auto"))
+    extraction_backend = st.selectbox(
+        "Estrazione frame (ffmpeg = selezione e ridimensionamento in decodifica, consigliato per video 4K)",
+        EXTRACTION_BACKENDS,
+        index=0
+    )
     length_style = st.selectbox("Stile descrizione:", ("sintetico", "normale", "dettagliato"), index=1)
     additional_request = st.text_area("Richieste aggiuntive (opzionale):", "")
+    dedup_threshold = st.number_input(
+        "Soglia frame duplicati (distanza di Hamming dHash, 0 = disattivata, consigliata 5)",
+        min_value=0, max_value=64, value=0
+    )
+    history_mode = st.selectbox(
+        "Storico inviato al modello (full = tutte le immagini precedenti, text = solo testo, window = ultime immagini)",
+        HISTORY_MODES,
+        index=0
+    )
+    analysis_mode = st.selectbox(
+        "Modalità di analisi (sequential = una conversazione, parallel = frame indipendenti e riconciliati, "
+        "segments = segmenti temporali in parallelo)",
+        ("sequential", "parallel", "segments"),
+        index=0
+    )
+    max_concurrency = st.number_input("Chiamate contemporanee al modello (parallel e segments)", min_value=1,
+                                      value=MAX_CONCURRENCY)
+    frames_per_call = st.number_input("Frame consecutivi descritti in una sola chiamata", min_value=1, value=1)
+    escalate_detail = st.checkbox("Con dettaglio low, rianalizza in high i frame con possibili anomalie", value=False)
+    max_tokens_budget = st.number_input("Budget di token per video (0 = nessun limite)", min_value=0, value=0)
 
     # ---------------------------
     # FUNZIONE PER ESEGUIRE UNA SOLA ANALISI
@@ -647,6 +618,7 @@ if "driver" in st.session_state and "wait" in st.session_state:
         image_results = []
 
         # Analisi Video
+        videos_to_analyze = []
         for video_file in video_files:
 
             # Controlla se esiste già il file di analisi per questo video
@@ -659,22 +631,47 @@ if "driver" in st.session_state and "wait" in st.session_state:
             if not enable_overwrite and os.path.exists(anomaly_filename):
                 st.info(f"Analisi per {video_basename} già esistente. Salto l'analisi.")
                 continue
+            videos_to_analyze.append(video_file)
+
+        # Estrazione dei frame su un pool di processi (un video per core): mentre il modello descrive
+        # un video, i successivi vengono già estratti. I risultati arrivano nell'ordine dei video.
+        extraction_options = video_extraction_options(
+            num_frames if frame_rate == 0 else None, frame_rate if frame_rate > 0 else 0, width, height,
+            sampling, max_frames, keep_aspect_ratio, max_image_tokens or None, detail, extraction_backend
+        )
+        for video_file, extracted in extract_videos_in_order(videos_to_analyze, extraction_options):
 
             st.session_state.logs = ""  # reset log per questo file
             frame_desc_list = []
             final_desc_text = ""
             anomaly_text = ""
             try:
-                with open(video_file, "rb") as vf:
-                    video_data = vf.read()
+                if isinstance(extracted, Exception):
+                    raise extracted
+                video_hash, extracted_frames = extracted
                 gen = analyze_video_generator(
-                    video_data=video_data,
+                    video_data=None,
                     num_frames=num_frames if frame_rate == 0 else None,
                     frame_rate=frame_rate if frame_rate > 0 else 0,
                     width=width,
                     height=height,
                     length_style=length_style,
-                    additional_request=additional_request
+                    additional_request=additional_request,
+                    history_mode=history_mode,
+                    dedup_threshold=dedup_threshold,
+                    sampling=sampling,
+                    max_frames=max_frames,
+                    keep_aspect_ratio=keep_aspect_ratio,
+                    max_image_tokens=max_image_tokens or None,
+                    detail=detail,
+                    extraction_backend=extraction_backend,
+                    frames=extracted_frames,
+                    video_hash=video_hash,
+                    analysis_mode=analysis_mode,
+                    max_concurrency=max_concurrency,
+                    frames_per_call=frames_per_call,
+                    escalate_detail=escalate_detail,
+                    max_tokens_budget=max_tokens_budget or None
                 )
 
                 for step_msg in gen:
@@ -809,6 +806,12 @@ if "driver" in st.session_state and "wait" in st.session_state:
                     af.write(anomaly_text)
                 st.info(f"File di anomalia creato: {anomaly_filename}")
 
+        cache_stats = get_response_cache().stats()
+        st.caption(
+            f"Cache risposte: {cache_stats['hits']} hit, {cache_stats['misses']} miss, "
+            f"{cache_stats['entries']} voci ({cache_stats['size_bytes'] / 1024 / 1024:.1f} MB)"
+        )
+
         # Aggiungiamo i risultati in testa alla lista delle analysis
         new_analysis_block = {
             "folder_name": folder_name,
@@ -0,0 +1,90 @@
+"""
+Benchmark: estrazione dei frame con OpenCV (decodifica a piena risoluzione + cv2.resize)
+e con ffmpeg (filtri select e scale nella pipeline di decodifica, frame letti da una pipe).
+
+Per ogni densità di campionamento misura tempo reale e tempo CPU (processo Python più i processi
+ffmpeg figli). La clip sintetica è generata con OpenCV (avc1, con ripiego su mp4v); per misure
+rappresentative dei video da drone usare una risoluzione 4K o passare un video reale con --video.
+
+Uso (dalla cartella app/):
+    python benchmarks/bench_ffmpeg_extraction.py
+    python benchmarks/bench_ffmpeg_extraction.py --size 3840 2160 --seconds 10 --threads 0 4
+    python benchmarks/bench_ffmpeg_extraction.py --video /percorso/ronda.mp4 --gaps 30 150
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cv2
+
+from analysis_core.frames import extract_frames
+from bench_frame_extraction import make_clip
+
+
+def measure(path: str, num_frames: int, backend: str, threads=None) -> tuple:
+    """
+    Restituisce (frame estratti, secondi reali, secondi CPU di questo processo e dei figli).
+    """
+    before = os.times()
+    start = time.perf_counter()
+    # extract_frames stampa una riga per frame: la sopprimiamo per non falsare la misura
+    with contextlib.redirect_stdout(io.StringIO()):
+        frames = extract_frames(path, 256, 256, num_frames=num_frames, backend=backend, ffmpeg_threads=threads)
+    elapsed = time.perf_counter() - start
+    after = os.times()
+    cpu = (after.user - before.user) + (after.system - before.system) \
+        + (after.children_user - before.children_user) + (after.children_system - before.children_system)
+    return len(frames), elapsed, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--video", help="video da usare al posto della clip sintetica")
+    parser.add_argument("--seconds", type=int, default=10)
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--size", type=int, nargs=2, default=[1920, 1080], metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--gaps", type=int, nargs="+", default=[1, 10, 30, 150],
+                        help="distanza in frame tra i frame estratti")
+    parser.add_argument("--threads", type=int, nargs="+", default=[0],
+                        help="thread di decodifica di ffmpeg da provare (0 = automatico)")
+    args = parser.parse_args()
+
+    tmp_dir = None
+    if args.video:
+        path = args.video
+        cap = cv2.VideoCapture(path)
+        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        print(f"Video: {path}, {total_frames} frame, "
+              f"{int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))}x{int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))}")
+        cap.release()
+    else:
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, "clip.mp4")
+        codec = make_clip(path, args.seconds, args.fps, *args.size)
+        total_frames = args.seconds * args.fps
+        print(f"Clip: {args.seconds}s, {args.fps} fps, {args.size[0]}x{args.size[1]}, codec {codec}")
+
+    try:
+        print(f"{'gap':>5} {'frame':>6} {'backend':>12} {'secondi':>8} {'CPU s':>8} {'frame/s':>8}")
+        for gap in args.gaps:
+            num_frames = max(1, total_frames // gap)
+            runs = [("opencv", None)] + [("ffmpeg", threads) for threads in args.threads]
+            for backend, threads in runs:
+                count, elapsed, cpu = measure(path, num_frames, backend, threads)
+                label = backend if threads is None else f"ffmpeg t={threads}"
+                print(f"{gap:>5} {count:>6} {label:>12} {elapsed:>8.2f} {cpu:>8.2f} "
+                      f"{count / elapsed if elapsed else 0.0:>8.1f}")
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
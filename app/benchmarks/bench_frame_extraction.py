@@ -0,0 +1,91 @@
+"""
+Benchmark: frame estratti al secondo con lettura sequenziale (grab/retrieve) e con seek per indice.
+
+Genera clip sintetiche H.264 (codec avc1, con ripiego su mp4v se l'OpenCV installato non lo supporta)
+e misura extract_frames con le due strategie per diverse densità di campionamento
+(un frame ogni N frame del video).
+
+Uso (dalla cartella app/):
+    python benchmarks/bench_frame_extraction.py
+    python benchmarks/bench_frame_extraction.py --seconds 60 --fps 30 --gaps 1 5 30 120 --size 1280 720
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cv2
+import numpy as np
+
+from analysis_core.frames import choose_read_strategy, extract_frames
+
+
+def make_clip(path: str, seconds: int, fps: int, width: int, height: int) -> str:
+    """
+    Scrive una clip con contenuto in movimento (gradiente che scorre e rumore) e restituisce il codec usato.
+    """
+    for codec in ("avc1", "mp4v"):
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*codec), fps, (width, height))
+        if writer.isOpened():
+            break
+        writer.release()
+    else:
+        raise RuntimeError("Nessun codec disponibile per scrivere la clip di test.")
+
+    rng = np.random.default_rng(0)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    for i in range(seconds * fps):
+        row = ((x + i * 4) % 256).astype(np.uint8)
+        frame = np.repeat(np.repeat(row[None, :, None], height, axis=0), 3, axis=2)
+        noise = rng.integers(0, 24, size=(height // 8, width // 8, 1), dtype=np.uint8)
+        frame = cv2.add(frame, cv2.resize(noise, (width, height), interpolation=cv2.INTER_NEAREST)[:, :, None].repeat(3, axis=2))
+        writer.write(frame)
+    writer.release()
+    return codec
+
+
+def measure(path: str, num_frames: int, strategy: str) -> tuple:
+    start = time.perf_counter()
+    # extract_frames stampa una riga per frame: la sopprimiamo per non falsare la misura
+    with contextlib.redirect_stdout(io.StringIO()):
+        frames = extract_frames(path, 256, 256, num_frames=num_frames, read_strategy=strategy)
+    elapsed = time.perf_counter() - start
+    return len(frames), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=int, default=20)
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--size", type=int, nargs=2, default=[640, 360], metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--gaps", type=int, nargs="+", default=[1, 3, 10, 30, 150],
+                        help="distanza in frame tra i frame estratti")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, "clip.mp4")
+    codec = make_clip(path, args.seconds, args.fps, *args.size)
+    print(f"Clip: {args.seconds}s, {args.fps} fps, {args.size[0]}x{args.size[1]}, codec {codec}")
+
+    print(f"{'gap':>5} {'frame':>6} {'seq fps':>9} {'seek fps':>9} {'auto':>11}")
+    total_frames = args.seconds * args.fps
+    for gap in args.gaps:
+        num_frames = max(1, total_frames // gap)
+        results = {}
+        for strategy in ("sequential", "seek"):
+            count, elapsed = measure(path, num_frames, strategy)
+            results[strategy] = (count, count / elapsed if elapsed else 0.0)
+        indices = [int(i * total_frames / num_frames) for i in range(num_frames)]
+        print(f"{gap:>5} {results['sequential'][0]:>6} {results['sequential'][1]:>9.1f} "
+              f"{results['seek'][1]:>9.1f} {choose_read_strategy(indices):>11}")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
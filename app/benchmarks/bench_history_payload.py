@@ -0,0 +1,85 @@
+"""
+Benchmark: byte inviati al modello per ogni frame al variare della modalità di history.
+
+Riproduce il ciclo di analisi di main.py (istruzione + descrizioni precedenti + immagine del frame,
+storia della conversazione costruita con build_history) senza chiamare il modello: le immagini sono
+JPEG sintetici di dimensione fissa e le risposte del modello sono testi di lunghezza tipica.
+
+Nelle modalità compatte la dimensione delle richieste deve restare costante una volta riempita la
+storia (dopo history_turns + history_image_window frame): se cresce ancora il benchmark termina con codice di uscita 1.
+
+Uso (dalla cartella app/):
+    python benchmarks/bench_history_payload.py
+    python benchmarks/bench_history_payload.py --frames 10 50 200 --image-kb 20
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from analysis_core.history import (DEFAULT_HISTORY_TURNS, DEFAULT_IMAGE_WINDOW, HISTORY_MODES, build_history,
+                                   limit_previous_descriptions)
+SYSTEM_PROMPT = "x" * 1800
+DESCRIPTION = "Descrizione qualitativa del frame con dettagli visivi rilevanti. " * 6
+
+
+def payload_bytes(messages) -> int:
+    return len(json.dumps([m.content for m in messages], ensure_ascii=False).encode("utf-8"))
+
+
+def simulate(num_frames: int, mode: str, image_kb: int) -> list:
+    image_url = "data:image/jpeg;base64," + base64.b64encode(os.urandom(image_kb * 1024)).decode("utf-8")
+    messages = [SystemMessage(content=SYSTEM_PROMPT)]
+    descriptions = []
+    sizes = []
+    for i in range(num_frames):
+        human_content = [{"type": "text", "text": "Analizza il frame seguente."}]
+        for idx, desc in enumerate(limit_previous_descriptions(descriptions, mode, DEFAULT_HISTORY_TURNS)):
+            human_content.append({"type": "text", "text": f"Descrizione frame precedente {idx + 1}: {desc}"})
+        human_content.append({"type": "image_url", "image_url": {"url": image_url, "detail": "auto"}})
+        human_message = HumanMessage(content=human_content)
+
+        history = build_history(messages, mode, DEFAULT_IMAGE_WINDOW, DEFAULT_HISTORY_TURNS)
+        sizes.append(payload_bytes(history + [human_message]))
+
+        ai_response = f'<attribute=frame_description| {{"descrizione_frame": "{DESCRIPTION}"}} | attribute=frame_description>'
+        messages.append(human_message)
+        messages.append(AIMessage(content=ai_response))
+        descriptions.append(DESCRIPTION)
+    return sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--image-kb", type=int, default=20, help="dimensione del JPEG di ogni frame (KB)")
+    args = parser.parse_args()
+
+    print(f"{'frame':>6} {'modalità':>8} {'media KB/frame':>15} {'ultimo KB':>10} {'totale MB':>10}")
+    # Dimensione delle richieste a storia piena, per modalità compatta, su tutte le esecuzioni
+    steady_sizes = {}
+    for num_frames in args.frames:
+        for mode in HISTORY_MODES:
+            sizes = simulate(num_frames, mode, args.image_kb)
+            print(f"{num_frames:>6} {mode:>8} {sum(sizes) / len(sizes) / 1024:>15.1f} "
+                  f"{sizes[-1] / 1024:>10.1f} {sum(sizes) / 1024 / 1024:>10.2f}")
+            if mode != "full":
+                steady_sizes.setdefault(mode, set()).update(sizes[DEFAULT_HISTORY_TURNS + DEFAULT_IMAGE_WINDOW:])
+
+    growing = [mode for mode, sizes in steady_sizes.items() if len(sizes) > 1]
+    for mode in growing:
+        sizes = steady_sizes[mode]
+        print(f"ERRORE: in modalità {mode} la richiesta cresce da {min(sizes) / 1024:.1f} KB "
+              f"a {max(sizes) / 1024:.1f} KB a storia piena")
+    if growing:
+        sys.exit(1)
+    print("Modalità compatte: dimensione della richiesta costante a storia piena.")
+
+
+if __name__ == "__main__":
+    main()
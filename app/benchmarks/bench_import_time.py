@@ -0,0 +1,75 @@
+"""
+Benchmark: tempo di import dei moduli condivisi e dell'API, e dipendenze pesanti caricate.
+
+Ogni import è misurato in un interprete nuovo (come all'avvio di un worker dell'API o di un processo
+del pool di estrazione), ripetuto più volte; si riporta la mediana e quali dipendenze pesanti
+(cv2, numpy, langchain, streamlit) risultano importate subito dopo. Con i moduli di analysis_core
+che differiscono gli import pesanti, importarli non deve caricare cv2 né langchain.
+
+Uso (dalla cartella app/):
+    python benchmarks/bench_import_time.py
+    python benchmarks/bench_import_time.py --runs 10 --modules analysis_core analysis_core.frames main
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_MODULES = [
+    "analysis_core",
+    "analysis_core.frames",
+    "analysis_core.summarize",
+    "analysis_core.sequential",
+    "analysis_core.extraction_pool",
+    "main",
+]
+HEAVY_MODULES = ("cv2", "numpy", "langchain_core", "langchain", "langchain_openai", "streamlit")
+
+# Eseguito nel processo figlio: stampa il tempo di import (ms) e le dipendenze pesanti caricate
+PROBE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = (time.perf_counter() - start) * 1000
+loaded = [name for name in {heavy!r} if name in sys.modules]
+print(elapsed, ",".join(loaded) or "-")
+"""
+
+
+def measure(module: str, runs: int) -> tuple:
+    env = dict(os.environ)
+    # L'API crea il backend all'import: lo stub evita di richiedere una chiave API
+    env.setdefault("VIDEO_ANALYSIS_BACKEND", "stub")
+    times, loaded = [], ""
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY_MODULES)],
+            cwd=APP_DIR, env=env, capture_output=True, text=True,
+        )
+        if result.returncode != 0:
+            return None, result.stderr.strip().splitlines()[-1]
+        elapsed, loaded = result.stdout.strip().splitlines()[-1].split(" ", 1)
+        times.append(float(elapsed))
+    return times, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", nargs="+", default=DEFAULT_MODULES)
+    parser.add_argument("--runs", type=int, default=5, help="interpreti nuovi per ogni modulo")
+    args = parser.parse_args()
+
+    print(f"{'modulo':<32} {'mediana':>10} {'min':>10}  dipendenze pesanti caricate")
+    for module in args.modules:
+        times, loaded = measure(module, args.runs)
+        if times is None:
+            print(f"{module:<32} {'errore':>10} {'':>10}  {loaded}")
+            continue
+        print(f"{module:<32} {statistics.median(times):>8.0f}ms {min(times):>8.0f}ms  {loaded}")
+
+
+if __name__ == "__main__":
+    main()
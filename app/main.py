@@ -1,18 +1,26 @@
-import base64
+import asyncio
 import os
+import posixpath
+import shutil
+import threading
+import time
 import uuid
-import tempfile
-from typing import List, Optional
-from fastapi import FastAPI, Body
-from pydantic import BaseModel
-import cv2
-from io import BytesIO
-from PIL import Image
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+from fastapi import FastAPI, Body, Depends, File, Form, HTTPException, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel, ValidationError
 import json
 
-from langchain_openai import ChatOpenAI
-from langchain.schema.messages import SystemMessage, HumanMessage
-from langchain_core.messages import AIMessage
+from analysis_core.backend import get_chat_backend
+from analysis_core.cache import get_response_cache
+from analysis_core.metrics import JOBS_IN_FLIGHT, time_stage
+from analysis_core.pipeline import AnalysisOptions, InvalidOptions, VideoAnalyzer
+from analysis_core.videos import UPLOAD_CHUNK_SIZE, cleanup_video, decode_base64_video, new_video_path
 
 app = FastAPI()
 
@@ -33,192 +41,585 @@ Nota: Le descrizioni devono essere esclusivamente qualitative, estetiche, non me
 """
 
 # Configurazione del modello
-# Inserire la propria OpenAI API Key
-OPENAI_API_KEY = "..."
+# Backend, modello e chiave API si configurano con le variabili d'ambiente (vedi analysis_core/backend.py)
+chat = get_chat_backend()
+
+# Video indicati per riferimento invece che in base64: video_path è letto in place se si trova sotto
+# una delle cartelle consentite (separate da os.pathsep, default ./FH_DATA dove la UI scarica i voli),
+# video_url è scaricato su disco solo se inizia con uno dei prefissi consentiti (separati da virgola;
+# nessun prefisso = video_url disattivato).
+ALLOWED_VIDEO_ROOTS = [
+    root for root in os.getenv("VIDEO_ANALYSIS_ALLOWED_ROOTS", os.path.join(os.getcwd(), "FH_DATA")).split(os.pathsep)
+    if root
+]
+ALLOWED_VIDEO_URL_PREFIXES = [prefix for prefix in os.getenv("VIDEO_ANALYSIS_ALLOWED_URL_PREFIXES", "").split(",") if prefix]
+VIDEO_URL_TIMEOUT = float(os.getenv("VIDEO_ANALYSIS_URL_TIMEOUT", "60"))
+
+# Pool di worker per i job asincroni (POST /jobs): numero di analisi eseguite in parallelo,
+# numero massimo di job in coda/esecuzione e tempo di conservazione dei job conclusi.
+JOB_WORKERS = int(os.getenv("VIDEO_ANALYSIS_JOB_WORKERS", "2"))
+MAX_PENDING_JOBS = int(os.getenv("VIDEO_ANALYSIS_MAX_PENDING_JOBS", "20"))
+JOB_RETENTION_SECONDS = int(os.getenv("VIDEO_ANALYSIS_JOB_RETENTION_SECONDS", "3600"))
+
+# Analisi batch (POST /analyze_videos): video per richiesta, video in coda o in analisi di tutte le
+# richieste batch e chiamate contemporanee al modello dei video in analisi (0 = concorrenza del backend)
+MAX_BATCH_VIDEOS = int(os.getenv("VIDEO_ANALYSIS_MAX_BATCH_VIDEOS", "50"))
+MAX_PENDING_BATCH_VIDEOS = int(os.getenv("VIDEO_ANALYSIS_MAX_PENDING_BATCH_VIDEOS", "100"))
+BATCH_WORKERS = int(os.getenv("VIDEO_ANALYSIS_BATCH_WORKERS", "0"))
+
+
+class VideoSource(BaseModel):
+    """
+    Video da analizzare: contenuto in base64, percorso sul server o URL. Va indicato esattamente uno dei tre.
+    """
+    video_base64: Optional[str] = None
+    video_path: Optional[str] = None
+    video_url: Optional[str] = None
+
+
+class VideoRequest(AnalysisOptions, VideoSource):
+    pass
+
+
+class BatchVideo(VideoSource):
+    # Identificativo restituito nei risultati (default: posizione del video nella lista)
+    id: Optional[str] = None
 
-chat = ChatOpenAI(model="gpt-4o", temperature=0.25, max_tokens=2048, openai_api_key=OPENAI_API_KEY)
 
-# Parametri di esempio: limite descrizioni precedenti incluse nella storia
-MAX_PREVIOUS_DESCRIPTIONS = 100
+class BatchVideoRequest(AnalysisOptions):
+    """
+    Più video analizzati con gli stessi parametri.
+    """
+    videos: List[BatchVideo]
+
 
-class VideoRequest(BaseModel):
-    video_base64: str
-    num_frames: Optional[int] = None
-    frame_rate: Optional[int] = None
-    # Aggiungiamo i parametri width e height per il resize dei frame
-    width: Optional[int] = 256
-    height: Optional[int] = 256
+def open_video_source(source: VideoSource) -> Tuple[str, bool]:
+    """
+    Restituisce il percorso del video da analizzare e se si tratta di una copia temporanea
+    (da rimuovere con cleanup_video a fine analisi). I video sul server non vengono copiati.
+    """
+    given = [name for name in VideoSource.model_fields if getattr(source, name)]
+    if len(given) != 1:
+        raise HTTPException(status_code=422, detail="Indicare esattamente uno tra video_base64, video_path e video_url.")
+    if source.video_path:
+        return resolve_local_video(source.video_path), False
+    if source.video_url:
+        return download_video(source.video_url), True
+    return decode_base64_video(source.video_base64), True
 
 
-def decode_base64_video(video_base64: str) -> str:
+def resolve_local_video(video_path: str) -> str:
+    """
+    Verifica che il video si trovi sotto una delle cartelle consentite (dopo aver risolto link
+    simbolici e "..") e ne restituisce il percorso assoluto.
+    """
+    real_path = os.path.realpath(video_path)
+    roots = [os.path.realpath(root) for root in ALLOWED_VIDEO_ROOTS]
+    if not any(os.path.commonpath([real_path, root]) == root for root in roots):
+        raise HTTPException(status_code=403, detail="Percorso del video non consentito.")
+    if not os.path.isfile(real_path):
+        raise HTTPException(status_code=404, detail="Video non trovato.")
+    print(f"Video letto in place da: {real_path}")
+    return real_path
+
+
+def _url_parts(url: str) -> Tuple[str, Optional[str], Optional[int], str]:
+    """
+    Schema, host, porta e percorso (decodificato e normalizzato) di un URL; ValueError se la porta non è valida.
+    """
+    parsed = urllib.parse.urlsplit(url)
+    path = urllib.parse.unquote(parsed.path)
+    path = posixpath.normpath(path) if path else ""
+    return parsed.scheme.lower(), parsed.hostname, parsed.port, path.rstrip("/")
+
+
+def _url_allowed(url: str) -> bool:
+    """
+    L'URL è consentito se schema, host e porta coincidono con quelli di un prefisso e il suo percorso
+    è quello del prefisso o si trova sotto di esso (confronto per segmenti: "/video" non consente "/video-privati").
+    """
+    try:
+        scheme, host, port, path = _url_parts(url)
+    except ValueError:
+        return False
+    if scheme not in ("http", "https") or not host:
+        return False
+    for prefix in ALLOWED_VIDEO_URL_PREFIXES:
+        try:
+            prefix_scheme, prefix_host, prefix_port, prefix_path = _url_parts(prefix)
+        except ValueError:
+            continue
+        if (scheme, host, port) != (prefix_scheme, prefix_host, prefix_port):
+            continue
+        if not prefix_path or path == prefix_path or path.startswith(prefix_path + "/"):
+            return True
+    return False
+
+
+@time_stage("decode")
+def download_video(video_url: str) -> str:
     """
-    Decodifica il video base64 e lo salva in un file temporaneo.
+    Scarica il video (ad esempio dal servizio di file hosting) in un file temporaneo, a blocchi.
+    """
+    if not _url_allowed(video_url):
+        raise HTTPException(status_code=403, detail="URL del video non consentito.")
+    print(f"Download del video da: {video_url}")
+    video_path = new_video_path()
+    try:
+        with urllib.request.urlopen(video_url, timeout=VIDEO_URL_TIMEOUT) as response:
+            # Anche dopo eventuali redirect l'URL deve restare tra quelli consentiti
+            if not _url_allowed(response.geturl()):
+                raise HTTPException(status_code=403, detail="URL del video non consentito.")
+            with open(video_path, "wb") as f:
+                shutil.copyfileobj(response, f, UPLOAD_CHUNK_SIZE)
+    except urllib.error.HTTPError as e:
+        cleanup_video(video_path)
+        raise HTTPException(status_code=502, detail=f"Download del video non riuscito: HTTP {e.code}")
+    except (urllib.error.URLError, OSError) as e:
+        cleanup_video(video_path)
+        raise HTTPException(status_code=502, detail=f"Download del video non riuscito: {e}")
+    except HTTPException:
+        cleanup_video(video_path)
+        raise
+    print(f"Video salvato in: {video_path}")
+    return video_path
+
+
+@time_stage("decode")
+def save_upload_to_disk(upload_file) -> str:
+    """
+    Copia a blocchi un file caricato (multipart) in un file temporaneo.
     Restituisce il percorso del file video.
     """
-    print("Decodifica del video in base64...")
-    video_data = base64.b64decode(video_base64)
-    tmp_dir = tempfile.mkdtemp()
-    video_path = os.path.join(tmp_dir, f"{uuid.uuid4()}.mp4")
+    print("Salvataggio del video caricato...")
+    video_path = new_video_path()
     with open(video_path, "wb") as f:
-        f.write(video_data)
+        shutil.copyfileobj(upload_file, f, UPLOAD_CHUNK_SIZE)
     print(f"Video salvato in: {video_path}")
     return video_path
 
 
-def extract_frames(video_path: str, width: int, height: int, num_frames: Optional[int] = None, frame_rate: Optional[int] = None) -> List[str]:
+def _analyzer() -> VideoAnalyzer:
     """
-    Estrae i frame dal video.
-    Se num_frames è fornito, estrae quel numero di frame uniformemente distribuiti sul video.
-    Se frame_rate è fornito, estrae i frame a quell'intervallo.
-    Inoltre, effettua il resize di ogni frame alla dimensione width x height.
-    Restituisce una lista di percorsi dei frame estratti.
+    Pipeline di analisi con il modello e il prompt di sistema dell'API.
     """
-    print("Estrazione dei frame dal video...")
-    cap = cv2.VideoCapture(video_path)
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    print(f"Frame totali nel video: {total_frames}, FPS: {fps}")
-
-    if num_frames is not None:
-        print(f"Estrazione di {num_frames} frame uniformemente distribuiti.")
-        frame_indices = [int(i * total_frames / num_frames) for i in range(num_frames)]
-    elif frame_rate is not None:
-        print(f"Estrazione di frame con frame_rate: {frame_rate}")
-        frame_step = int(fps / frame_rate) if frame_rate <= fps else 1
-        frame_indices = list(range(0, total_frames, frame_step))
-    else:
-        print("Nessun parametro fornito, estraggo 5 frame di default.")
-        num_frames = 5
-        frame_indices = [int(i * total_frames / num_frames) for i in range(num_frames)]
+    return VideoAnalyzer(chat, SYSTEM_PROMPT)
 
-    frame_paths = []
-    for i, idx in enumerate(frame_indices):
-        cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
-        ret, frame = cap.read()
-        if not ret:
-            print(f"Impossibile leggere il frame all'indice {idx}. Stop.")
-            break
 
-        # Effettuiamo il resize del frame
-        resized_frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+def analyze_video_events(video_path: str, options: AnalysisOptions) -> Iterator[dict]:
+    """
+    Esegue l'analisi completa di un video già salvato su disco (vedi VideoAnalyzer.analyze_video_events).
+    Generatore: produce un evento (dict con chiave "event") non appena ogni risultato è disponibile.
+    Le opzioni che non permettono l'analisi diventano un errore 422.
+    """
+    try:
+        yield from _analyzer().analyze_video_events(video_path, options)
+    except InvalidOptions as e:
+        raise HTTPException(status_code=422, detail=str(e))
 
-        tmp_dir = tempfile.mkdtemp()
-        frame_path = os.path.join(tmp_dir, f"frame_{i}.jpg")
-        cv2.imwrite(frame_path, resized_frame)
-        frame_paths.append(frame_path)
-        print(f"Frame {i} estratto, ridimensionato a {width}x{height} e salvato in: {frame_path}")
 
-    cap.release()
-    print("Estrazione frame completata.")
-    return frame_paths
+def run_video_analysis(video_path: str, options: AnalysisOptions) -> dict:
+    """
+    Versione sincrona di analyze_video_events: consuma tutti gli eventi e restituisce il risultato completo.
+    """
+    result = {
+        "frame_descriptions": [],
+        "final_description": "",
+        "frame_timestamps": [],
+        "duplicate_frames": [],
+        "frame_image_tokens": [],
+        "resumed_frames": 0,
+        "segment_summaries": [],
+        "budget": None
+    }
+    for event in analyze_video_events(video_path, options):
+        apply_event(result, event)
+    return result
 
 
-def image_to_base64(image_path: str) -> str:
-    with open(image_path, "rb") as f:
-        return "data:image/jpeg;base64," + base64.b64encode(f.read()).decode("utf-8")
+def apply_event(result: dict, event: dict) -> None:
+    """
+    Aggiorna un risultato parziale (frame_descriptions, final_description) con un evento dell'analisi.
+    Le descrizioni sono indicizzate per frame perché in modalità "parallel" arrivano fuori ordine.
+    """
+    if event["event"] == "frames_extracted":
+        result["frame_descriptions"] = [None] * event["num_frames"]
+        result["frame_timestamps"] = event["frame_timestamps"]
+        result["duplicate_frames"] = event["duplicate_frames"]
+        result["frame_image_tokens"] = [None] * event["num_frames"]
+        result["resumed_frames"] = event["resumed_frames"]
+    elif event["event"] == "frame_description":
+        result["frame_descriptions"][event["index"]] = event["descrizione_frame"]
+        result["frame_image_tokens"][event["index"]] = event["image_tokens"]
+    elif event["event"] == "frames_reconciled":
+        result["frame_descriptions"] = list(event["frame_descriptions"])
+    elif event["event"] == "segment_summary":
+        result["segment_summaries"].append({key: event[key] for key in ("segment", "start", "end", "descrizione_segmento")})
+        result["segment_summaries"].sort(key=lambda summary: summary["segment"])
+    elif event["event"] == "budget":
+        result["budget"] = {key: value for key, value in event.items() if key != "event"}
+    elif event["event"] == "final_description":
+        result["final_description"] = event["descrizione_finale"]
 
 
 @app.post("/analyze_video")
 def analyze_video(req: VideoRequest):
     print("Ricevuta richiesta di analisi video.")
     # Decodifica del video
-    video_path = decode_base64_video(req.video_base64)
-
-    # Estrazione dei frame con resize a width x height
-    frame_paths = extract_frames(
-        video_path,
-        width=req.width,
-        height=req.height,
-        num_frames=req.num_frames,
-        frame_rate=req.frame_rate
-    )
+    video_path, temporary = open_video_source(req)
+    try:
+        return run_video_analysis(video_path, req)
+    finally:
+        if temporary:
+            cleanup_video(video_path)
 
-    print("Inizializzazione della conversazione con il modello...")
-    system_message = SystemMessage(content=SYSTEM_PROMPT)
-    messages = [system_message]
 
-    # Manteniamo una lista di descrizioni dei frame precedenti
-    frame_descriptions = []
+def _sse_format(event: dict) -> str:
+    return f"event: {event['event']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
 
-    # Per ogni frame estratto, chiediamo una descrizione
-    for i, frame_path in enumerate(frame_paths):
-        print(f"\nAnalisi del frame {i+1} di {len(frame_paths)}...")
-        frame_b64 = image_to_base64(frame_path)
 
-        previous_descriptions_limited = frame_descriptions[-MAX_PREVIOUS_DESCRIPTIONS:]
+def _stream_analysis_events(video_path: str, options: AnalysisOptions, temporary: bool) -> Iterator[str]:
+    try:
+        for event in analyze_video_events(video_path, options):
+            yield _sse_format(event)
+    except Exception as e:
+        print(f"Errore durante l'analisi in streaming: {e}")
+        yield _sse_format({"event": "error", "detail": str(e)})
+    finally:
+        if temporary:
+            cleanup_video(video_path)
+
+
+@app.post("/analyze_video_stream")
+def analyze_video_stream(req: VideoRequest):
+    """
+    Come /analyze_video, ma la risposta è uno stream Server-Sent Events: ogni descrizione
+    di frame e la descrizione finale vengono inviate al client appena disponibili.
+    """
+    print("Ricevuta richiesta di analisi video in streaming.")
+    video_path, temporary = open_video_source(req)
+    return StreamingResponse(
+        _stream_analysis_events(video_path, req, temporary),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-        human_content = [
-            {"type": "text", "text": "Analizza il frame seguente. Tieni conto delle descrizioni dei frame precedenti fornite. Non generare analisi mediche. Cerca di mantenere coerenza con le descrizioni precedenti."},
-        ]
 
-        for idx, desc in enumerate(previous_descriptions_limited):
-            human_content.append({"type": "text", "text": f"Descrizione frame precedente {idx+1}: {desc}"})
+def _upload_options(options: Optional[str], **fields) -> AnalysisOptions:
+    """
+    Parametri di /analyze_video_upload: il campo `options` contiene gli stessi parametri degli altri
+    endpoint in JSON; i singoli campi del form (num_frames, frame_rate, width, height), se presenti, li sovrascrivono.
+    """
+    try:
+        data = json.loads(options) if options else {}
+        if not isinstance(data, dict):
+            raise ValueError("il campo options deve essere un oggetto JSON")
+        data.update({name: value for name, value in fields.items() if value is not None})
+        return AnalysisOptions(**data)
+    except (ValueError, ValidationError) as e:
+        raise HTTPException(status_code=422, detail=f"Parametri di analisi non validi: {e}")
+
+
+@app.post("/analyze_video_upload")
+def analyze_video_upload(
+    video: UploadFile = File(...),
+    options: Optional[str] = Form(None),
+    num_frames: Optional[int] = Form(None),
+    frame_rate: Optional[int] = Form(None),
+    width: Optional[int] = Form(None),
+    height: Optional[int] = Form(None),
+):
+    """
+    Variante multipart/form-data: il video viaggia come file binario (nessun overhead base64)
+    e viene copiato su disco a blocchi.
+    """
+    print("Ricevuto upload multipart per analisi video.")
+    analysis_options = _upload_options(options, num_frames=num_frames, frame_rate=frame_rate, width=width, height=height)
+    video_path = save_upload_to_disk(video.file)
+    try:
+        return run_video_analysis(video_path, analysis_options)
+    finally:
+        cleanup_video(video_path)
+
+
+@app.post("/analyze_video_raw")
+async def analyze_video_raw(request: Request, options: AnalysisOptions = Depends()):
+    """
+    Variante a corpo grezzo (Content-Type: video/mp4 o application/octet-stream):
+    il corpo della richiesta viene scritto su disco man mano che arriva, i parametri
+    sono passati in query string.
+    """
+    print("Ricevuto video come corpo grezzo per analisi.")
+    video_path = new_video_path()
+    try:
+        with open(video_path, "wb") as f:
+            # I blocchi ricevuti vengono accumulati e scritti nel threadpool, come per gli upload multipart:
+            # la scrittura su disco non blocca l'event loop
+            buffer = bytearray()
+            async for chunk in request.stream():
+                buffer += chunk
+                if len(buffer) >= UPLOAD_CHUNK_SIZE:
+                    await run_in_threadpool(f.write, bytes(buffer))
+                    buffer.clear()
+            if buffer:
+                await run_in_threadpool(f.write, bytes(buffer))
+        print(f"Video salvato in: {video_path}")
+        # L'analisi è bloccante: la eseguiamo nel threadpool per non fermare l'event loop
+        return await run_in_threadpool(run_video_analysis, video_path, options)
+    finally:
+        cleanup_video(video_path)
+
+
+# ---------------------------------
+# Analisi batch
+# ---------------------------------
+# I video di tutte le richieste batch passano da un unico pool, un video intero per worker: non c'è una
+# coda globale di frame, le chiamate dei video in corso si alternano soltanto sugli slot del backend
+# (chat.concurrency) e sullo scheduler dei limiti RPM/TPM, condivisi dal processo. Ogni video occupa
+# tante unità di capacità quante chiamate può avere in corso (1 in modalità "sequential", max_concurrency
+# nelle altre): la somma dei video in analisi non supera la capacità batch, così un batch di video
+# "parallel" non moltiplica le chiamate in attesa sugli slot del backend. In modalità "sequential"
+# ogni slot resta comunque occupato finché ci sono video da descrivere.
+BATCH_CAPACITY = BATCH_WORKERS or chat.concurrency
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_CAPACITY, thread_name_prefix="video-batch")
+batch_lock = threading.Lock()
+batch_capacity = threading.Condition(batch_lock)
+batch_state = {"pending": 0, "in_use": 0}
+
+
+def _video_concurrency(options: AnalysisOptions) -> int:
+    """
+    Chiamate al modello contemporanee di un video analizzato con le opzioni date, entro la capacità batch.
+    """
+    if options.analysis_mode == "sequential":
+        return 1
+    return min(max(1, options.max_concurrency), BATCH_CAPACITY)
 
-        human_content.append({"type": "image_url", "image_url": {"url": frame_b64, "detail": "auto"}})
 
-        human_message = HumanMessage(content=human_content)
+def _run_batch_video(video_id: str, source: VideoSource, options: AnalysisOptions, submitted_at: float) -> dict:
+    units = _video_concurrency(options)
+    with batch_capacity:
+        while batch_state["in_use"] + units > BATCH_CAPACITY:
+            batch_capacity.wait()
+        batch_state["in_use"] += units
+    try:
+        return _analyze_batch_video(video_id, source, options, submitted_at)
+    finally:
+        with batch_capacity:
+            batch_state["in_use"] -= units
+            batch_state["pending"] -= 1
+            batch_capacity.notify_all()
 
-        print("Invio richiesta al modello per la descrizione del frame...")
-        response = chat(messages + [human_message])
-        ai_response = response.content
 
-        print("Parsing della risposta del modello...")
-        start_tag = "<attribute=frame_description|"
-        end_tag = "| attribute=frame_description>"
-        start_idx = ai_response.find(start_tag)
-        end_idx = ai_response.find(end_tag)
+def _analyze_batch_video(video_id: str, source: VideoSource, options: AnalysisOptions, submitted_at: float) -> dict:
+    started_at = time.time()
+    video_path, temporary = None, False
+    try:
+        video_path, temporary = open_video_source(source)
+        result = run_video_analysis(video_path, options)
+        result.update({"id": video_id, "status": "completed", "error": None})
+    except Exception as e:
+        print(f"Errore nell'analisi del video {video_id}: {e}")
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        result = {"id": video_id, "status": "failed", "error": detail}
+    finally:
+        if temporary:
+            cleanup_video(video_path)
+    finished_at = time.time()
+    result["timing"] = {
+        "queued_seconds": round(started_at - submitted_at, 3),
+        "analysis_seconds": round(finished_at - started_at, 3),
+    }
+    return result
 
-        if start_idx == -1 or end_idx == -1:
-            print("Errore: formato non corretto nella risposta del modello.")
-            raise ValueError("La risposta del modello non contiene la descrizione formattata correttamente.")
 
-        json_str = ai_response[start_idx+len(start_tag):end_idx].strip()
-        try:
-            desc_dict = json.loads(json_str)
-            desc_frame = desc_dict.get("descrizione_frame", "")
-            print(f"Descrizione frame {i+1} estratta con successo.")
-        except:
-            print("Errore nel parsing del JSON per la descrizione del frame.")
-            raise ValueError("Errore nel parsing del JSON per la descrizione del frame.")
-
-        messages.append(human_message)
-        messages.append(AIMessage(content=ai_response))
-        frame_descriptions.append(desc_frame)
-
-    print("\nTutti i frame sono stati analizzati. Generazione della descrizione finale del video...")
-    final_human_content = [
-        {"type": "text", "text": "Genera la descrizione finale del video basandoti sulle descrizioni dei frame precedenti. Non analisi mediche, ma solo qualitative ed estetiche. Fornisci la descrizione finale racchiusa nei tag richiesti."},
+@app.post("/analyze_videos")
+async def analyze_videos(req: BatchVideoRequest):
+    """
+    Analizza più video con gli stessi parametri e restituisce i risultati nell'ordine della richiesta,
+    con i tempi di ciascun video e quelli complessivi. L'errore di un video non interrompe gli altri.
+    L'attesa dei video non occupa un thread del server: la richiesta resta sospesa sull'event loop
+    mentre i worker del pool batch li analizzano.
+    """
+    if not req.videos:
+        raise HTTPException(status_code=422, detail="Nessun video da analizzare.")
+    if len(req.videos) > MAX_BATCH_VIDEOS:
+        raise HTTPException(status_code=413, detail=f"Troppi video nella richiesta (massimo {MAX_BATCH_VIDEOS}).")
+    print(f"Ricevuta richiesta di analisi batch di {len(req.videos)} video.")
+    start = time.time()
+    scheduler_before = chat.scheduler.stats()
+    options = AnalysisOptions(**req.model_dump(exclude={"videos"}))
+    # Controllo del limite e prenotazione dei posti nello stesso blocco, come per POST /jobs
+    with batch_lock:
+        if batch_state["pending"] + len(req.videos) > MAX_PENDING_BATCH_VIDEOS:
+            raise HTTPException(status_code=429, detail="Troppi video batch in coda, riprovare più tardi.")
+        batch_state["pending"] += len(req.videos)
+
+    # Ogni video viene aperto (decodificato, scaricato o letto in place) dal worker che lo analizza:
+    # un video non valido o non raggiungibile fa fallire solo quel video
+    futures = [
+        asyncio.wrap_future(batch_executor.submit(_run_batch_video, video.id or str(k), video, options, time.time()))
+        for k, video in enumerate(req.videos)
     ]
+    results = await asyncio.gather(*futures)
+
+    total_seconds = time.time() - start
+    analysis_seconds = sum(result["timing"]["analysis_seconds"] for result in results)
+    scheduler_after = chat.scheduler.stats()
+    return {
+        "results": results,
+        "timing": {
+            "total_seconds": round(total_seconds, 3),
+            # Somma dei tempi di analisi dei singoli video: il rapporto con total_seconds
+            # indica quanti video sono stati in media analizzati contemporaneamente
+            "analysis_seconds": round(analysis_seconds, 3),
+            "parallelism": round(analysis_seconds / total_seconds, 2) if total_seconds else 0.0,
+            "videos": len(results),
+            "failed": sum(1 for result in results if result["status"] == "failed"),
+            "frames": sum(1 for result in results for description in result.get("frame_descriptions", [])
+                          if description is not None),
+            # Token usati dalle analisi dei video (dichiarati dal modello o stimati, vedi "budget")
+            "tokens": sum((result.get("budget") or {}).get("tokens", 0) for result in results),
+            # Differenza dei contatori dello scheduler (condiviso: include le altre richieste concorrenti)
+            "scheduler": {key: round(scheduler_after[key] - scheduler_before[key], 3) for key in scheduler_after},
+        },
+    }
 
-    for idx, d in enumerate(frame_descriptions):
-        final_human_content.append({"type": "text", "text": f"Descrizione frame {idx+1}: {d}"})
 
-    final_human_message = HumanMessage(content=final_human_content)
+@app.get("/cache/stats")
+def cache_stats():
+    """
+    Contatori della cache delle risposte (hit/miss del processo, voci e dimensione su disco).
+    """
+    return get_response_cache().stats()
+
 
-    print("Invio richiesta al modello per la descrizione finale...")
-    final_response = chat(messages + [final_human_message])
-    final_text = final_response.content
-    print("Parsing descrizione finale...")
+@app.get("/metrics")
+def metrics():
+    """
+    Metriche in formato Prometheus: durata delle fasi, frame analizzati, token, errori di parsing, cache e job.
+    """
+    from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
-    final_start_tag = "<attribute=final_description|"
-    final_end_tag = "| attribute=final_description>"
-    fs_idx = final_text.find(final_start_tag)
-    fe_idx = final_text.find(final_end_tag)
-    if fs_idx == -1 or fe_idx == -1:
-        print("Errore: formato non corretto nella descrizione finale del modello.")
-        raise ValueError("La risposta del modello non contiene la descrizione finale formattata correttamente.")
-    final_json_str = final_text[fs_idx+len(final_start_tag):fe_idx].strip()
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
-    try:
-        final_desc_dict = json.loads(final_json_str)
-        final_description = final_desc_dict.get("descrizione_finale", "")
-        print("Descrizione finale estratta con successo.")
-    except:
-        print("Errore nel parsing del JSON per la descrizione finale.")
-        raise ValueError("Errore nel parsing del JSON per la descrizione finale.")
-
-    print("Processo completato con successo.")
+
+@app.get("/backend/stats")
+def backend_stats():
+    """
+    Backend del modello in uso e contatori dello scheduler (tentativi, retry, fallimenti, attesa per i limiti).
+    """
     return {
-        "frame_descriptions": frame_descriptions,
-        "final_description": final_description
+        "backend": chat.kind,
+        "model": chat.model_name,
+        "concurrency": chat.concurrency,
+        "timeout": chat.timeout,
+        "scheduler": chat.scheduler.stats(),
     }
+
+
+# ---------------------------------
+# Job asincroni
+# ---------------------------------
+# Ogni job viene eseguito da un pool di worker di dimensione fissa: la richiesta HTTP
+# ritorna subito con l'id del job e lo stato (con i risultati parziali) si legge da GET /jobs/{job_id}.
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="video-job")
+jobs: Dict[str, dict] = {}
+jobs_lock = threading.Lock()
+
+
+def _prune_finished_jobs() -> None:
+    # Da chiamare con jobs_lock acquisito
+    now = time.time()
+    expired = [
+        job_id for job_id, job in jobs.items()
+        if job["finished_at"] is not None and now - job["finished_at"] > JOB_RETENTION_SECONDS
+    ]
+    for job_id in expired:
+        del jobs[job_id]
+
+
+def _run_job(job_id: str, video_path: str, temporary: bool, options: AnalysisOptions) -> None:
+    job = jobs[job_id]
+    with jobs_lock:
+        job["status"] = "running"
+        job["started_at"] = time.time()
+    JOBS_IN_FLIGHT.inc()
+    try:
+        for event in analyze_video_events(video_path, options):
+            with jobs_lock:
+                if event["event"] == "frames_extracted":
+                    job["num_frames"] = event["num_frames"]
+                apply_event(job, event)
+        with jobs_lock:
+            job["status"] = "completed"
+    except Exception as e:
+        print(f"Errore nell'esecuzione del job {job_id}: {e}")
+        with jobs_lock:
+            job["status"] = "failed"
+            job["error"] = str(e)
+    finally:
+        JOBS_IN_FLIGHT.dec()
+        with jobs_lock:
+            job["finished_at"] = time.time()
+        if temporary:
+            cleanup_video(video_path)
+
+
+@app.post("/jobs", status_code=202)
+def create_job(req: VideoRequest):
+    """
+    Accoda l'analisi di un video e restituisce subito l'id del job.
+    """
+    options = AnalysisOptions(**req.model_dump(exclude=set(VideoSource.model_fields)))
+    job_id = str(uuid.uuid4())
+    # Controllo del limite e prenotazione del posto nello stesso blocco: richieste concorrenti
+    # non possono superare MAX_PENDING_JOBS
+    with jobs_lock:
+        _prune_finished_jobs()
+        pending = sum(1 for job in jobs.values() if job["status"] in ("queued", "running"))
+        if pending >= MAX_PENDING_JOBS:
+            raise HTTPException(status_code=429, detail="Troppi job in coda, riprovare più tardi.")
+        jobs[job_id] = {
+            "job_id": job_id,
+            "status": "queued",
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "num_frames": None,
+            "frame_descriptions": [],
+            "final_description": None,
+            "frame_timestamps": [],
+            "duplicate_frames": [],
+            "frame_image_tokens": [],
+            "resumed_frames": 0,
+            "segment_summaries": [],
+            "budget": None,
+            "error": None,
+        }
+
+    # Il video viene aperto (decodificato, scaricato o verificato) fuori dal lock; se non è valido il posto viene liberato
+    try:
+        video_path, temporary = open_video_source(req)
+    except BaseException:
+        with jobs_lock:
+            jobs.pop(job_id, None)
+        raise
+    job_executor.submit(_run_job, job_id, video_path, temporary, options)
+    print(f"Job {job_id} accodato.")
+    return {"job_id": job_id, "status": "queued"}
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    """
+    Restituisce lo stato del job e i risultati parziali disponibili.
+    """
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Job non trovato")
+        snapshot = dict(job)
+        snapshot["frame_descriptions"] = list(job["frame_descriptions"])
+        snapshot["segment_summaries"] = list(job["segment_summaries"])
+    return snapshot
@@ -0,0 +1,56 @@
+import base64
+import os
+import sys
+
+import pytest
+
+# I moduli dell'app si importano come nei processi dell'API e delle interfacce (dalla cartella app/)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# main crea il backend all'import: lo stub risponde senza chiamate di rete né chiave API
+os.environ.setdefault("VIDEO_ANALYSIS_BACKEND", "stub")
+
+
+@pytest.fixture
+def stores(tmp_path, monkeypatch):
+    """
+    Cache delle risposte e checkpoint in una cartella temporanea, al posto di quelli condivisi del processo.
+    """
+    from analysis_core import cache, checkpoints
+
+    response_cache = cache.ResponseCache(str(tmp_path / "cache.sqlite"), max_bytes=1024 * 1024, ttl_seconds=3600)
+    checkpoint_store = checkpoints.CheckpointStore(str(tmp_path / "checkpoints.sqlite"), ttl_seconds=3600)
+    monkeypatch.setattr(cache, "_response_cache", response_cache)
+    monkeypatch.setattr(checkpoints, "_checkpoint_store", checkpoint_store)
+    return response_cache, checkpoint_store
+
+
+@pytest.fixture
+def api(stores):
+    """
+    Modulo main e client di test dell'API, con il backend stub.
+    """
+    from fastapi.testclient import TestClient
+
+    import main
+
+    return main, TestClient(main.app, raise_server_exceptions=False)
+
+
+@pytest.fixture(scope="session")
+def video_base64(tmp_path_factory) -> str:
+    """
+    Video di prova di 4 secondi (40 frame a 10 fps) con contenuto diverso in ogni secondo.
+    """
+    import cv2
+    import numpy as np
+
+    path = str(tmp_path_factory.mktemp("video") / "test.mp4")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), 10, (160, 120))
+    for index in range(40):
+        image = np.zeros((120, 160, 3), np.uint8)
+        image[:] = (index * 6) % 255
+        cv2.putText(image, str(index // 10), (50, 80), cv2.FONT_HERSHEY_SIMPLEX, 2, (255, 255, 255), 4)
+        writer.write(image)
+    writer.release()
+    with open(path, "rb") as f:
+        return base64.b64encode(f.read()).decode()
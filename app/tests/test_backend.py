@@ -0,0 +1,95 @@
+import asyncio
+import time
+
+import pytest
+from langchain_core.messages import HumanMessage
+
+from analysis_core.backend import BACKEND_DEFAULTS, create_backend
+from analysis_core.scheduler import RateLimitScheduler
+
+
+def test_stub_backend_defaults_and_env_overrides(monkeypatch):
+    backend = create_backend("stub")
+    assert (backend.kind, backend.model_name) == ("stub", "stub")
+    assert backend.concurrency == BACKEND_DEFAULTS["stub"]["concurrency"]
+
+    monkeypatch.setenv("VIDEO_ANALYSIS_BACKEND", "stub")
+    monkeypatch.setenv("VIDEO_ANALYSIS_BACKEND_CONCURRENCY", "3")
+    assert create_backend().concurrency == 3
+
+
+def test_invalid_backend_configuration_is_rejected(monkeypatch):
+    monkeypatch.delenv("VIDEO_ANALYSIS_BASE_URL", raising=False)
+    with pytest.raises(ValueError):
+        create_backend("sconosciuto")
+    with pytest.raises(ValueError):
+        create_backend("openai_compatible")
+
+
+def test_openai_compatible_backend_is_created_without_loading_the_client():
+    backend = create_backend("openai_compatible", model="llava", base_url="http://localhost:8000/v1")
+
+    assert backend.model_name == "llava"
+    assert backend._model is None
+
+
+def test_stub_backend_answers_sync_and_async_calls():
+    backend = create_backend("stub")
+    frame = HumanMessage(content=[{"type": "text", "text": "Analizza il frame seguente."},
+                                  {"type": "image_url", "image_url": {"url": "data:image/jpeg;base64,AAAA"}}])
+
+    assert "frame_description" in backend([frame]).content
+    assert "frame_description" in asyncio.run(backend.ainvoke([frame])).content
+    assert backend.scheduler.stats()["calls"] == 2
+
+
+def free_slots(backend) -> int:
+    taken = 0
+    while backend._slots.acquire(blocking=False):
+        taken += 1
+    for _ in range(taken):
+        backend._slots.release()
+    return taken
+
+
+def test_cancelled_queued_call_gives_its_slot_back_after_the_loop_is_closed():
+    backend = create_backend("stub", concurrency=1)
+    backend.scheduler = RateLimitScheduler()
+    backend._slots.acquire()
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(backend.ainvoke([HumanMessage(content="Genera la descrizione finale.")]))
+    # La chiamata resta in attesa del posto in un thread del pool
+    loop.run_until_complete(asyncio.sleep(0.05))
+
+    task.cancel()
+    loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+    # Come _describe_frames_parallel: l'event loop viene chiuso subito dopo l'annullamento
+    loop.close()
+    backend._slots.release()
+    # Il posto liberato viene preso dal thread in attesa, che deve restituirlo da solo
+    time.sleep(0.2)
+
+    deadline = time.monotonic() + 2
+    while free_slots(backend) != 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert free_slots(backend) == 1
+
+
+def test_cancellation_after_the_slot_is_obtained_releases_it():
+    backend = create_backend("stub", concurrency=2)
+
+    async def cancel_while_waiting():
+        backend._slots.acquire()
+        backend._slots.acquire()
+        task = asyncio.create_task(backend.ainvoke([HumanMessage(content="Genera la descrizione finale.")]))
+        await asyncio.sleep(0.05)
+        # Il posto si libera e viene preso dal thread, ma la chiamata viene annullata prima di ripartire
+        backend._slots.release()
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        backend._slots.release()
+
+    asyncio.run(cancel_while_waiting())
+
+    assert free_slots(backend) == 2
@@ -0,0 +1,43 @@
+import threading
+import time
+
+
+def test_batch_is_rejected_when_too_many_videos_are_pending(api, video_base64, monkeypatch):
+    main, client = api
+    monkeypatch.setattr(main, "MAX_PENDING_BATCH_VIDEOS", 2)
+    videos = [{"video_base64": video_base64}] * 3
+
+    response = client.post("/analyze_videos", json={"videos": videos, "num_frames": 2})
+
+    assert response.status_code == 429
+    assert main.batch_state["pending"] == 0
+
+
+def test_batch_videos_share_the_backend_capacity(api, monkeypatch):
+    main, client = api
+    running, peak = [], []
+    lock = threading.Lock()
+
+    def analyze(video_id, source, options, submitted_at):
+        with lock:
+            running.append(main._video_concurrency(options))
+            peak.append(sum(running))
+        time.sleep(0.05)
+        with lock:
+            running.pop()
+        return {"id": video_id, "status": "completed", "error": None,
+                "timing": {"queued_seconds": 0.0, "analysis_seconds": 0.05}}
+
+    monkeypatch.setattr(main, "_analyze_batch_video", analyze)
+    monkeypatch.setattr(main, "BATCH_CAPACITY", 4)
+    videos = [{"video_path": f"video_{k}.mp4"} for k in range(6)]
+
+    body = {"videos": videos, "analysis_mode": "parallel", "max_concurrency": 3}
+    assert client.post("/analyze_videos", json=body).status_code == 200
+    # Ogni video "parallel" occupa 3 unità su 4: uno alla volta
+    assert max(peak) == 3
+
+    body = {"videos": videos, "analysis_mode": "sequential"}
+    assert client.post("/analyze_videos", json=body).status_code == 200
+    assert max(peak) <= 4
+    assert main.batch_state == {"pending": 0, "in_use": 0}
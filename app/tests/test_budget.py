@@ -0,0 +1,134 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from analysis_core import budget as budget_module
+from analysis_core.budget import AnalysisBudget, BudgetExceeded
+
+
+class Usage:
+    def __init__(self, input_tokens, output_tokens):
+        self.usage_metadata = {"input_tokens": input_tokens, "output_tokens": output_tokens}
+        self.content = ""
+
+
+class SlowChat:
+    """
+    Backend stub con un ritardo fisso per chiamata e, se indicato, un consumo fisso di token per le chiamate
+    con immagini (lo stub conta come token anche i caratteri delle immagini in base64).
+    """
+
+    def __init__(self, chat, delay=0.0, frame_tokens=None):
+        self.chat = chat
+        self.delay = delay
+        self.frame_tokens = frame_tokens
+
+    def __getattr__(self, name):
+        return getattr(self.chat, name)
+
+    def _usage(self, messages, response):
+        if self.frame_tokens is not None and "image_url" in json.dumps(messages[-1].content):
+            response.usage_metadata = {"input_tokens": self.frame_tokens, "output_tokens": 0,
+                                       "total_tokens": self.frame_tokens}
+        return response
+
+    def __call__(self, messages):
+        time.sleep(self.delay)
+        return self._usage(messages, self.chat(messages))
+
+    async def ainvoke(self, messages):
+        await asyncio.sleep(self.delay)
+        return self._usage(messages, await self.chat.ainvoke(messages))
+
+
+def test_token_budget_counts_the_reserve():
+    budget = AnalysisBudget(max_tokens=1000)
+    budget.record(["x"], Usage(500, 100), 0.1)
+    budget.check()
+
+    budget.reserve(400, 1)
+    with pytest.raises(BudgetExceeded) as exc:
+        budget.check()
+    assert exc.value.reason == "tokens"
+
+    budget.reserve(0, 0)
+    budget.check()
+    assert budget.usage()["tokens"] == 600
+
+
+def test_time_budget_uses_the_average_call_duration(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(budget_module.time, "monotonic", lambda: now[0])
+    budget = AnalysisBudget(max_seconds=10)
+    budget.record(["x"], Usage(1, 1), 3.0)
+    now[0] += 5
+
+    assert budget.exhausted() is None
+    budget.reserve(0, 2)
+    assert budget.exhausted() == "time"
+
+
+def test_missing_usage_is_estimated_from_the_request():
+    budget = AnalysisBudget()
+    response = type("Response", (), {"content": "x" * 40})()
+
+    budget.record(["y" * 400], response, 0.0)
+
+    assert budget.prompt_tokens == 100
+    assert budget.completion_tokens == 10
+
+
+@pytest.mark.parametrize("analysis_mode", ["sequential", "parallel"])
+def test_time_budget_stops_the_analysis_with_partial_results(api, video_base64, monkeypatch, analysis_mode):
+    main, client = api
+    monkeypatch.setattr(main, "chat", SlowChat(main.chat, delay=0.1))
+    body = {"video_base64": video_base64, "num_frames": 12, "analysis_mode": analysis_mode, "max_seconds": 0.6,
+            "max_concurrency": 1, "use_cache": False, "resume": False}
+
+    response = client.post("/analyze_video", json=body)
+
+    assert response.status_code == 200
+    result = response.json()
+    described = [d for d in result["frame_descriptions"] if d is not None]
+    assert result["budget"]["stopped"] == "time"
+    assert 0 < len(described) < 12
+    assert len(result["frame_descriptions"]) == 12
+    assert result["final_description"]
+
+
+def test_token_budget_limits_the_frames_up_front(api, video_base64):
+    main, client = api
+    body = {"video_base64": video_base64, "num_frames": 12, "max_tokens_budget": 15000, "use_cache": False,
+            "resume": False}
+
+    result = client.post("/analyze_video", json=body).json()
+
+    assert 0 < result["budget"]["frame_limit"] < 12
+    assert len(result["frame_descriptions"]) == result["budget"]["frame_limit"]
+    assert result["budget"]["estimated_tokens"] <= 15000
+
+
+def test_token_budget_stops_when_calls_cost_more_than_estimated(api, video_base64, monkeypatch):
+    main, client = api
+    monkeypatch.setattr(main, "chat", SlowChat(main.chat, frame_tokens=3500))
+    body = {"video_base64": video_base64, "num_frames": 12, "max_tokens_budget": 15000, "use_cache": False,
+            "resume": False}
+
+    result = client.post("/analyze_video", json=body).json()
+
+    described = [d for d in result["frame_descriptions"] if d is not None]
+    assert result["budget"]["stopped"] == "tokens"
+    assert 0 < len(described) < result["budget"]["frame_limit"]
+    # La riserva lascia spazio alla descrizione finale dei frame già descritti
+    assert result["final_description"]
+    assert result["budget"]["tokens"] <= 15000
+
+
+def test_too_small_token_budget_is_rejected(api, video_base64):
+    main, client = api
+    response = client.post("/analyze_video", json={"video_base64": video_base64, "num_frames": 4,
+                                                   "max_tokens_budget": 100})
+
+    assert response.status_code == 422
@@ -0,0 +1,72 @@
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from analysis_core import cache
+from analysis_core.cache import ResponseCache, cached_call, conversation_context, make_cache_key, messages_cache_key
+
+
+def make_cache(tmp_path, max_bytes=1024 * 1024, ttl_seconds=3600) -> ResponseCache:
+    return ResponseCache(str(tmp_path / "cache.sqlite"), max_bytes=max_bytes, ttl_seconds=ttl_seconds)
+
+
+def test_entries_expire_after_the_ttl(tmp_path, monkeypatch):
+    response_cache = make_cache(tmp_path, ttl_seconds=60)
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "time", lambda: now[0])
+
+    response_cache.set("k", "risposta")
+    now[0] += 59
+    assert response_cache.get("k") == "risposta"
+    now[0] += 2
+    assert response_cache.get("k") is None
+    assert response_cache.stats()["hits"] == 1
+    assert response_cache.stats()["misses"] == 1
+
+    # Le voci scadute vengono eliminate al salvataggio successivo
+    response_cache.set("altra", "x")
+    assert response_cache.stats()["entries"] == 1
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, monkeypatch):
+    response_cache = make_cache(tmp_path, max_bytes=30)
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "time", lambda: now[0])
+
+    for key in ("a", "b", "c"):
+        response_cache.set(key, "x" * 10)
+        now[0] += 1
+    # "a" è stata letta di recente: la meno usata diventa "b"
+    assert response_cache.get("a") is not None
+    now[0] += 1
+    response_cache.set("d", "x" * 10)
+
+    assert response_cache.get("b") is None
+    assert all(response_cache.get(key) is not None for key in ("a", "c", "d"))
+    assert response_cache.stats()["size_bytes"] <= 30
+
+
+def test_context_changes_the_key_only_when_present():
+    key = make_cache_key(["img"], "prompt", "", "modello")
+
+    assert make_cache_key(["img"], "prompt", "", "modello", conversation_context(None, None, "history=full")) == key
+    first = make_cache_key(["img"], "prompt", "", "modello", conversation_context("k1", "risposta 1", "history=full"))
+    other = make_cache_key(["img"], "prompt", "", "modello", conversation_context("k2", "risposta 1", "history=full"))
+    assert len({key, first, other}) == 3
+
+
+def test_cached_call_keys_on_the_whole_conversation(stores):
+    calls = []
+
+    def call(messages):
+        calls.append(messages)
+        return f"risposta {len(calls)}"
+    cached = cached_call(call, "stub")
+    frame = HumanMessage(content=[{"type": "text", "text": "frame"},
+                                  {"type": "image_url", "image_url": {"url": "data:image/jpeg;base64,AAAA"}}])
+    conversation_a = [SystemMessage(content="s"), HumanMessage(content="primo"), AIMessage(content="a"), frame]
+    conversation_b = [SystemMessage(content="s"), HumanMessage(content="altro"), AIMessage(content="a"), frame]
+
+    assert cached(conversation_a) == "risposta 1"
+    assert cached(conversation_a) == "risposta 1"
+    assert cached(conversation_b) == "risposta 2"
+    assert len(calls) == 2
+    assert messages_cache_key(conversation_a, "stub") != messages_cache_key(conversation_a, "altro modello")
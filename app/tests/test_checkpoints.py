@@ -0,0 +1,94 @@
+import json
+
+from analysis_core.checkpoints import CheckpointStore, RunCheckpoint, get_checkpoint_store
+
+
+class FailingChat:
+    """
+    Backend stub che fallisce dalla chiamata numero `fail_at` (da 1) in poi; conta le chiamate con immagini.
+    """
+
+    def __init__(self, chat, fail_at=None):
+        self.chat = chat
+        self.fail_at = fail_at
+        self.calls = 0
+        self.frame_calls = 0
+
+    def __getattr__(self, name):
+        return getattr(self.chat, name)
+
+    def __call__(self, messages):
+        self.calls += 1
+        if self.fail_at is not None and self.calls >= self.fail_at:
+            raise RuntimeError("modello non raggiungibile")
+        if "image_url" in json.dumps(messages[-1].content):
+            self.frame_calls += 1
+        return self.chat(messages)
+
+
+def test_store_keeps_steps_per_run_and_deletes_segments(tmp_path):
+    store = CheckpointStore(str(tmp_path / "checkpoints.sqlite"), ttl_seconds=3600)
+    run = RunCheckpoint(store, "run")
+    run.save(0, [{"index": 0, "descrizione_frame": "a"}, {"index": 1, "descrizione_frame": "b"}], "risposta 0")
+    run.segment(1).save(0, [{"index": 5, "descrizione_frame": "c"}], "risposta s1")
+    RunCheckpoint(store, "altra").save(0, [{"index": 0, "descrizione_frame": "x"}], "r")
+
+    resumed = RunCheckpoint(store, "run")
+    assert resumed.resumed_frames == 2
+    assert resumed.get(0) == ([{"index": 0, "descrizione_frame": "a"}, {"index": 1, "descrizione_frame": "b"}],
+                              "risposta 0")
+    assert RunCheckpoint(store, "run").segment(1).resumed_frames == 1
+
+    resumed.complete()
+    assert store.stats() == {"runs": 1, "steps": 1, "ttl_seconds": 3600}
+
+
+def test_disabled_checkpoint_saves_nothing():
+    run = RunCheckpoint(None, None)
+    run.save(0, [{"index": 0}], "r")
+    assert run.get(0) is None
+    assert run.resumed_frames == 0
+
+
+def test_interrupted_analysis_resumes_from_the_last_described_frame(api, video_base64, monkeypatch):
+    main, client = api
+    body = {"video_base64": video_base64, "num_frames": 6, "use_cache": False, "resume": True}
+
+    failing = FailingChat(main.chat, fail_at=4)
+    monkeypatch.setattr(main, "chat", failing)
+    assert client.post("/analyze_video", json=body).status_code == 500
+    assert failing.frame_calls == 3
+
+    resumed = FailingChat(main.chat.chat)
+    monkeypatch.setattr(main, "chat", resumed)
+    response = client.post("/analyze_video", json=body)
+
+    assert response.status_code == 200
+    result = response.json()
+    assert result["resumed_frames"] == 3
+    assert resumed.frame_calls == 3
+    assert len(result["frame_descriptions"]) == 6
+    assert all(result["frame_descriptions"])
+    assert result["final_description"]
+    # Conclusa l'analisi il checkpoint viene eliminato
+    assert get_checkpoint_store().stats()["steps"] == 0
+
+
+def test_segments_resume_per_segment(api, video_base64, monkeypatch):
+    main, client = api
+    # Senza sovrapposizione ogni frame appartiene a un solo segmento
+    body = {"video_base64": video_base64, "num_frames": 8, "analysis_mode": "segments", "segment_seconds": 1,
+            "segment_overlap_seconds": 0, "use_cache": False, "resume": True, "max_concurrency": 1}
+
+    failing = FailingChat(main.chat, fail_at=6)
+    monkeypatch.setattr(main, "chat", failing)
+    assert client.post("/analyze_video", json=body).status_code == 500
+
+    resumed = FailingChat(main.chat.chat)
+    monkeypatch.setattr(main, "chat", resumed)
+    response = client.post("/analyze_video", json=body)
+
+    assert response.status_code == 200
+    assert 0 < failing.frame_calls < 8
+    assert response.json()["resumed_frames"] == failing.frame_calls
+    assert failing.frame_calls + resumed.frame_calls == 8
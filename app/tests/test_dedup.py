@@ -0,0 +1,63 @@
+import cv2
+import numpy as np
+
+from analysis_core.dedup import color_signature, dhash, hamming_distance, suppress_near_duplicates
+from analysis_core.frames import ExtractedFrame, extract_frames
+
+
+def make_frame(index: int, image: np.ndarray) -> ExtractedFrame:
+    height, width = image.shape[:2]
+    return ExtractedFrame(index=index, timestamp=index / 10, jpeg=b"", width=width, height=height,
+                          dhash=dhash(image), color=color_signature(image))
+
+
+def solid(bgr) -> np.ndarray:
+    image = np.zeros((64, 64, 3), np.uint8)
+    image[:] = bgr
+    return image
+
+
+def test_solid_frames_of_different_colours_are_not_duplicates():
+    blue, green = make_frame(0, solid((255, 0, 0))), make_frame(1, solid((0, 255, 0)))
+    assert blue.dhash == green.dhash
+
+    kept, dropped = suppress_near_duplicates([blue, green], threshold=5)
+
+    assert [frame.index for frame in kept] == [0, 1]
+    assert dropped == []
+
+
+def test_near_identical_frames_are_dropped():
+    rng = np.random.default_rng(0)
+    base = np.tile(np.linspace(0, 255, 64, dtype=np.uint8), (64, 1))
+    frames = []
+    for index in range(4):
+        noise = rng.integers(-2, 3, base.shape)
+        gray = np.clip(base.astype(int) + noise, 0, 255).astype(np.uint8)
+        frames.append(make_frame(index, cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)))
+
+    kept, dropped = suppress_near_duplicates(frames, threshold=5)
+
+    assert [frame.index for frame in kept] == [0]
+    assert [d["frame_index"] for d in dropped] == [1, 2, 3]
+    assert all(d["duplicate_of"] == 0 for d in dropped)
+
+
+def test_colour_only_scene_cut_is_kept(tmp_path):
+    # Stessa struttura (una barra bianca) su sfondo blu e poi verde: il dHash dei due tratti è uguale
+    path = str(tmp_path / "cut.mp4")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), 10, (128, 96))
+    for index in range(20):
+        image = np.zeros((96, 128, 3), np.uint8)
+        image[:] = (200, 40, 40) if index < 10 else (40, 200, 40)
+        image[40:56, 20:108] = 255
+        writer.write(image)
+    writer.release()
+
+    frames = extract_frames(path, width=64, height=48, num_frames=4)
+    kept, dropped = suppress_near_duplicates(frames, threshold=5)
+
+    assert hamming_distance(frames[0].dhash, frames[-1].dhash) < 5
+    assert [frame.index < 10 for frame in kept] == [True, False]
+    assert len(dropped) == 2
+
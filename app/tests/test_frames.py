@@ -0,0 +1,25 @@
+import cv2
+import numpy as np
+
+from analysis_core.frames import SEEK_MIN_GAP, choose_read_strategy, extract_frames
+
+
+def test_auto_read_strategy_switches_to_seek_above_the_measured_crossover():
+    assert choose_read_strategy(list(range(0, 600, SEEK_MIN_GAP))) == "sequential"
+    assert choose_read_strategy(list(range(0, 600, 25))) == "seek"
+    assert choose_read_strategy(list(range(0, 600, 30))) == "seek"
+    assert choose_read_strategy(list(range(0, 600, 30)), "sequential") == "sequential"
+
+
+def test_extracted_frames_keep_only_the_jpeg_and_its_size(tmp_path):
+    path = str(tmp_path / "clip.mp4")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), 10, (160, 120))
+    for index in range(10):
+        writer.write(np.full((120, 160, 3), index * 20, np.uint8))
+    writer.release()
+
+    frames = extract_frames(path, width=64, height=48, num_frames=2)
+
+    assert [(frame.width, frame.height) for frame in frames] == [(64, 48), (64, 48)]
+    assert not hasattr(frames[0], "image")
+    assert cv2.imdecode(np.frombuffer(frames[0].jpeg, np.uint8), cv2.IMREAD_COLOR).shape == (48, 64, 3)
@@ -0,0 +1,116 @@
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from analysis_core.parsing import (ReplyParseError, format_frame_reply, parse_final_description,
+                                   parse_frame_description, parse_indexed_frame_descriptions, parse_reply, strip_tags)
+from analysis_core.sequential import describe_frame
+from analysis_core.summarize import FINAL_INSTRUCTION, TimedText, summarize_group
+
+
+def frame_block(body: str) -> str:
+    return f"<attribute=frame_description| {body} | attribute=frame_description>"
+
+
+@pytest.mark.parametrize("body", [
+    '{"descrizione_frame": "un furgone bianco"}',
+    '```json\n{"descrizione_frame": "un furgone bianco"}\n```',
+    '{“descrizione_frame”: “un furgone bianco”}',
+    '{"descrizione_frame": "un furgone bianco",}',
+    '{"descrizione_frame": "un furgone bianco"',
+    "{'descrizione_frame': 'un furgone bianco'}",
+])
+def test_frame_description_is_repaired(body):
+    assert parse_frame_description("Ecco la descrizione:\n" + frame_block(body)) == "un furgone bianco"
+
+
+def test_unescaped_quotes_and_newlines_are_kept_in_the_value():
+    reply = frame_block('{"descrizione_frame": "cartello "PERICOLO"\nsul cancello", "timestamp_frame": "00:15"}')
+
+    parsed = parse_reply(reply)
+
+    assert parsed.frames == [(None, 'cartello "PERICOLO"\nsul cancello')]
+    assert parsed.frame_fields[0]["timestamp_frame"] == "00:15"
+
+
+def test_tags_with_spaces_and_several_blocks():
+    reply = (
+        '< attribute = frame_description | {"descrizione_frame": "a"} | attribute=frame_description >\n'
+        + frame_block('{"indice_frame": "7", "descrizione_frame": "b"}')
+        + '<attribute=final_description| {"descrizione_finale": "fine"} | attribute=final_description>'
+    )
+
+    # Senza indice_frame vale la posizione del blocco a partire da first_frame_number
+    assert parse_indexed_frame_descriptions(reply, first_frame_number=6) == {6: "a", 7: "b"}
+    assert parse_final_description(reply) == "fine"
+
+
+def test_unreadable_block_raises_reply_parse_error():
+    reply = frame_block("descrizione senza json")
+
+    assert parse_reply(reply).failed_blocks == ["frame_description"]
+    with pytest.raises(ReplyParseError):
+        parse_frame_description(reply)
+    with pytest.raises(ReplyParseError):
+        parse_final_description("nessun blocco")
+    assert strip_tags(reply) == "descrizione senza json"
+
+
+def test_describe_frame_reasks_once_after_an_unparseable_reply():
+    replies = ["non rispetto il formato", frame_block('{"descrizione_frame": "recinzione integra"}')]
+    requests = []
+
+    def call(messages):
+        requests.append(messages)
+        return replies[len(requests) - 1]
+
+    description, ai_response = describe_frame(call, [SystemMessage(content="s")], HumanMessage(content="frame"))
+
+    assert description == "recinzione integra"
+    assert ai_response == replies[1]
+    assert len(requests) == 2
+    assert [m.content for m in requests[1][1:3]] == ["frame", "non rispetto il formato"]
+    assert "formato richiesto" in requests[1][-1].content
+
+
+def test_describe_frame_falls_back_to_the_text_without_tags():
+    replies = ["non rispetto il formato", "<attribute=frame_description| ancora testo libero"]
+
+    def call(messages):
+        return replies.pop(0)
+
+    description, _ = describe_frame(call, [SystemMessage(content="s")], HumanMessage(content="frame"))
+
+    assert description == "ancora testo libero"
+
+
+def test_summary_falls_back_to_the_text_without_tags():
+    replies = ["riassunto senza tag", "<attribute=final_description| ancora testo libero"]
+
+    def call(messages):
+        return replies.pop(0)
+
+    items = [TimedText(0.0, 0.0, "a"), TimedText(1.0, 1.0, "b")]
+    summary = summarize_group(call, SystemMessage(content="s"), items, FINAL_INSTRUCTION)
+
+    assert summary.description == "ancora testo libero"
+
+
+def test_history_keeps_a_well_formed_reply_after_a_reask(api, video_base64, monkeypatch):
+    main, client = api
+    requests = []
+    stub = main.chat
+
+    def chat(messages):
+        requests.append(messages)
+        # La prima risposta (frame 1) non è interpretabile; la nuova richiesta del frame risponde correttamente
+        if len(requests) == 1:
+            return AIMessage(content="non rispetto il formato")
+        return stub(messages)
+
+    monkeypatch.setattr(main, "chat", chat)
+    body = {"video_base64": video_base64, "num_frames": 2, "use_cache": False, "resume": False}
+    result = client.post("/analyze_video", json=body).json()
+
+    second_frame_history = [m.content for m in requests[2] if isinstance(m, AIMessage)]
+    assert second_frame_history == [format_frame_reply([result["frame_descriptions"][0]])]
+    assert parse_frame_description(second_frame_history[0]) == result["frame_descriptions"][0]
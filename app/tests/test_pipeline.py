@@ -0,0 +1,92 @@
+import base64
+
+import pytest
+
+from analysis_core.backend import get_chat_backend
+from analysis_core.budget import BudgetExceeded
+from analysis_core.pipeline import AnalysisOptions, InvalidOptions, VideoAnalyzer
+from analysis_core.sequential import FrameRequest, describe_frames_sequential
+
+
+class QuotaChat:
+    """
+    Backend stub con un numero massimo di chiamate, come il limite di frame dell'interfaccia dei dati salvati.
+    """
+
+    def __init__(self, chat, max_calls):
+        self.chat = chat
+        self.max_calls = max_calls
+        self.requests = []
+        self.model_name = chat.model_name
+
+    def __call__(self, messages):
+        if len(self.requests) >= self.max_calls:
+            raise BudgetExceeded("frames")
+        self.requests.append(messages)
+        return self.chat(messages)
+
+
+def _extracted_frames(video_base64, tmp_path, num_frames):
+    from analysis_core.frames import extract_frames
+
+    path = tmp_path / "video.mp4"
+    path.write_bytes(base64.b64decode(video_base64))
+    return extract_frames(str(path), width=64, height=64, num_frames=num_frames)
+
+
+def test_pre_extracted_frames_with_timestamps_and_instruction_suffix(stores, video_base64, tmp_path):
+    chat = QuotaChat(get_chat_backend(), max_calls=100)
+    analyzer = VideoAnalyzer(chat, "sistema", instruction_suffix=" Stile sintetico.", frame_timestamps=True,
+                             source="ui")
+    frames = _extracted_frames(video_base64, tmp_path, 3)
+    options = AnalysisOptions(use_cache=False, resume=False)
+
+    events = list(analyzer.analyze_video_events(None, options, frames, video_hash="hash"))
+
+    assert [e["index"] for e in events if e["event"] == "frame_description"] == [0, 1, 2]
+    first_text = chat.requests[0][-1].content[0]["text"]
+    assert first_text.startswith("Timestamp: ")
+    assert first_text.endswith(" Stile sintetico.")
+    assert events[-1]["event"] == "final_description"
+    assert events[-1]["descrizione_finale"]
+
+
+def test_call_quota_stops_the_frames_and_the_final_description(stores, video_base64, tmp_path):
+    analyzer = VideoAnalyzer(QuotaChat(get_chat_backend(), max_calls=2), "sistema")
+    frames = _extracted_frames(video_base64, tmp_path, 4)
+
+    events = list(analyzer.analyze_video_events(None, AnalysisOptions(use_cache=False, resume=False), frames,
+                                                video_hash="hash"))
+
+    assert len([e for e in events if e["event"] == "frame_description"]) == 2
+    budget = next(e for e in events if e["event"] == "budget")
+    assert budget["stopped"] == "frames"
+    assert events[-1]["descrizione_finale"] == ""
+
+
+def test_invalid_options_are_rejected_before_extraction():
+    analyzer = VideoAnalyzer(get_chat_backend(), "sistema")
+    options = AnalysisOptions(analysis_mode="segments", segment_seconds=0)
+
+    with pytest.raises(InvalidOptions):
+        next(analyzer.analyze_video_events("/percorso/inesistente.mp4", options))
+
+
+def test_sequential_helper_reads_frames_lazily():
+    from langchain_core.messages import SystemMessage
+
+    chat = get_chat_backend()
+    read = []
+
+    def requests():
+        for index in range(3):
+            read.append(index)
+            yield FrameRequest(f"Frame {index}", "data:image/jpeg;base64,AAAA")
+
+    results = describe_frames_sequential(lambda messages: chat(messages).content, SystemMessage(content="sistema"),
+                                         requests())
+    # Il frame successivo viene letto solo dopo aver descritto il precedente
+    index, description, reply = next(results)
+    assert (index, read) == (0, [0])
+    assert description in reply
+    assert [index for index, _, _ in results] == [1, 2]
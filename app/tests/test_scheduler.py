@@ -0,0 +1,155 @@
+import asyncio
+import time
+
+import pytest
+from langchain_core.messages import HumanMessage
+
+from analysis_core import scheduler
+from analysis_core.backend import StubChatModel, create_backend
+from analysis_core.scheduler import RateLimitScheduler
+
+
+class FakeResponse:
+    def __init__(self, headers: dict):
+        self.headers = headers
+
+
+class RateLimitError(Exception):
+    status_code = 429
+
+    def __init__(self, headers: dict = None):
+        super().__init__("rate limit")
+        self.response = FakeResponse(headers or {})
+
+
+class ServerError(Exception):
+    def __init__(self):
+        super().__init__("bad gateway")
+        self.status_code = 502
+
+
+def failing(errors: list, result="ok"):
+    """
+    Funzione che solleva in ordine gli errori della lista e poi restituisce `result`.
+    """
+    attempts = []
+
+    def fn():
+        attempts.append(time.monotonic())
+        if len(attempts) <= len(errors):
+            raise errors[len(attempts) - 1]
+        return result
+    fn.attempts = attempts
+    return fn
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    recorded = []
+    monkeypatch.setattr(scheduler.time, "sleep", recorded.append)
+    return recorded
+
+
+def test_retry_after_is_honoured_and_pauses_the_whole_process(sleeps):
+    rate_limiter = RateLimitScheduler(max_retries=3)
+    fn = failing([RateLimitError({"retry-after": "3"})])
+
+    assert rate_limiter.call(fn, ["ciao"]) == "ok"
+    assert len(fn.attempts) == 2
+    assert 3.0 in sleeps
+    assert rate_limiter.stats()["retries"] == 1
+
+    # La pausa vale anche per le chiamate successive del processo
+    sleeps.clear()
+    rate_limiter.call(failing([]), ["ciao"])
+    assert sleeps[0] == pytest.approx(3.0, abs=0.5)
+
+
+def test_retry_after_ms_header(sleeps):
+    rate_limiter = RateLimitScheduler(max_retries=1)
+
+    rate_limiter.call(failing([RateLimitError({"retry-after-ms": "250"})]), ["ciao"])
+
+    assert 0.25 in sleeps
+
+
+def test_exponential_backoff_without_retry_after(sleeps):
+    rate_limiter = RateLimitScheduler(max_retries=5, backoff_base=1.0, backoff_max=3.0)
+    fn = failing([ServerError() for _ in range(4)])
+
+    assert rate_limiter.call(fn, ["ciao"]) == "ok"
+
+    backoffs = [delay for delay in sleeps if delay > 0]
+    assert len(fn.attempts) == 5
+    assert all(delay <= min(3.0, 2 ** attempt) for attempt, delay in enumerate(backoffs))
+    assert rate_limiter.stats()["retries"] == 4
+
+
+def test_gives_up_after_max_retries(sleeps):
+    rate_limiter = RateLimitScheduler(max_retries=2)
+    fn = failing([ServerError() for _ in range(10)])
+
+    with pytest.raises(ServerError):
+        rate_limiter.call(fn, ["ciao"])
+
+    assert len(fn.attempts) == 3
+    assert rate_limiter.stats()["failures"] == 1
+
+
+def test_non_retryable_errors_are_not_retried(sleeps):
+    rate_limiter = RateLimitScheduler(max_retries=5)
+    fn = failing([ValueError("richiesta non valida")])
+
+    with pytest.raises(ValueError):
+        rate_limiter.call(fn, ["ciao"])
+
+    assert len(fn.attempts) == 1
+    assert rate_limiter.stats() == {"calls": 1, "retries": 0, "failures": 1, "throttled_seconds": 0.0}
+
+
+def test_async_call_honours_retry_after(monkeypatch):
+    waits = []
+
+    async def fake_sleep(delay):
+        waits.append(delay)
+    monkeypatch.setattr(scheduler.asyncio, "sleep", fake_sleep)
+    rate_limiter = RateLimitScheduler(max_retries=2)
+    attempts = []
+
+    async def fn():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RateLimitError({"retry-after": "2"})
+        return "ok"
+
+    assert asyncio.run(rate_limiter.acall(fn, ["ciao"])) == "ok"
+    assert len(attempts) == 2
+    assert 2.0 in waits
+
+
+def test_stub_backend_call_is_retried(sleeps, monkeypatch):
+    backend = create_backend("stub")
+    backend.scheduler = RateLimitScheduler(max_retries=2)
+    calls = []
+    reply = StubChatModel.invoke
+
+    def flaky_invoke(model, messages, **kwargs):
+        calls.append(messages)
+        if len(calls) == 1:
+            raise RateLimitError({"retry-after": "1"})
+        return reply(model, messages, **kwargs)
+    monkeypatch.setattr(StubChatModel, "invoke", flaky_invoke)
+
+    response = backend([HumanMessage(content="Genera la descrizione finale del video.")])
+
+    assert "final_description" in response.content
+    assert len(calls) == 2
+    assert backend.scheduler.stats()["retries"] == 1
+
+
+def test_openai_backend_has_no_token_limit_unless_configured(monkeypatch):
+    monkeypatch.delenv("VIDEO_ANALYSIS_TPM", raising=False)
+    assert create_backend("openai", api_key="sk-test").scheduler.tokens is None
+
+    monkeypatch.setenv("VIDEO_ANALYSIS_TPM", "90000")
+    assert create_backend("openai", api_key="sk-test").scheduler.tokens.capacity == 90000
@@ -1,18 +1,15 @@
-import base64
-import os
-import uuid
-import tempfile
-from typing import List, Optional
-import json
-import cv2
-from io import BytesIO
-from PIL import Image
+from typing import Optional
 
 import streamlit as st
 
-from langchain_openai import ChatOpenAI
-from langchain.schema.messages import SystemMessage, HumanMessage
-from langchain_core.messages import AIMessage
+from analysis_core.backend import get_chat_backend
+from analysis_core.cache import cached_call
+from analysis_core.frames import extract_frames, format_minutes_seconds
+from analysis_core.parsing import ReplyParseError
+from analysis_core.prompts import get_system_prompt, user_style_text
+from analysis_core.sequential import FrameRequest, describe_frames_sequential
+from analysis_core.summarize import TimedText, summarize_hierarchically
+from analysis_core.videos import cleanup_video, save_video_bytes
 
 # Prompt di sistema di base
 BASE_SYSTEM_PROMPT_ = """
@@ -130,202 +127,53 @@ Ricorda: **Non ripetere** le descrizioni dei frame precedenti, ma considerale co
 Se i frame sono termici, potresti aggiungere un commento come “A 01:05 la zona del motore risulta particolarmente calda, indicando un possibile recente utilizzo del veicolo”.
 """
 
-OPENAI_API_KEY = "...."
-chat = ChatOpenAI(model="gpt-4o", temperature=0.25, max_tokens=2048, openai_api_key=OPENAI_API_KEY)
-
-MAX_PREVIOUS_DESCRIPTIONS = 100
-
-
-def decode_base64_video(video_base64: str) -> str:
-    video_data = base64.b64decode(video_base64)
-    tmp_dir = tempfile.mkdtemp()
-    video_path = os.path.join(tmp_dir, f"{uuid.uuid4()}.mp4")
-    with open(video_path, "wb") as f:
-        f.write(video_data)
-    return video_path
-
-
-# --- MODIFICA 1: Cambiamo il tipo di ritorno da List[str] a List[tuple],
-# per includere (frame_path, time_str)
-def extract_frames(video_path: str, width: int, height: int, num_frames: Optional[int] = None,
-                   frame_rate: Optional[int] = None) -> List[tuple]:
-    cap = cv2.VideoCapture(video_path)
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    fps = cap.get(cv2.CAP_PROP_FPS)
-
-    if num_frames is not None:
-        frame_indices = [int(i * total_frames / num_frames) for i in range(num_frames)]
-    elif frame_rate is not None:
-        frame_step = int(fps / frame_rate) if frame_rate <= fps else 1
-        frame_indices = list(range(0, total_frames, frame_step))
-    else:
-        num_frames = 5
-        frame_indices = [int(i * total_frames / num_frames) for i in range(num_frames)]
-
-    frame_paths = []
-    for i, idx in enumerate(frame_indices):
-        cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
-        ret, frame = cap.read()
-        if not ret:
-            break
-
-        # --- MODIFICA 2: Calcoliamo il tempo in secondi e lo trasformiamo in mm:ss
-        time_in_sec = idx / fps if fps else 0
-        minutes, seconds = divmod(int(time_in_sec), 60)
-        time_str = f"{minutes:02d}:{seconds:02d}"  # formattazione mm:ss
-
-        resized_frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
-        tmp_dir = tempfile.mkdtemp()
-        frame_path = os.path.join(tmp_dir, f"frame_{i}.jpg")
-        cv2.imwrite(frame_path, resized_frame)
-
-        # Invece di aggiungere solo frame_path, aggiungiamo (frame_path, time_str)
-        frame_paths.append((frame_path, time_str))
-
-    cap.release()
-    return frame_paths
-
-
-def image_to_base64(image_path: str) -> str:
-    with open(image_path, "rb") as f:
-        return "data:image/jpeg;base64," + base64.b64encode(f.read()).decode("utf-8")
-
-
-def get_length_instruction(length_style: str) -> str:
-    if length_style.lower() == "sintetico":
-        return "Scegli uno stile SINTETICO: descrizione breve ed essenziale."
-    elif length_style.lower() == "normale":
-        return "Scegli uno stile NORMALE: descrizione di lunghezza media e dettaglio moderato."
-    elif length_style.lower() == "dettagliato":
-        return "Scegli uno stile DETTAGLIATO: descrizione più lunga, ricca di particolari."
-    else:
-        return "Scegli uno stile NORMALE."
-
-
-def get_system_prompt(length_style: str) -> str:
-    length_instruction = get_length_instruction(length_style)
-    return BASE_SYSTEM_PROMPT + "\n" + length_instruction
-
+# Backend, modello e chiave API si configurano con le variabili d'ambiente (vedi analysis_core/backend.py)
+chat = get_chat_backend()
 
 def analyze_video_generator(video_data: bytes, num_frames: Optional[int], frame_rate: Optional[int], width: int,
                             height: int, length_style: str, additional_request: str):
+    # langchain viene importato solo quando parte un'analisi, non a ogni rerun dell'interfaccia
+    from langchain_core.messages import SystemMessage
+
     yield "Decodifica del video..."
-    video_base64 = base64.b64encode(video_data).decode('utf-8')
-    video_path = decode_base64_video(video_base64)
+    video_path = save_video_bytes(video_data)
 
     yield "Estrazione dei frame..."
-    # --- MODIFICA 3: Adesso frame_paths è una lista di tuple: (frame_path, time_str)
-    frame_paths = extract_frames(video_path, width=width, height=height, num_frames=num_frames, frame_rate=frame_rate)
-    yield f"{len(frame_paths)} frame estratti."
+    try:
+        frames = extract_frames(video_path, width=width, height=height, num_frames=num_frames, frame_rate=frame_rate)
+    finally:
+        cleanup_video(video_path)
+    yield f"{len(frames)} frame estratti."
 
-    system_prompt = get_system_prompt(length_style)
-    system_message = SystemMessage(content=system_prompt)
-    messages = [system_message]
+    system_message = SystemMessage(content=get_system_prompt(BASE_SYSTEM_PROMPT, length_style))
+    style_text = user_style_text(length_style, additional_request)
     frame_descriptions = []
 
-    # Prepara le richieste aggiuntive da aggiungere nel prompt utente
-    additional_req_text = ""
-    if additional_request.strip():
-        additional_req_text = f"Richieste aggiuntive: {additional_request.strip()}"
-
-    # Analisi dei singoli frame
-    # --- MODIFICA 4: Scompattiamo (frame_path, frame_time_str)
-    for i, (frame_path, frame_time_str) in enumerate(frame_paths):
-        yield f"Analisi del frame {i + 1}/{len(frame_paths)}..."
-        frame_b64 = image_to_base64(frame_path)
-
-        previous_descriptions_limited = frame_descriptions[-MAX_PREVIOUS_DESCRIPTIONS:]
-
-        # Prompt utente per il frame
-        # Includiamo stile, richieste aggiuntive e il tempo corrispondente
-        frame_user_text = (
-            "Analizza il frame seguente. Tieni conto delle descrizioni precedenti. "
-            f"\nQuesto frame è stato estratto al tempo (mm:ss): {frame_time_str}."
-        )
-        frame_user_text += f"\nStile: {length_style.upper()}"
-        if additional_req_text:
-            frame_user_text += f"\n{additional_req_text}"
-
-        human_content = [
-            {"type": "text", "text": frame_user_text},
-        ]
-
-        for idx, desc in enumerate(previous_descriptions_limited):
-            human_content.append({"type": "text", "text": f"Descrizione frame precedente {idx + 1}: {desc}"})
-
-        human_content.append({"type": "image_url", "image_url": {"url": frame_b64, "detail": "auto"}})
-
-        human_message = HumanMessage(content=human_content)
-
-        while True:
-            response = chat(messages + [human_message])
-            ai_response = response.content
-            print("#"*120)
-            print(ai_response)
-            print("#" * 120)
-            start_tag = "<attribute=frame_description|"
-            end_tag = "| attribute=frame_description>"
-            start_idx = ai_response.find(start_tag)
-            end_idx = ai_response.find(end_tag)
-
-            if start_idx == -1 or end_idx == -1:
-                yield "Errore nella formattazione della risposta del modello per il frame."
-                raise ValueError("Formato non corretto nella risposta del modello.")
-
-            json_str = ai_response[start_idx + len(start_tag):end_idx].strip()
-            try:
-                desc_dict = json.loads(json_str)
-                desc_frame = desc_dict.get("descrizione_frame", "")
-                break
-            except:
-                yield "Errore nel parsing del JSON per la descrizione del frame."
-                raise ValueError("Errore nel parsing del JSON per la descrizione del frame.")
-
+    # Ogni frame porta nel prompt il tempo del video a cui è stato estratto
+    yield f"Analisi di {len(frames)} frame..."
+    requests = [
+        FrameRequest("Analizza il frame seguente. Tieni conto delle descrizioni precedenti. "
+                     f"\nQuesto frame è stato estratto al tempo (mm:ss): {format_minutes_seconds(frame.timestamp)}."
+                     + style_text, frame.data_url)
+        for frame in frames
+    ]
+    # Risposte dalla cache condivisa se la stessa conversazione è già stata inviata al modello
+    call = cached_call(lambda m: chat(m).content, chat.model_name)
+    for i, desc_frame, _ in describe_frames_sequential(call, system_message, requests):
         frame_descriptions.append(desc_frame)
-        messages.append(human_message)
-        messages.append(AIMessage(content=ai_response))
         yield f"Descrizione frame {i + 1}: {desc_frame}"
 
-    # Descrizione finale del video
     yield "Generazione descrizione finale del video..."
-    # Includiamo anche per la descrizione finale lo stile e le richieste aggiuntive
-    final_user_text = (
-        "Genera la descrizione finale del video basandoti sulle descrizioni dei frame precedenti. "
-        "Non analisi mediche, ma solo qualitative ed estetiche."
-    )
-    final_user_text += f"\nStile: {length_style.upper()}"
-    if additional_req_text:
-        final_user_text += f"\n{additional_req_text}"
-    final_user_text += "\nFornisci la descrizione finale racchiusa nei tag richiesti."
-
-    final_human_content = [
-        {"type": "text", "text": final_user_text},
-    ]
-
-    for idx, d in enumerate(frame_descriptions):
-        final_human_content.append({"type": "text", "text": f"Descrizione frame {idx + 1}: {d}"})
-
-    final_human_message = HumanMessage(content=final_human_content)
-    final_response = chat(messages + [final_human_message])
-    final_text = final_response.content
-
-    final_start_tag = "<attribute=final_description|"
-    final_end_tag = "| attribute=final_description>"
-    fs_idx = final_text.find(final_start_tag)
-    fe_idx = final_text.find(final_end_tag)
-
-    if fs_idx == -1 or fe_idx == -1:
-        yield "Errore nella formattazione della descrizione finale."
-        raise ValueError("La risposta del modello non contiene la descrizione finale formattata correttamente.")
-
-    final_json_str = final_text[fs_idx + len(final_start_tag):fe_idx].strip()
-
+    final_user_text = ("Genera la descrizione finale del video basandoti sulle descrizioni dei frame precedenti. "
+                       "Non analisi mediche, ma solo qualitative ed estetiche." + style_text +
+                       "\nFornisci la descrizione finale racchiusa nei tag richiesti.")
+    # Descrizione finale dalle sole descrizioni dei frame con i loro tempi, senza immagini né storia
+    items = [TimedText(frame.timestamp, frame.timestamp, d) for frame, d in zip(frames, frame_descriptions)]
     try:
-        final_desc_dict = json.loads(final_json_str)
-        final_description = final_desc_dict.get("descrizione_finale", "")
-    except:
-        yield "Errore nel parsing del JSON per la descrizione finale."
-        raise ValueError("Errore nel parsing del JSON per la descrizione finale.")
+        final_description = summarize_hierarchically(call, system_message, items, final_user_text).description
+    except ReplyParseError:
+        yield "Errore nella formattazione della descrizione finale."
+        raise
 
     yield f"Descrizione finale del video: {final_description}"
     return frame_descriptions, final_description
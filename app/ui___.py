@@ -1,20 +1,16 @@
-import base64
 import os
-import uuid
-import tempfile
-from typing import List, Optional, Tuple
-import json
-import cv2
 import time
-from io import BytesIO
-from PIL import Image
 import threading
 
 import streamlit as st
 
-from langchain_openai import ChatOpenAI
-from langchain.schema.messages import SystemMessage, HumanMessage
-from langchain_core.messages import AIMessage
+from analysis_core.backend import get_chat_backend
+from analysis_core.cache import cached_call
+from analysis_core.frames import format_minutes_seconds, image_file_data_url
+from analysis_core.parsing import ReplyParseError, parse_reply
+from analysis_core.prompts import get_system_prompt, user_style_text
+from analysis_core.sequential import FrameRequest, describe_frames_sequential
+from analysis_core.summarize import TimedText, summarize_hierarchically
 
 # IMPORTA la funzione Selenium per lo stream extraction da uno script esterno.
 # In questo esempio la funzione è importata da AUTO_FLYGHTHUB.cockpit
@@ -66,172 +62,99 @@ Ad ogni chiamata riceverai:
 Ricorda di non ripetere le descrizioni precedenti, ma usale come contesto per mantenere coerenza.
 """
 
-def get_length_instruction(length_style: str) -> str:
-    if length_style.lower() == "sintetico":
-        return "Scegli uno stile SINTETICO: descrizione breve ed essenziale."
-    elif length_style.lower() == "normale":
-        return "Scegli uno stile NORMALE: descrizione di lunghezza media e dettaglio moderato."
-    elif length_style.lower() == "dettagliato":
-        return "Scegli uno stile DETTAGLIATO: descrizione più lunga, ricca di particolari."
-    else:
-        return "Scegli uno stile NORMALE."
-
-def get_system_prompt(length_style: str) -> str:
-    length_instruction = get_length_instruction(length_style)
-    return BASE_SYSTEM_PROMPT + "\n" + length_instruction
-
-# ---------------------------------
-# FUNZIONE DI UTILITÀ: Conversione immagine in base64
-# ---------------------------------
-def image_to_base64(image_path: str) -> str:
-    with open(image_path, "rb") as f:
-        return "data:image/jpeg;base64," + base64.b64encode(f.read()).decode("utf-8")
-
-# ---------------------------------
-# FUNZIONE: Estrazione frame da video (con timestamp)
-# (Qui non usiamo una funzione di estrazione da video, poiché i frame vengono generati dallo script Selenium)
-# ---------------------------------
-
 # ---------------------------------
 # GENERATORE PER ANALISI DELLO STREAM
 # ---------------------------------
-def analyze_stream_generator(width: int, height: int, length_style: str, additional_request: str):
-    yield "Inizio analisi stream..."
-    system_prompt = get_system_prompt(length_style)
-    system_message = SystemMessage(content=system_prompt)
-    messages = [system_message]
-    frame_descriptions = []
+# Cartella in cui lo script Selenium salva i frame dello stream (nome "frame_<timestamp in ms>.png")
+OUTPUT_FOLDER = "app/AUTO_FLYGHTHUB/OUTPUT_FRAMES"
+# Secondi senza nuovi frame dopo i quali lo stream si considera concluso
+STREAM_IDLE_SECONDS = 10
+
 
-    # Set per tenere traccia dei file già processati
-    processed_files = set()
-    # Specifica il percorso della cartella di output dei frame
-    output_folder = "app/AUTO_FLYGHTHUB/OUTPUT_FRAMES"
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
+def _frame_seconds(file: str) -> float:
+    try:
+        return int(file[len("frame_"):-len(".png")]) / 1000
+    except ValueError:
+        return 0.0
 
-    last_new_frame_time = time.time()
 
-    while True:
-        # Elenca i file PNG nella cartella OUTPUT_FRAMES (i frame hanno il nome "frame_<timestamp>.png")
-        all_files = [f for f in os.listdir(output_folder) if f.startswith("frame_") and f.endswith(".png")]
-        all_files.sort()  # Ordinati per nome (ossia per timestamp)
+def analyze_stream_generator(width: int, height: int, length_style: str, additional_request: str):
+    # langchain viene importato solo quando parte un'analisi, non a ogni rerun dell'interfaccia
+    from langchain_core.messages import SystemMessage
 
-        new_files = [f for f in all_files if f not in processed_files]
+    yield "Inizio analisi stream..."
+    system_message = SystemMessage(content=get_system_prompt(BASE_SYSTEM_PROMPT, length_style))
+    style_text = user_style_text(length_style, additional_request)
+    # File dei frame inviati al modello, nello stesso ordine delle descrizioni
+    stream_files = []
+    frame_descriptions = []
 
-        if new_files:
+    if not os.path.exists(OUTPUT_FOLDER):
+        os.makedirs(OUTPUT_FOLDER)
+
+    def stream_requests():
+        # I frame (già salvati su disco dallo script Selenium) vengono inviati man mano che compaiono nella
+        # cartella, in ordine di timestamp. La cartella viene sempre riletta prima di controllare il timeout:
+        # mentre il modello descrive un frame il generatore resta sospeso, e i frame arrivati nel frattempo
+        # non devono andare persi. Il generatore termina dopo STREAM_IDLE_SECONDS senza nuovi frame.
+        processed_files = set()
+        last_new_frame_time = time.time()
+        while True:
+            new_files = sorted(f for f in os.listdir(OUTPUT_FOLDER)
+                               if f.startswith("frame_") and f.endswith(".png") and f not in processed_files)
+            if not new_files:
+                if time.time() - last_new_frame_time > STREAM_IDLE_SECONDS:
+                    return
+                time.sleep(1)
+                continue
             last_new_frame_time = time.time()
             for file in new_files:
                 processed_files.add(file)
-                # Estrai il timestamp dal nome del file
-                timestamp_str = file[len("frame_"):-len(".png")]
-                try:
-                    ts = int(timestamp_str)
-                    minutes, seconds = divmod(int(ts / 1000), 60)
-                    time_str = f"{minutes:02d}:{seconds:02d}"
-                except:
-                    time_str = "00:00"
-
-                frame_path = os.path.join(output_folder, file)
-                frame_b64 = image_to_base64(frame_path)
-
-                # Costruisci il prompt per il frame (includendo il timestamp)
+                stream_files.append(file)
                 frame_user_text = (
-                    f"Analizza il frame seguente. Tieni conto delle descrizioni precedenti.\n"
-                    f"Questo frame è stato estratto al tempo (mm:ss): {time_str}."
+                    "Analizza il frame seguente. Tieni conto delle descrizioni precedenti.\n"
+                    f"Questo frame è stato estratto al tempo (mm:ss): {format_minutes_seconds(_frame_seconds(file))}."
+                    + style_text
                 )
-                frame_user_text += f"\nStile: {length_style.upper()}"
-                if additional_request.strip():
-                    frame_user_text += f"\nRichieste aggiuntive: {additional_request.strip()}"
-
-                human_content = [{"type": "text", "text": frame_user_text}]
-                previous_descriptions = frame_descriptions[-100:]
-                for idx, desc in enumerate(previous_descriptions):
-                    human_content.append({"type": "text", "text": f"Descrizione frame precedente {idx + 1}: {desc}"})
-                human_content.append({"type": "image_url", "image_url": {"url": frame_b64, "detail": "auto"}})
-
-                human_message = HumanMessage(content=human_content)
-
-                while True:
-                    response = chat(messages + [human_message])
-                    ai_response = response.content
-                    # Estrazione della descrizione racchiusa tra i marker
-                    start_tag = "<attribute=frame_description|"
-                    end_tag = "| attribute=frame_description>"
-                    start_idx = ai_response.find(start_tag)
-                    end_idx = ai_response.find(end_tag)
-
-                    if start_idx == -1 or end_idx == -1:
-                        print(response)
-                        yield "Errore nella formattazione della risposta del modello per il frame."
-                        raise ValueError("Formato non corretto nella risposta del modello.")
-
-                    json_str = ai_response[start_idx + len(start_tag):end_idx].strip()
-                    try:
-                        desc_dict = json.loads(json_str)
-                        desc_frame = desc_dict.get("descrizione_frame", "")
-                        # Se il timestamp non è incluso, lo aggiungiamo
-                        if "timestamp_frame" not in desc_dict:
-                            desc_frame = f"{desc_frame} [Timestamp: {time_str}]"
-                        break
-                    except:
-                        yield "Errore nel parsing del JSON per la descrizione del frame."
-                        raise ValueError("Errore nel parsing del JSON per la descrizione del frame.")
-
-                frame_descriptions.append(desc_frame)
-                messages.append(human_message)
-                messages.append(AIMessage(content=ai_response))
-                yield f"Descrizione frame per {file} (timestamp {time_str}): {desc_frame}"
-        else:
-            # Se non ci sono nuovi frame, controlla se sono passati più di 10 secondi
-            if time.time() - last_new_frame_time > 10:
-                yield "Nessun nuovo frame per 10 secondi. Interruzione analisi stream."
-                break
-        time.sleep(1)
+                yield FrameRequest(frame_user_text, image_file_data_url(os.path.join(OUTPUT_FOLDER, file)))
+
+    # Risposte dalla cache condivisa se la stessa conversazione è già stata inviata al modello
+    call = cached_call(lambda m: chat(m).content, chat.model_name)
+    for i, desc_frame, ai_response in describe_frames_sequential(call, system_message, stream_requests()):
+        file = stream_files[i]
+        time_str = format_minutes_seconds(_frame_seconds(file))
+        # Se il modello non riporta il timestamp nel blocco, lo aggiungiamo
+        fields = parse_reply(ai_response).frame_fields
+        if not fields or "timestamp_frame" not in fields[0]:
+            desc_frame = f"{desc_frame} [Timestamp: {time_str}]"
+        frame_descriptions.append(desc_frame)
+        yield f"Descrizione frame per {file} (timestamp {time_str}): {desc_frame}"
+    yield f"Nessun nuovo frame per {STREAM_IDLE_SECONDS} secondi. Interruzione analisi stream."
+    if not frame_descriptions:
+        yield "Nessun frame ricevuto dallo stream."
+        return [], ""
 
     # Genera la descrizione finale del video
     yield "Generazione descrizione finale del video..."
-    final_user_text = (
-        "Genera la descrizione finale del video basandoti sulle descrizioni dei frame precedenti. "
-        "Non analisi mediche, ma solo qualitative ed estetiche."
-    )
-    final_user_text += f"\nStile: {length_style.upper()}"
-    if additional_request.strip():
-        final_user_text += f"\nRichieste aggiuntive: {additional_request.strip()}"
-    final_user_text += "\nFornisci la descrizione finale racchiusa nei tag richiesti."
-
-    final_human_content = [{"type": "text", "text": final_user_text}]
-    for idx, d in enumerate(frame_descriptions):
-        final_human_content.append({"type": "text", "text": f"Descrizione frame {idx + 1}: {d}"})
-
-    final_human_message = HumanMessage(content=final_human_content)
-    final_response = chat(messages + [final_human_message])
-    final_text = final_response.content
-
-    final_start_tag = "<attribute=final_description|"
-    final_end_tag = "| attribute=final_description>"
-    fs_idx = final_text.find(final_start_tag)
-    fe_idx = final_text.find(final_end_tag)
-
-    if fs_idx == -1 or fe_idx == -1:
-        yield "Errore nella formattazione della descrizione finale."
-        raise ValueError("La risposta del modello non contiene la descrizione finale formattata correttamente.")
-
-    final_json_str = final_text[fs_idx + len(final_start_tag):fe_idx].strip()
+    final_user_text = ("Genera la descrizione finale del video basandoti sulle descrizioni dei frame precedenti. "
+                       "Non analisi mediche, ma solo qualitative ed estetiche." + style_text +
+                       "\nFornisci la descrizione finale racchiusa nei tag richiesti.")
+    # Descrizione finale dalle sole descrizioni dei frame con i loro tempi, senza immagini né storia
+    items = [TimedText(_frame_seconds(file), _frame_seconds(file), d) for file, d in zip(stream_files, frame_descriptions)]
     try:
-        final_desc_dict = json.loads(final_json_str)
-        final_description = final_desc_dict.get("descrizione_finale", "")
-    except:
-        yield "Errore nel parsing del JSON per la descrizione finale."
-        raise ValueError("Errore nel parsing del JSON per la descrizione finale.")
+        final_description = summarize_hierarchically(call, system_message, items, final_user_text).description
+    except ReplyParseError:
+        yield "Errore nella formattazione della descrizione finale."
+        raise
 
     yield f"Descrizione finale del video: {final_description}"
     return frame_descriptions, final_description
 
 # ---------------------------------
-# CONFIGURAZIONE DEL MODELLO CHATOPENAI
+# CONFIGURAZIONE DEL MODELLO
 # ---------------------------------
-OPENAI_API_KEY = "...."
-chat = ChatOpenAI(model="gpt-4o", temperature=0.25, max_tokens=2048, openai_api_key=OPENAI_API_KEY)
+# Backend, modello e chiave API si configurano con le variabili d'ambiente (vedi analysis_core/backend.py)
+chat = get_chat_backend()
 
 # ---------------------------------
 # STREAMLIT UI
@@ -1,18 +1,9 @@
-import base64
-import os
-import uuid
-import tempfile
-from typing import Optional
-import json
-import cv2
-from io import BytesIO
-from PIL import Image
-
 import streamlit as st
 
-from langchain_openai import ChatOpenAI
-from langchain.schema.messages import SystemMessage, HumanMessage
-from langchain_core.messages import AIMessage
+from analysis_core.backend import get_chat_backend
+from analysis_core.frames import jpeg_data_url, resize_image
+from analysis_core.prompts import get_system_prompt
+from analysis_core.sequential import describe_frame, frame_message
 
 # Prompt di base per il modello. Verrà arricchito con le istruzioni sulla lunghezza dell'output.
 BASE_SYSTEM_PROMPT = """
@@ -35,70 +26,24 @@ L'utente sceglierà tra "sintetico", "normale", "dettagliato".
 Adatta il tuo output di conseguenza.
 """
 
-OPENAI_API_KEY = "......"
-chat = ChatOpenAI(model="gpt-4o", temperature=0.25, max_tokens=2048, openai_api_key=OPENAI_API_KEY)
-
-def image_to_base64(image_data: bytes) -> str:
-    return "data:image/jpeg;base64," + base64.b64encode(image_data).decode("utf-8")
-
-def resize_image(image_data: bytes, width: int, height: int) -> bytes:
-    # Carica l'immagine in PIL
-    img = Image.open(BytesIO(image_data))
-    img_resized = img.resize((width, height))
-    # Converte l'immagine ridimensionata in bytes
-    buf = BytesIO()
-    img_resized.save(buf, format="JPEG")
-    return buf.getvalue()
-
-def generate_system_prompt(length_style: str) -> str:
-    if length_style.lower() == "sintetico":
-        length_instruction = "Scegli uno stile SINTETICO: descrizione breve ed essenziale."
-    elif length_style.lower() == "normale":
-        length_instruction = "Scegli uno stile NORMALE: descrizione di lunghezza media e dettaglio moderato."
-    elif length_style.lower() == "dettagliato":
-        length_instruction = "Scegli uno stile DETTAGLIATO: descrizione più lunga, ricca di particolari."
-    else:
-        length_instruction = "Scegli uno stile NORMALE."
-
-    return BASE_SYSTEM_PROMPT + "\n" + length_instruction
+# Backend, modello e chiave API si configurano con le variabili d'ambiente (vedi analysis_core/backend.py)
+chat = get_chat_backend()
 
 def analyze_single_image(image_data: bytes, length_style: str, additional_request: str):
-    # Genera il prompt di sistema in base allo stile desiderato
-    system_prompt = generate_system_prompt(length_style)
-    system_message = SystemMessage(content=system_prompt)
-    messages = [system_message]
+    # langchain viene importato solo quando parte un'analisi, non a ogni rerun dell'interfaccia
+    from langchain_core.messages import SystemMessage
 
-    # Converti l'immagine in base64
-    image_b64 = image_to_base64(image_data)
+    # Genera il prompt di sistema in base allo stile desiderato
+    system_message = SystemMessage(content=get_system_prompt(BASE_SYSTEM_PROMPT, length_style))
 
     # Messaggio utente (human message) con richieste aggiuntive
     # Le richieste aggiuntive vengono concatenate alla frase base
     human_text = "Analizza l'immagine seguente. Non generare analisi mediche. Rispetta lo stile richiesto."
     if additional_request.strip():
         human_text += "\nRichieste aggiuntive: " + additional_request.strip()
+    human_message = frame_message(human_text, jpeg_data_url(image_data), [])
 
-    human_content = [
-        {"type": "text", "text": human_text},
-        {"type": "image_url", "image_url": {"url": image_b64, "detail": "auto"}}
-    ]
-
-    human_message = HumanMessage(content=human_content)
-
-    response = chat(messages + [human_message])
-    ai_response = response.content
-
-    # Parsing della risposta
-    start_tag = "<attribute=frame_description|"
-    end_tag = "| attribute=frame_description>"
-    start_idx = ai_response.find(start_tag)
-    end_idx = ai_response.find(end_tag)
-
-    if start_idx == -1 or end_idx == -1:
-        raise ValueError("Formato non corretto nella risposta del modello.")
-
-    json_str = ai_response[start_idx+len(start_tag):end_idx].strip()
-    desc_dict = json.loads(json_str)
-    desc_frame = desc_dict.get("descrizione_frame", "")
+    desc_frame, _ = describe_frame(lambda m: chat(m).content, [system_message], human_message)
     return desc_frame
 
 # ---------------------------------